@@ -12,6 +12,7 @@ from .trim import trim_cmd
 from .filter import filter_cmd
 from .shogun import shogun_cmd
 from .sortmerna import sortmerna_cmd
+from .trim_filter import trim_filter_cmd
 
 
 # Initialize the plugin
@@ -22,3 +23,4 @@ plugin.register_command(trim_cmd)
 plugin.register_command(filter_cmd)
 plugin.register_command(shogun_cmd)
 plugin.register_command(sortmerna_cmd)
+plugin.register_command(trim_filter_cmd)
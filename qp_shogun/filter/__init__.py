@@ -20,6 +20,8 @@ req_params = {'input': ('artifact', ['per_sample_FASTQ'])}
 opt_params = {
     'Bowtie2 database to filter': ["choice: [%s]" % default_db_list,
                                    default_db],
+    'Additional Bowtie2 databases to filter': [
+        "mchoice: [%s]" % default_db_list, '[]'],
     'Number of threads': ['integer', '15']
     }
 outputs = {'Filtered files': 'per_sample_FASTQ'}
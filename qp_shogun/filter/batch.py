@@ -0,0 +1,189 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+# This file contains the batched version of the host filtering: the pairs of
+# several samples go through a single bowtie2 so its index is only loaded
+# once, and the unmapped pairs are split back per sample while streaming
+# -----------------------------------------------------------------------------
+
+from bisect import bisect_right
+from gzip import open as gzip_open
+from io import open as io_open, BufferedReader
+from itertools import islice
+from subprocess import Popen, PIPE
+from threading import Thread
+
+import click
+
+from qp_shogun.filter.sam_pairs import (
+    _unmapped_pairs, _gzip_writer, READ_BUFFER, COUNTS_MSG)
+
+
+def _open_fastq(fp):
+    """Opens a, possibly gzipped, FASTQ in binary mode"""
+    if fp.endswith('.gz'):
+        # GzipFile.readline is slow, a buffer in front of it reads by lines
+        # from its decompressed blocks
+        return BufferedReader(gzip_open(fp, 'rb'), READ_BUFFER)
+    return io_open(fp, 'rb', buffering=READ_BUFFER)
+
+
+def interleave_pairs(pairs, out, ends, bases=None):
+    """Writes the pairs of reads of several samples interleaved
+
+    Parameters
+    ----------
+    pairs : list of (str, str)
+        The forward and reverse FASTQ filepaths of each sample
+    out : file-like
+        The binary output
+    ends : list
+        The number of pairs written after each sample is appended to it,
+        once all its pairs are written
+    bases : list, optional
+        The number of bases of each sample is appended to it, with ends
+
+    Raises
+    ------
+    ValueError
+        If the forward and reverse files of a sample have a different number
+        of reads
+    """
+    total = 0
+    for fwd_fp, rev_fp in pairs:
+        sample_bases = 0
+        with _open_fastq(fwd_fp) as fwd, _open_fastq(rev_fp) as rev:
+            fwd, rev = iter(fwd), iter(rev)
+            for fwd_lines in zip(*[fwd] * 4):
+                rev_lines = tuple(islice(rev, 4))
+                if len(rev_lines) < 4:
+                    raise ValueError('%s has more reads than %s' % (
+                        fwd_fp, rev_fp))
+                out.write(b''.join(fwd_lines + rev_lines))
+                total += 1
+                sample_bases += len(fwd_lines[1].rstrip(b'\r\n')) + len(
+                    rev_lines[1].rstrip(b'\r\n'))
+            if next(rev, None) is not None:
+                raise ValueError('%s has more reads than %s' % (
+                    rev_fp, fwd_fp))
+        if bases is not None:
+            bases.append(sample_bases)
+        ends.append(total)
+
+
+def _close_writers(fps, writers):
+    """Closes the compressors of a sample, returning their errors"""
+    for writer in writers:
+        writer.stdin.close()
+    return ['Error compressing %s' % fp
+            for fp, writer in zip(fps, writers) if writer.wait() != 0]
+
+
+def _empty_outputs(fps):
+    """Writes the outputs of a sample without unmapped pairs"""
+    for fp in fps:
+        gzip_open(fp, 'wb').close()
+
+
+@click.command()
+@click.option('--threads', '-p', type=int, default=1, show_default=True,
+              help='The number of threads of each compressor')
+@click.option('--level', '-l', type=click.IntRange(1, 9), default=None,
+              help='The gzip level, by default the one of pigz')
+@click.option('--sample', '-s', 'samples', multiple=True,
+              type=(str, str, str, str),
+              help='The forward and reverse reads of a sample, and where to '
+                   'write its forward and reverse unmapped reads')
+@click.argument('bowtie2', nargs=-1, required=True, type=click.UNPROCESSED)
+def main(threads, level, samples, bowtie2):
+    """Filters the samples with a single BOWTIE2 command
+
+    The command, after --, must read the interleaved pairs from stdin and
+    write the alignments in the same order to stdout (--reorder
+    --interleaved -)
+    """
+    aligner = Popen(list(bowtie2), stdin=PIPE, stdout=PIPE,
+                    bufsize=READ_BUFFER)
+    ends = []
+    bases = []
+    errors = []
+    compress_errors = []
+
+    def _feed():
+        try:
+            interleave_pairs([s[:2] for s in samples], aligner.stdin, ends,
+                             bases)
+        except Exception as e:
+            errors.append(str(e))
+        finally:
+            try:
+                aligner.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = Thread(target=_feed)
+    feeder.start()
+    kept = [0] * len(samples)
+    kept_bases = [0] * len(samples)
+    # the samples whose outputs were started, only the compressors of the
+    # last one are running
+    started = 0
+    writers = []
+    try:
+        # with --reorder the alignments are in the same order as the pairs,
+        # so a pair is from the first sample whose pairs end after it, or
+        # from the sample being written if none does yet. The samples are
+        # done in order, so each one's compressors are started with its
+        # first pair and closed when the next one starts
+        for index, rec1, rec2, n in _unmapped_pairs(aligner.stdout, [0, 0]):
+            sample = bisect_right(ends, index)
+            if sample >= started:
+                if writers:
+                    compress_errors.extend(_close_writers(
+                        samples[started - 1][2:], writers))
+                for skipped in samples[started:sample]:
+                    _empty_outputs(skipped[2:])
+                writers = [_gzip_writer(fp, threads, level)
+                           for fp in samples[sample][2:]]
+                started = sample + 1
+            writers[0].stdin.write(rec1)
+            writers[1].stdin.write(rec2)
+            kept[sample] += 1
+            kept_bases[sample] += n
+    except ValueError as e:
+        aligner.kill()
+        errors.append(str(e))
+    except Exception:
+        aligner.kill()
+        raise
+    finally:
+        feeder.join()
+        if writers:
+            compress_errors.extend(_close_writers(
+                samples[started - 1][2:], writers))
+
+    if aligner.wait() != 0:
+        errors.append('bowtie2 failed with return value %d'
+                      % aligner.returncode)
+    errors.extend(compress_errors)
+    if errors:
+        raise click.ClickException('\n'.join(errors))
+    for skipped in samples[started:]:
+        _empty_outputs(skipped[2:])
+
+    start = 0
+    for sample, end, n_bases, n, n_kept_bases in zip(
+            samples, ends, bases, kept, kept_bases):
+        click.echo('%s: %s' % (sample[0], COUNTS_MSG % (
+            end - start, n_bases, n, n_kept_bases)), err=True)
+        start = end
+
+
+if __name__ == '__main__':
+    main()
@@ -6,19 +6,318 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 
-from os.path import join
-from tempfile import TemporaryDirectory
+from os.path import join, getsize, basename, exists
+from sys import executable
+import re
+from glob import glob
+from json import loads
+from itertools import zip_longest
+from shutil import rmtree
 from qp_shogun.utils import (
-    _format_params, make_read_pairs_per_sample,
-    _run_commands, _per_sample_ainfo)
+    _format_params, make_read_pairs_per_sample, _run_commands,
+    _per_sample_ainfo, plan_concurrency, _plan_commands, _estimate_seqs,
+    _archive_logs, _env_flag, _scratch_dir, _gzip_level, _log_lines,
+    _write_read_counts, TOOL_MODELS)
+from qp_shogun.filter.utils import bt2_reference
 
 BOWTIE2_PARAMS = {
     'x': 'Bowtie2 database to filter',
     'p': 'Number of threads'}
+# the bytes read at a time when loading an index in the page cache
+WARM_UP_CHUNK = 16 * 1024 ** 2
+# small samples are batched until the startup of bowtie2 is at most this
+# fraction of the runtime of the batch
+BATCH_MAX_OVERHEAD = 0.05
+# references of at most this many bases, as phiX, can be screened by k-mers
+# instead of bowtie2, see kmer_screens
+KMER_SCREEN_MAX_BASES = 10 ** 6
+# the counts each filter writes to stderr, qp_shogun.filter.sam_pairs isn't
+# imported so it can run as a module
+FILTER_COUNTS_RE = re.compile(
+    r'^(?:(.*): )?(\d+) pairs \((\d+) bp\), (\d+) with both reads '
+    r'unmapped \((\d+) bp\)$')
+
+
+def _batch_seqs():
+    """The number of sequences of a batch, see BATCH_MAX_OVERHEAD"""
+    model = TOOL_MODELS['bowtie2']
+    return model['seconds'] / (model['seconds_per_seq'] * BATCH_MAX_OVERHEAD)
+
+
+def batch_samples(sample_seqs, batch_seqs):
+    """Groups consecutive small samples in batches
+
+    Parameters
+    ----------
+    sample_seqs : list of float
+        The (estimated) number of sequences of each sample
+    batch_seqs : float
+        The number of sequences of a batch
+
+    Returns
+    -------
+    list of list of int
+        The indices of the samples of each batch, a sample with batch_seqs or
+        more sequences is always on its own
+    """
+    batches = []
+    batch = []
+    total = 0
+    for i, seqs in enumerate(sample_seqs):
+        if seqs >= batch_seqs:
+            batches.append([i])
+            continue
+        batch.append(i)
+        total += seqs
+        if total >= batch_seqs:
+            batches.append(batch)
+            batch = []
+            total = 0
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def _databases(parameters):
+    """The Bowtie2 databases to filter, in order and without duplicates"""
+    databases = [parameters['Bowtie2 database to filter']]
+    additional = parameters.get('Additional Bowtie2 databases to filter')
+    # Qiita passes the choices as a JSON list
+    if isinstance(additional, str):
+        additional = loads(additional)
+    databases.extend(additional or [])
+    return [db for i, db in enumerate(databases) if db not in databases[:i]]
+
+
+def kmer_screens(databases):
+    """The databases small enough to be screened by k-mers
+
+    Parameters
+    ----------
+    databases : list of str
+        The Bowtie2 databases to filter
+
+    Returns
+    -------
+    set of str
+        The databases with at most KMER_SCREEN_MAX_BASES bases, if the
+        QC_SHOGUN_KMER_SCREEN environment variable is set
+    """
+    screens = set()
+    if not _env_flag('QC_SHOGUN_KMER_SCREEN'):
+        return screens
+    for db in databases:
+        layout = bt2_reference(db)
+        if layout is not None and sum(
+                length for _, length, _ in layout) <= KMER_SCREEN_MAX_BASES:
+            screens.add(db)
+    return screens
+
+
+def _filter_counts(lines):
+    """The counts of the filters in the output of a command
+
+    Parameters
+    ----------
+    lines : list of str
+        The output of the command, see _log_lines
+
+    Returns
+    -------
+    dict of {str: tuple of int}
+        The pairs and bases read, and the pairs and bases written, by each
+        filter, keyed by its label: the database, or the forward reads of
+        a batched sample
+    """
+    counts = {}
+    for line in lines:
+        match = FILTER_COUNTS_RE.match(line)
+        if match is not None:
+            counts[match.group(1)] = tuple(int(n) for n in match.groups()[1:])
+    return counts
+
+
+def _chain_counts(stages):
+    """The reads and bases in and out of a sample from its filters
+
+    Parameters
+    ----------
+    stages : iterable of tuple of int
+        The counts of each filter of the sample, see _filter_counts
+
+    Returns
+    -------
+    tuple of int or None
+        The reads in, reads out, bases in and bases out, None without counts
+
+    Notes
+    -----
+    The filters are chained, so the first reads the most pairs and the last
+    writes the fewest; their output is in the order they finish.
+    """
+    stages = list(stages)
+    if not stages:
+        return None
+    first = max(stages, key=lambda c: c[0])
+    last = min(stages, key=lambda c: c[2])
+    return 2 * first[0], 2 * last[2], first[1], last[3]
+
+
+def _removed_reads(stages, names):
+    """The reads removed by each database of a sample
+
+    Parameters
+    ----------
+    stages : dict of {str: tuple of int}
+        The counts of each filter of the sample, see _filter_counts
+    names : list of str
+        The names of the databases, their labels in stages
+
+    Returns
+    -------
+    list of int or None
+        The reads each database removed, None for those without counts
+    """
+    return [2 * (stages[name][0] - stages[name][2]) if name in stages
+            else None for name in names]
+
+
+def _filter_seqs(lines, names):
+    """The pairs read by a filter command, its seqs in the benchmarks
+
+    Parameters
+    ----------
+    lines : list of str
+        The output of the command, see _log_lines
+    names : list of str
+        The names of the databases, see _removed_reads
+
+    Returns
+    -------
+    int or None
+        The pairs read by the first filter, or by the filters of all the
+        samples of a batch, None without counts
+    """
+    stages = _filter_counts(lines)
+    if not stages:
+        return None
+    chained = [c[0] for label, c in stages.items() if label in names]
+    if chained:
+        return max(chained)
+    # the filters of a batch are labelled by the forward reads of a sample
+    return sum(c[0] for c in stages.values())
+
+
+def _index_fps(index):
+    """The files of a Bowtie2 index, given its prefix"""
+    return sorted(glob(index + '.*.bt2') + glob(index + '.*.bt2l'))
+
+
+def warm_up_index(index):
+    """Reads a Bowtie2 index so it's in the page cache
+
+    Parameters
+    ----------
+    index : str
+        The Bowtie2 index prefix
+
+    Returns
+    -------
+    float
+        The size of the index, in MB
+
+    Notes
+    -----
+    With --mm bowtie2 memory-maps the index instead of reading it, so the
+    concurrent processes share its pages in the page cache, and reading it
+    once up front means the first samples don't page it in from disk at the
+    same time.
+    """
+    size = 0
+    for fp in _index_fps(index):
+        with open(fp, 'rb') as f:
+            while True:
+                chunk = f.read(WARM_UP_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+    return size / 1024 ** 2
+
+
+def filter_pipeline(parameters, r1_fp, r2_fp, fwd_fp=None, rev_fp=None,
+                    mm=False, screens=None, level=None):
+    """The command that filters the pairs of a sample with every database
+
+    Parameters
+    ----------
+    parameters : dict
+        The QC_Filter parameters, keyed by parameter name
+    r1_fp, r2_fp : str
+        Where to write the compressed forward and reverse unmapped reads
+    fwd_fp, rev_fp : str, optional
+        The forward and reverse reads, by default the pairs are read
+        interleaved from stdin
+    mm : bool, optional
+        Whether bowtie2 memory-maps the index (--mm)
+    screens : set of str, optional
+        The databases screened by k-mers instead of aligned with bowtie2
+    level : int, optional
+        The gzip level of the outputs, defaults to the one of pigz
+
+    Returns
+    -------
+    str
+        The command, each database reads the pairs of the previous one and
+        writes its unmapped pairs to the next one, interleaved
+    """
+    threads = parameters['Number of threads']
+    databases = _databases(parameters)
+    screens = screens or set()
+    aligned = [db for db in databases if db not in screens]
+
+    stage_cmds = []
+    for i, db in enumerate(databases):
+        # the screen reads the interleaved pairs from stdin by default
+        if i == 0 and fwd_fp is not None:
+            ip = '-1 %s -2 %s' % (fwd_fp, rev_fp)
+        else:
+            ip = '' if db in screens else '--interleaved -'
+        # the forward and reverse outputs are compressed at the same time
+        op = '--interleaved'
+        if i == len(databases) - 1:
+            op = '-p %s' % threads
+            if level is not None:
+                op += ' -l %d' % level
+            op += ' %s %s' % (r1_fp, r2_fp)
+
+        if db in screens:
+            stage_cmds.append(
+                '{python} -m qp_shogun.filter.kmer -x {db} -d {name} '
+                '{ip}{op}'.format(python=executable, db=db,
+                                  name=basename(db),
+                                  ip=ip + ' ' if ip else '', op=op))
+            continue
+        stage_params = dict(parameters)
+        stage_params[BOWTIE2_PARAMS['x']] = db
+        if len(aligned) > 1:
+            stage_params[BOWTIE2_PARAMS['p']] = max(
+                1, int(threads) // len(aligned))
+        param_string = _format_params(stage_params, BOWTIE2_PARAMS)
+        if mm:
+            param_string += ' --mm'
+        stage_cmds.append(
+            'bowtie2 {params} --very-sensitive {ip} | {python} -m '
+            'qp_shogun.filter.sam_pairs -d {name} {op}'.format(
+                params=param_string, ip=ip, python=executable,
+                name=basename(db), op=op))
+
+    return ' | '.join(stage_cmds)
 
 
 def generate_filter_commands(forward_seqs, reverse_seqs, map_file,
-                             out_dir, temp_dir, parameters):
+                             out_dir, parameters, mm=False, batches=None,
+                             screens=None, level=None):
     """Generates the QC_Filter commands
 
     Parameters
@@ -33,11 +332,27 @@ def generate_filter_commands(forward_seqs, reverse_seqs, map_file,
         The job output directory
     parameters : dict
         The command's parameters, keyed by parameter name
+    mm : bool, optional
+        Whether bowtie2 memory-maps the index (--mm)
+    batches : list of list of int, optional
+        The indices of the samples filtered by the same command, see
+        batch_samples. Defaults to a command per sample
+    screens : set of str, optional
+        The databases screened by k-mers instead of aligned with bowtie2,
+        see kmer_screens
+    level : int, optional
+        The gzip level of the outputs, defaults to the one of pigz
+
+    Raises
+    ------
+    ValueError
+        If samples are batched and there's more than one database to filter,
+        or it's screened by k-mers
 
     Returns
     -------
     cmds: list of str
-        The QC_Filter commands
+        The QC_Filter commands, one per batch
     samples: list of tup
         list of 4-tuples with run prefix, sample name, fwd read fp, rev read fp
 
@@ -47,47 +362,71 @@ def generate_filter_commands(forward_seqs, reverse_seqs, map_file,
     step but implicitly allowing empty reverse reads in the actual command
     generation. This behavior may allow support of situations with empty
     reverse reads in some samples, for example after trimming and QC.
+
+    The pairs where both reads are unmapped, from their primary alignments,
+    are streamed from bowtie2 to a compressor per read by
+    qp_shogun.filter.sam_pairs, without intermediate files: bowtie2 reports
+    both mates of a pair next to each other so they don't need to be sorted
+    by name. The reads are the same as bedtools bamtofastq on the name
+    sorted alignments, including their names, in the order of the input
+    files.
+
+    With additional databases, the unmapped pairs of each bowtie2 are
+    streamed, interleaved, to the bowtie2 of the next database, which share
+    the threads, and only the pairs unmapped in all of them are written.
+    The number of pairs and bases read and written by each database is
+    reported in the output of its qp_shogun.filter.sam_pairs.
+
+    A database in screens is filtered by qp_shogun.filter.kmer, which
+    removes the pairs sharing a k-mer with its reference, with the same
+    inputs and outputs as bowtie2 and qp_shogun.filter.sam_pairs.
+
+    The samples of a batch are interleaved into a single bowtie2, so its
+    index is only loaded once, and qp_shogun.filter.batch splits its
+    unmapped pairs back per sample. The alignments, and so the outputs of
+    each sample, are the same as when it's filtered on its own.
     """
     # we match filenames, samples, and run prefixes
     samples = make_read_pairs_per_sample(forward_seqs, reverse_seqs, map_file)
 
     cmds = []
 
-    param_string = _format_params(parameters, BOWTIE2_PARAMS)
     threads = parameters['Number of threads']
+    databases = _databases(parameters)
+    screens = screens or set()
+    compress = '-p %s' % threads
+    if level is not None:
+        compress += ' -l %d' % level
+
+    if batches is None:
+        batches = [[i] for i in range(len(samples))]
+    elif (len(databases) > 1 or screens) and any(
+            len(batch) > 1 for batch in batches):
+        raise ValueError('Samples can only be batched when filtering a '
+                         'single database with bowtie2')
 
-    for run_prefix, sample, f_fp, r_fp in samples:
-        cmds.append('bowtie2 {params} --very-sensitive -1 {fwd_ip} -2 {rev_ip}'
-                    ' | samtools view -f 12 -F 256 -b -o {bow_op}; '
-
-                    'samtools sort -T {sample_path} -@ {thrds} -n -o {sam_op} '
-                    '{sam_un_op}; '
-
-                    'bedtools bamtofastq -i {sam_op} -fq {bedtools_op_one} '
-                    '-fq2 {bedtools_op_two}; '
-                    'pigz -p {thrds} -c {bedtools_op_one} > {gz_op_one}; '
-                    'pigz -p {thrds} -c {bedtools_op_two} > {gz_op_two};'
-
-                    .format(params=param_string, thrds=threads,
-                            fwd_ip=f_fp, rev_ip=r_fp,
-                            bow_op=join(temp_dir, '%s.unsorted.bam'
-                                        % run_prefix),
-                            sample_path=join(temp_dir, '%s' % run_prefix),
-                            sam_op=join(temp_dir, '%s.bam' % run_prefix),
-                            sam_un_op=join(temp_dir,
-                                           '%s.unsorted.bam' % run_prefix),
-                            bedtools_op_one=join(temp_dir,
-                                                 '%s.R1.fastq'
-                                                 % run_prefix),
-                            bedtools_op_two=join(temp_dir,
-                                                 '%s.R2.fastq'
-                                                 % run_prefix),
-                            gz_op_one=join(out_dir,
-                                           '%s.R1.fastq.gz'
-                                           % run_prefix),
-                            gz_op_two=join(out_dir,
-                                           '%s.R2.fastq.gz'
-                                           % run_prefix)))
+    for batch in batches:
+        # forward and reverse input and output of each sample
+        files = [(samples[i][2], samples[i][3],
+                  join(out_dir, '%s.R1.fastq.gz' % samples[i][0]),
+                  join(out_dir, '%s.R2.fastq.gz' % samples[i][0]))
+                 for i in batch]
+        if len(batch) > 1:
+            param_string = _format_params(parameters, BOWTIE2_PARAMS)
+            if mm:
+                param_string += ' --mm'
+            cmds.append(
+                '{python} -m qp_shogun.filter.batch {compress} {samples} -- '
+                'bowtie2 {params} --very-sensitive --reorder --interleaved -'
+                .format(python=executable, compress=compress,
+                        params=param_string,
+                        samples=' '.join('-s %s %s %s %s' % f for f in files)))
+            continue
+
+        f_fp, r_fp, gz_op_one, gz_op_two = files[0]
+        cmds.append(filter_pipeline(
+            parameters, gz_op_one, gz_op_two, f_fp, r_fp, mm, screens,
+            level))
 
     return cmds, samples
 
@@ -126,30 +465,109 @@ def filter(qclient, job_id, parameters, out_dir):
     qiime_map = prep_info['qiime-map']
 
     # Step 2 generating command
-    qclient.update_job_step(job_id, "Step 2 of 4: Generating"
-                                    " QC_Filter commands")
-    # Creating temporary directory for intermediate files
-    with TemporaryDirectory(dir=out_dir, prefix='filter_') as temp_dir:
-        rs = fps['raw_reverse_seqs'] if 'raw_reverse_seqs' in fps else []
-        commands, samples = generate_filter_commands(fps['raw_forward_seqs'],
-                                                     rs, qiime_map, out_dir,
-                                                     temp_dir, parameters)
-
-        # Step 3 execute filtering command
-        len_cmd = len(commands)
-        msg = "Step 3 of 4: Executing QC_Filter job (%d/{0})".format(len_cmd)
-        success, msg = _run_commands(
-            qclient, job_id, commands, msg, 'QC_Filter')
-        if not success:
-            return False, None, msg
+    rs = fps['raw_reverse_seqs'] if 'raw_reverse_seqs' in fps else []
+    # the samples are independent so they are filtered concurrently, each
+    # with a share of the threads
+    sample_seqs = [
+        _estimate_seqs(fp) for fp in sorted(fps['raw_forward_seqs'])]
+    databases = _databases(parameters)
+    # small references are screened by k-mers instead of aligned
+    screens = kmer_screens(databases)
+    aligned = [db for db in databases if db not in screens]
+    names = [basename(db) for db in databases]
+    # with a memory-mapped index the concurrent samples share its memory
+    mm = _env_flag('QC_SHOGUN_BOWTIE2_MM')
+    shared_mb = None
+    if mm:
+        shared_mb = sum(getsize(fp) for db in aligned
+                        for fp in _index_fps(db)) / 1024 ** 2
+    # small samples can be filtered together, so the index is loaded once;
+    # the pairs of a batch can't be told apart after a database so batching
+    # is only possible with a single one
+    batches = [[i] for i in range(len(sample_seqs))]
+    if _env_flag('QC_SHOGUN_BOWTIE2_BATCH') and aligned == databases[:1]:
+        batches = batch_samples(sample_seqs, _batch_seqs())
+    batch_seqs = [sum(sample_seqs[i] for i in batch) for batch in batches]
+    if aligned:
+        plan = plan_concurrency(
+            'bowtie2', parameters['Number of threads'], batch_seqs,
+            shared_mb=shared_mb, stages=len(aligned))
+    else:
+        plan = plan_concurrency(
+            'kmer', parameters['Number of threads'], batch_seqs)
+    parameters['Number of threads'] = plan['threads']
+    qclient.update_job_step(
+        job_id, "Step 2 of 4: Generating QC_Filter commands (%s)"
+        % plan['estimate'])
+    # the outputs are written to a scratch directory and moved to out_dir
+    # when their command succeeds, the outputs are smaller than the inputs
+    sample_bytes = [sum(getsize(fp) for fp in pair if fp is not None)
+                    for pair in zip_longest(sorted(fps['raw_forward_seqs']),
+                                            sorted(rs))]
+    scratch = _scratch_dir(out_dir, sum(sorted(
+        (sum(sample_bytes[i] for i in batch) for batch in batches),
+        reverse=True)[:plan['concurrency']]))
+    commands, samples = _plan_commands(
+        plan, lambda params: generate_filter_commands(
+            fps['raw_forward_seqs'], rs, qiime_map, scratch, params, mm,
+            batches, screens, _gzip_level()),
+        parameters, 'Number of threads')
 
-    # Step 4 generating artifacts
-    msg = "Step 4 of 4: Generating new artifacts (%d/{0})".format(len_cmd)
+    # Step 3 execute filtering command
+    len_cmd = len(commands)
+    if mm and aligned:
+        qclient.update_job_step(
+            job_id, "Step 3 of 4: Loading the Bowtie2 database")
+        for db in aligned:
+            warm_up_index(db)
+    msg = "Step 3 of 4: Executing QC_Filter job (%d/{0}, {1})".format(
+        len_cmd, plan['description'])
+    log_dir = join(out_dir, 'bowtie2_logs')
     suffixes = ['%s.R1.fastq.gz',
                 '%s.R2.fastq.gz']
+    batches = [batches[i] for i in plan['order']]
+    log_names = [samples[batch[0]][0] if len(batch) == 1
+                 else 'batch_%d' % (i + 1) for i, batch in enumerate(batches)]
+    outputs = [[suff % samples[i][0] for i in batch for suff in suffixes]
+               for batch in batches]
+    try:
+        success, run_msg = _run_commands(
+            qclient, job_id, commands, msg, 'QC_Filter', plan['concurrency'],
+            log_dir, log_names, [batch_seqs[i] for i in plan['order']],
+            [[join(out_dir, fn) for fn in fns] for fns in outputs],
+            join(out_dir, 'bowtie2_ledger.json'),
+            [[(join(scratch, fn), join(out_dir, fn)) for fn in fns]
+             for fns in outputs],
+            lambda lines: _filter_seqs(lines, names))
+    finally:
+        rmtree(scratch, ignore_errors=True)
+    if not success:
+        return False, None, run_msg
+
+    # Step 4 generating artifacts
+    msg = "Step 4 of 4: Generating new artifacts (%d/{0})".format(len_cmd)
     prg_name = 'Filtering'
     file_type_name = 'Filtered files'
+    # the counts of a batch, which only has a database, are labelled by the
+    # forward reads of each sample
+    counts = {}
+    for name, batch in zip(log_names, batches):
+        stages = _filter_counts(_log_lines(join(log_dir, '%s.log' % name)))
+        for i in batch:
+            sample_stages = stages
+            if len(batch) > 1:
+                sample_stages = {names[0]: stages[samples[i][2]]} if (
+                    samples[i][2] in stages) else {}
+            chain = _chain_counts(sample_stages.values())
+            counts[samples[i][0]] = None if chain is None else (
+                chain + tuple(_removed_reads(sample_stages, names)))
+    counts_fp = _write_read_counts(
+        join(out_dir, 'bowtie2_read_counts.tsv'),
+        [s for s in samples if exists(join(out_dir, suffixes[0] % s[0]))],
+        counts, ['removed_%s' % name for name in names])
+    log_fp = _archive_logs(log_dir, join(out_dir, 'bowtie2_logs.tar.gz'))
     ainfo = _per_sample_ainfo(
-        out_dir, samples, suffixes, prg_name, file_type_name, bool(rs))
+        out_dir, samples, suffixes, prg_name, file_type_name, bool(rs),
+        log_fp, counts_fp)
 
-    return True, ainfo, ""
+    return True, ainfo, run_msg
@@ -0,0 +1,333 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+# This file contains a k-mer screen for small contaminant references, as the
+# bundled phiX: the pairs sharing a k-mer with the reference are removed
+# without the startup and alignment costs of bowtie2
+# -----------------------------------------------------------------------------
+
+from io import open as io_open
+from itertools import islice
+from os import getpid, remove, replace
+from os.path import getmtime, exists
+import sys
+
+import click
+import numpy as np
+
+from qp_shogun.filter.utils import bt2_reference
+from qp_shogun.filter.sam_pairs import _gzip_writer, READ_BUFFER, COUNTS_MSG
+from qp_shogun.filter.batch import _open_fastq
+
+# the k-mer size, as BBDuk's phiX screen (k=31); the canonical k-mers fit in
+# a uint64
+KMER_SIZE = 31
+# the pairs classified at a time
+BATCH_PAIRS = 4096
+# the k-mers are looked up in a bit table of 2 ** HASH_BITS bits before the
+# sorted reference k-mers, so most of the k-mers of the reads are rejected
+# without a binary search
+HASH_BITS = 20
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+# the 2 bit code of each base, anything else is ambiguous (4)
+_CODES = np.full(256, 4, dtype=np.uint8)
+for _i, _b in enumerate(b'ACGT'):
+    _CODES[_b] = _CODES[_b + 32] = _i
+
+
+def _window_values(codes, k):
+    """The 2 bit packed value of each k-long window of codes
+
+    Parameters
+    ----------
+    codes : np.array of np.uint8
+        The bases, 0 to 3
+    k : int
+        The window size, at most 32
+
+    Returns
+    -------
+    np.array of np.uint64
+        The value of each window, with its first base in the highest bits
+
+    Notes
+    -----
+    The windows of 1, 2, 4, ... bases are built by doubling, and a window of
+    k bases is the concatenation of those in the binary decomposition of k,
+    so the array is traversed O(log(k)) times.
+    """
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    windows = {1: codes.astype(np.uint64)}
+    size = 1
+    while size * 2 <= k:
+        prev = windows[size]
+        windows[size * 2] = (prev[:-size] << np.uint64(2 * size)) | \
+            prev[size:]
+        size *= 2
+
+    values = np.zeros(n, dtype=np.uint64)
+    offset = 0
+    while offset < k:
+        while offset + size > k:
+            size //= 2
+        values <<= np.uint64(2 * size)
+        values |= windows[size][offset:offset + n]
+        offset += size
+    return values
+
+
+def canonical_kmers(seq, k=KMER_SIZE):
+    """The canonical k-mers of a sequence
+
+    Parameters
+    ----------
+    seq : bytes
+        The sequence
+    k : int, optional
+        The k-mer size
+
+    Returns
+    -------
+    np.array of np.uint64, np.array of bool
+        The smallest of the value of each k-mer and of its reverse complement,
+        and whether the k-mer only has unambiguous bases
+    """
+    codes = _CODES[np.frombuffer(seq, dtype=np.uint8)]
+    ambiguous = codes > 3
+    codes = codes & 3
+    forward = _window_values(codes, k)
+    reverse = _window_values(3 - codes[::-1], k)[::-1]
+    n_ambiguous = np.concatenate(([0], np.cumsum(ambiguous)))
+    valid = n_ambiguous[k:] == n_ambiguous[:-k]
+    return np.minimum(forward, reverse), valid
+
+
+def _hash(kmers):
+    """The bit of each k-mer in the bit table, see HASH_BITS"""
+    return (kmers * _HASH_MULTIPLIER) >> np.uint64(64 - HASH_BITS)
+
+
+def _reference_kmers(index, k):
+    """The sorted canonical k-mers of the reference of a Bowtie2 index"""
+    layout = bt2_reference(index)
+    if layout is None:
+        raise ValueError('%s is not a Bowtie2 index' % index)
+    packed = np.fromfile(index + '.4.bt2', dtype=np.uint8)
+    # 4 bases per byte, the first in the lowest bits
+    codes = np.stack([(packed >> np.uint8(2 * i)) & 3 for i in range(4)],
+                     axis=1).ravel()
+    kmers = []
+    start = 0
+    for _, length, _ in layout:
+        stretch = codes[start:start + length]
+        forward = _window_values(stretch, k)
+        reverse = _window_values(3 - stretch[::-1], k)[::-1]
+        kmers.append(np.minimum(forward, reverse))
+        start += length
+    return np.unique(np.concatenate(kmers + [np.zeros(0, np.uint64)]))
+
+
+def load_kmer_screen(index, k=KMER_SIZE):
+    """Loads the k-mers of a reference, building and caching them if needed
+
+    Parameters
+    ----------
+    index : str
+        The prefix of the Bowtie2 index of the reference
+    k : int, optional
+        The k-mer size
+
+    Returns
+    -------
+    dict
+        The sorted canonical 'kmers' of the reference, their bit 'table' and
+        'k'
+
+    Notes
+    -----
+    The k-mers are cached next to the index, in {index}.k{k}.npy, and rebuilt
+    when the index is newer. If the cache can't be written, the k-mers are
+    built every time.
+    """
+    cache_fp = '%s.k%d.npy' % (index, k)
+    if exists(cache_fp) and getmtime(cache_fp) >= getmtime(
+            index + '.4.bt2'):
+        kmers = np.load(cache_fp)
+    else:
+        kmers = _reference_kmers(index, k)
+        tmp_fp = '%s.%d.tmp' % (cache_fp, getpid())
+        try:
+            with open(tmp_fp, 'wb') as f:
+                np.save(f, kmers)
+            replace(tmp_fp, cache_fp)
+        except OSError:
+            if exists(tmp_fp):
+                remove(tmp_fp)
+
+    table = np.zeros(2 ** HASH_BITS, dtype=bool)
+    table[_hash(kmers)] = True
+    return {'kmers': kmers, 'table': table, 'k': k}
+
+
+def screen_pairs(screen, pairs):
+    """Finds the pairs sharing a k-mer with the reference
+
+    Parameters
+    ----------
+    screen : dict
+        The reference, as returned by load_kmer_screen
+    pairs : list of bytes
+        The forward and reverse sequences of each pair, one after the other
+
+    Returns
+    -------
+    np.array of bool
+        Whether each pair has a k-mer of the reference in any of its reads
+    """
+    n_pairs = len(pairs) // 2
+    if not n_pairs:
+        return np.zeros(0, dtype=bool)
+    # the reads are separated by an ambiguous base so no k-mer spans two
+    kmers, valid = canonical_kmers(b'N'.join(pairs), screen['k'])
+    candidates = np.flatnonzero(valid & screen['table'][_hash(kmers)])
+    found = screen['kmers'].searchsorted(kmers[candidates])
+    found[found == len(screen['kmers'])] = 0
+    hits = candidates[screen['kmers'][found] == kmers[candidates]]
+
+    starts = np.cumsum([0] + [len(seq) + 1 for seq in pairs[:-1]])
+    matched = np.zeros(n_pairs, dtype=bool)
+    matched[(starts.searchsorted(hits, side='right') - 1) // 2] = True
+    return matched
+
+
+def screen_reads(screen, records, r1, r2=None):
+    """Writes the pairs without k-mers of the reference
+
+    Parameters
+    ----------
+    screen : dict
+        The reference, as returned by load_kmer_screen
+    records : iterable of (tuple of bytes, tuple of bytes)
+        The 4 lines of the forward and reverse FASTQ records of each pair
+    r1 : file-like
+        The binary output of the forward reads
+    r2 : file-like, optional
+        The binary output of the reverse reads, if None both reads are
+        written to r1 one after the other (interleaved)
+
+    Returns
+    -------
+    int, int, int, int
+        The number of pairs and of bases, and of those written
+    """
+    records = iter(records)
+    total = bases = kept = kept_bases = 0
+    while True:
+        batch = list(islice(records, BATCH_PAIRS))
+        if not batch:
+            break
+        seqs = [rec[1].rstrip(b'\r\n') for pair in batch for rec in pair]
+        matched = screen_pairs(screen, seqs)
+        lengths = [len(fwd) + len(rev)
+                   for fwd, rev in zip(seqs[::2], seqs[1::2])]
+        keep = [pair for pair, m in zip(batch, matched) if not m]
+        total += len(batch)
+        bases += sum(lengths)
+        kept += len(keep)
+        kept_bases += sum(n for n, m in zip(lengths, matched) if not m)
+        if r2 is None:
+            r1.write(b''.join(b''.join(fwd + rev) for fwd, rev in keep))
+        else:
+            r1.write(b''.join(b''.join(fwd) for fwd, _ in keep))
+            r2.write(b''.join(b''.join(rev) for _, rev in keep))
+    return total, bases, kept, kept_bases
+
+
+def _fastq_pairs(fwd, rev=None):
+    """Yields the 4 lines of the forward and reverse records of each pair
+
+    If rev is None the records are interleaved in fwd
+    """
+    fwd = iter(fwd)
+    if rev is None:
+        for lines in zip(*[fwd] * 8):
+            yield lines[:4], lines[4:]
+    else:
+        yield from zip(zip(*[fwd] * 4), zip(*[iter(rev)] * 4))
+
+
+@click.command()
+@click.option('--index', '-x', required=True,
+              help='The prefix of the Bowtie2 index of the reference')
+@click.option('--kmer-size', '-k', type=int, default=KMER_SIZE,
+              show_default=True, help='The k-mer size, at most 32')
+@click.option('--threads', '-p', type=int, default=1, show_default=True,
+              help='The number of threads of each compressor')
+@click.option('--level', '-l', type=click.IntRange(1, 9), default=None,
+              help='The gzip level, by default the one of pigz')
+@click.option('--database', '-d', default=None,
+              help='The name of the reference, to label the counts')
+@click.option('-1', 'fwd_fp', type=click.Path(exists=True, dir_okay=False),
+              help='The forward reads, by default the pairs are read '
+                   'interleaved from stdin')
+@click.option('-2', 'rev_fp', type=click.Path(exists=True, dir_okay=False),
+              help='The reverse reads')
+@click.option('--interleaved', is_flag=True,
+              help='Write the pairs interleaved and uncompressed to stdout')
+@click.argument('r1_fp', type=click.Path(dir_okay=False), required=False)
+@click.argument('r2_fp', type=click.Path(dir_okay=False), required=False)
+def main(index, kmer_size, threads, level, database, fwd_fp, rev_fp,
+         interleaved, r1_fp, r2_fp):
+    """Writes the pairs without k-mers of INDEX to R1_FP and R2_FP"""
+    if interleaved == bool(r1_fp or r2_fp) or (r1_fp and not r2_fp):
+        raise click.UsageError(
+            'Either R1_FP and R2_FP or --interleaved are required')
+    if bool(fwd_fp) != bool(rev_fp):
+        raise click.UsageError('-1 and -2 go together')
+    screen = load_kmer_screen(index, kmer_size)
+
+    if fwd_fp:
+        inputs = [_open_fastq(fwd_fp), _open_fastq(rev_fp)]
+    else:
+        inputs = [io_open(sys.stdin.fileno(), 'rb', buffering=READ_BUFFER,
+                          closefd=False)]
+    try:
+        if interleaved:
+            with io_open(sys.stdout.fileno(), 'wb', buffering=READ_BUFFER,
+                         closefd=False) as out:
+                counts = screen_reads(screen, _fastq_pairs(*inputs), out)
+        else:
+            writers = [_gzip_writer(fp, threads, level)
+                       for fp in (r1_fp, r2_fp)]
+            try:
+                counts = screen_reads(
+                    screen, _fastq_pairs(*inputs), writers[0].stdin,
+                    writers[1].stdin)
+            finally:
+                for writer in writers:
+                    writer.stdin.close()
+            failed = [fp for fp, writer in zip((r1_fp, r2_fp), writers)
+                      if writer.wait() != 0]
+            if failed:
+                raise click.ClickException(
+                    'Error compressing %s' % ', '.join(failed))
+    finally:
+        for f in inputs:
+            f.close()
+
+    msg = COUNTS_MSG % counts
+    if database is not None:
+        msg = '%s: %s' % (database, msg)
+    click.echo(msg, err=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+# This file contains an in-process version of `samtools fastq -f 12 -F 256 -n`
+# that reads the bowtie2 alignments from a pipe and writes the pairs where
+# both reads are unmapped straight to a gzip compressor per read
+# -----------------------------------------------------------------------------
+
+from io import open as io_open
+from subprocess import Popen, PIPE
+import sys
+
+import click
+
+# the bytes written to a compressor at a time, and read from the alignments
+WRITE_BUFFER = 1024 ** 2
+READ_BUFFER = 1024 ** 2
+# SAM flags are only parsed the first time they are seen, bowtie2 writes the
+# unmapped pairs as 77 and 141
+_FLAGS = {b'77': (1, False, True, True), b'141': (2, False, False, True)}
+# the counts written to stderr by each filter, see filter._filter_counts
+COUNTS_MSG = '%d pairs (%d bp), %d with both reads unmapped (%d bp)'
+_COMPLEMENT = bytes.maketrans(b'ACGTNacgtn', b'TGCANtgcan')
+
+
+def _parse_flag(flag):
+    """Parses a SAM flag
+
+    Parameters
+    ----------
+    flag : bytes
+        The FLAG field of a record
+
+    Returns
+    -------
+    int, bool, bool, bool
+        1 or 2 for the forward or reverse read of a pair where both reads are
+        unmapped (-f 12), in its primary alignment (-F 256), 0 otherwise;
+        whether the read is reverse complemented; whether it's the primary
+        alignment of a forward read, to count the pairs; and whether it's a
+        primary alignment, to count the bases
+    """
+    value = int(flag)
+    read = 0
+    if value & 12 == 12 and not value & 256:
+        read = {64: 1, 128: 2}.get(value & 192, 0)
+    _FLAGS[flag] = (read, bool(value & 16), value & 2496 == 64,
+                    not value & 2304)
+    return _FLAGS[flag]
+
+
+def _unmapped_pairs(sam, counts):
+    """Yields the pairs of reads where both reads are unmapped
+
+    Parameters
+    ----------
+    sam : iterable of bytes
+        The SAM lines, with the mates of a pair next to each other as bowtie2
+        writes them
+    counts : list of int
+        Its first and second elements are set to the number of pairs and of
+        bases read so far
+
+    Yields
+    ------
+    int, bytes, bytes, int
+        The index of the pair in the alignments, the FASTQ records of its
+        forward and reverse reads, and their number of bases
+
+    Raises
+    ------
+    ValueError
+        If the alignments don't start with a SAM header (@HD or @SQ), as
+        when the aligner failed before writing anything
+
+    Notes
+    -----
+    The records are the same as those of `samtools fastq -n`: the name
+    without /1 or /2 and the reads in their original orientation. A read
+    without its mate next to it is skipped, so both reads of a pair are
+    always yielded together.
+    """
+    counts[:2] = [0, 0]
+    pending = None
+    header = False
+
+    for line in sam:
+        if line[:1] == b'@':
+            header = header or line[:3] in (b'@HD', b'@SQ')
+            continue
+        if not header:
+            raise ValueError('The alignments have no SAM header')
+        name, flag, rest = line.split(b'\t', 2)
+        read, reverse, first, primary = _FLAGS.get(flag) or _parse_flag(flag)
+        counts[0] += first
+        if not primary:
+            continue
+        fields = rest.split(b'\t', 9)
+        seq = fields[7]
+        counts[1] += len(seq)
+        if not read:
+            continue
+
+        qual = fields[8].rstrip(b'\r\n')
+        if reverse:
+            seq = seq.translate(_COMPLEMENT)[::-1]
+            qual = qual[::-1]
+        record = b'@' + name + b'\n' + seq + b'\n+\n' + qual + b'\n'
+
+        if read == 1:
+            pending = (counts[0] - 1, name, record, len(seq))
+        elif pending is not None and pending[1] == name:
+            yield pending[0], pending[2], record, pending[3] + len(seq)
+            pending = None
+        else:
+            pending = None
+
+    if not header:
+        raise ValueError('The alignments have no SAM header')
+
+
+def extract_unmapped_pairs(sam, r1, r2=None):
+    """Writes the pairs of reads where both reads are unmapped
+
+    Parameters
+    ----------
+    sam : iterable of bytes
+        The SAM lines, with the mates of a pair next to each other as bowtie2
+        writes them
+    r1 : file-like
+        The binary output of the forward reads
+    r2 : file-like, optional
+        The binary output of the reverse reads, if None both reads are
+        written to r1 one after the other (interleaved)
+
+    Returns
+    -------
+    int, int, int, int
+        The number of pairs and of bases, and of those written
+
+    Notes
+    -----
+    See _unmapped_pairs, both outputs always have the same pairs in the same
+    order.
+
+    Raises
+    ------
+    ValueError
+        If the alignments don't have a SAM header
+    """
+    outputs = (r1, r2)
+    buffers = ([], [])
+    sizes = [0, 0]
+    counts = [0, 0]
+    kept = kept_bases = 0
+
+    for _, rec1, rec2, bases in _unmapped_pairs(sam, counts):
+        kept += 1
+        kept_bases += bases
+        if r2 is None:
+            records = ((0, rec1 + rec2),)
+        else:
+            records = ((0, rec1), (1, rec2))
+        for i, rec in records:
+            buffers[i].append(rec)
+            sizes[i] += len(rec)
+            if sizes[i] >= WRITE_BUFFER:
+                outputs[i].write(b''.join(buffers[i]))
+                del buffers[i][:]
+                sizes[i] = 0
+
+    for i in (0, 1):
+        if buffers[i]:
+            outputs[i].write(b''.join(buffers[i]))
+
+    return counts[0], counts[1], kept, kept_bases
+
+
+def _gzip_writer(fp, threads, level=None):
+    """Starts a pigz compressing its standard input to fp
+
+    The forward and reverse reads each have their own pigz, so they are
+    compressed at the same time. The level defaults to the one of pigz (6)
+    """
+    cmd = ['pigz', '-p', str(threads), '-c']
+    if level is not None:
+        cmd.insert(3, '-%d' % level)
+    with open(fp, 'wb') as f:
+        return Popen(cmd, stdin=PIPE, stdout=f, bufsize=WRITE_BUFFER)
+
+
+@click.command()
+@click.option('--threads', '-p', type=int, default=1, show_default=True,
+              help='The number of threads of each compressor')
+@click.option('--level', '-l', type=click.IntRange(1, 9), default=None,
+              help='The gzip level, by default the one of pigz')
+@click.option('--database', '-d', default=None,
+              help='The database the reads were aligned to, to label the '
+                   'counts')
+@click.option('--interleaved', is_flag=True,
+              help='Write the pairs interleaved and uncompressed to stdout')
+@click.argument('r1_fp', type=click.Path(dir_okay=False), required=False)
+@click.argument('r2_fp', type=click.Path(dir_okay=False), required=False)
+def main(threads, level, database, interleaved, r1_fp, r2_fp):
+    """Writes the unmapped pairs of the SAM in stdin to R1_FP and R2_FP"""
+    if interleaved == bool(r1_fp or r2_fp) or (r1_fp and not r2_fp):
+        raise click.UsageError(
+            'Either R1_FP and R2_FP or --interleaved are required')
+    sam = io_open(sys.stdin.fileno(), 'rb', buffering=READ_BUFFER,
+                  closefd=False)
+    try:
+        if interleaved:
+            with io_open(sys.stdout.fileno(), 'wb', buffering=WRITE_BUFFER,
+                         closefd=False) as out:
+                counts = extract_unmapped_pairs(sam, out)
+        else:
+            writers = [_gzip_writer(fp, threads, level)
+                       for fp in (r1_fp, r2_fp)]
+            try:
+                counts = extract_unmapped_pairs(
+                    sam, writers[0].stdin, writers[1].stdin)
+            finally:
+                for writer in writers:
+                    writer.stdin.close()
+            failed = [fp for fp, writer in zip((r1_fp, r2_fp), writers)
+                      if writer.wait() != 0]
+            if failed:
+                raise click.ClickException(
+                    'Error compressing %s' % ', '.join(failed))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    msg = COUNTS_MSG % counts
+    if database is not None:
+        msg = '%s: %s' % (database, msg)
+    click.echo(msg, err=True)
+
+
+if __name__ == '__main__':
+    main()
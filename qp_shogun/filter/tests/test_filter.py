@@ -7,20 +7,34 @@
 # -----------------------------------------------------------------------------
 
 from unittest import main
-from os import close, remove, makedirs
-from os.path import exists, isdir, join
+from os import close, remove, makedirs, chmod
+from os.path import exists, isdir, join, getsize
+from glob import glob
 from shutil import rmtree, copyfile
 from tempfile import mkstemp, mkdtemp
 from json import dumps
 from functools import partial
+from random import seed, randint, random, choice, choices
+from io import BytesIO
+from sys import executable
+import gzip
 import os
+import numpy as np
+from qiita_client.util import system_call
 from qiita_client.testing import PluginTestCase
 from qp_shogun import plugin
 from qp_shogun.filter.filter import (
-    generate_filter_commands, filter)
+    generate_filter_commands, filter, warm_up_index, batch_samples,
+    kmer_screens, filter_pipeline, _databases, _filter_counts,
+    _chain_counts, _removed_reads, _filter_seqs)
+from qp_shogun.filter.sam_pairs import extract_unmapped_pairs, _gzip_writer
+from qp_shogun.filter.batch import interleave_pairs
+from qp_shogun.filter.kmer import (
+    canonical_kmers, load_kmer_screen, screen_pairs)
 from qp_shogun.filter.utils import (
     get_dbs, get_dbs_list, generate_filter_dflt_params)
-from qp_shogun.utils import (_format_params, _per_sample_ainfo)
+from qp_shogun.utils import (
+    _format_params, _per_sample_ainfo, _system_call_logged)
 
 
 BOWTIE2_PARAMS = {
@@ -68,6 +82,7 @@ class QC_FilterTests(PluginTestCase):
         obs = generate_filter_dflt_params()
         exp = {'phix': {'Bowtie2 database to filter': join(db_path, 'phix',
                                                            'phix'),
+                        'Additional Bowtie2 databases to filter': [],
                         'Number of threads': 15}}
 
         self.assertEqual(obs, exp)
@@ -90,19 +105,9 @@ class QC_FilterTests(PluginTestCase):
         exp_cmd = [
             ('bowtie2 -p 5 -x %sphix/phix --very-sensitive '
              '-1 fastq/s1.fastq.gz -2 fastq/s1.R2.fastq.gz | '
-             'samtools view -f 12 -F 256 -b -o temp/s1.unsorted.bam; '
-
-             'samtools sort -T temp/s1 -@ 5 -n '
-             '-o temp/s1.bam temp/s1.unsorted.bam; '
-
-             'bedtools bamtofastq -i temp/s1.bam -fq '
-             'temp/s1.R1.fastq -fq2 '
-             'temp/s1.R2.fastq; '
-
-             'pigz -p 5 -c temp/s1.R1.fastq > '
-             'output/s1.R1.fastq.gz; '
-             'pigz -p 5 -c temp/s1.R2.fastq > '
-             'output/s1.R2.fastq.gz;') % db_path
+             '%s -m qp_shogun.filter.sam_pairs -d phix -p 5 '
+             'output/s1.R1.fastq.gz output/s1.R2.fastq.gz') % (
+                 db_path, executable)
             ]
 
         exp_sample = [
@@ -112,11 +117,543 @@ class QC_FilterTests(PluginTestCase):
         obs_cmd, obs_sample = generate_filter_commands(
             ['fastq/s1.fastq.gz'],
             ['fastq/s1.R2.fastq.gz'],
-            fp, 'output', 'temp', self.params)
+            fp, 'output', self.params)
 
         self.assertEqual(obs_cmd, exp_cmd)
         self.assertEqual(obs_sample, exp_sample)
 
+        # the index can be memory-mapped
+        obs_cmd, obs_sample = generate_filter_commands(
+            ['fastq/s1.fastq.gz'],
+            ['fastq/s1.R2.fastq.gz'],
+            fp, 'output', self.params, mm=True)
+        self.assertEqual(
+            obs_cmd, [exp_cmd[0].replace(' --very', ' --mm --very')])
+
+        # and the gzip level of the outputs set
+        obs_cmd, obs_sample = generate_filter_commands(
+            ['fastq/s1.fastq.gz'],
+            ['fastq/s1.R2.fastq.gz'],
+            fp, 'output', self.params, level=1)
+        self.assertEqual(
+            obs_cmd, [exp_cmd[0].replace(' -p 5 output', ' -p 5 -l 1 output')])
+
+    def test_generate_filter_commands_batches(self):
+        fd, fp = mkstemp()
+        close(fd)
+        with open(fp, 'w') as f:
+            f.write(MAPPING_FILE)
+        self._clean_up_files.append(fp)
+        db_path = os.environ["QC_FILTER_DB_DP"]
+
+        obs_cmd, obs_sample = generate_filter_commands(
+            ['fastq/s1.fastq.gz', 'fastq/s2.fastq.gz', 'fastq/s3.fastq.gz'],
+            ['fastq/s1.R2.fastq.gz', 'fastq/s2.R2.fastq.gz',
+             'fastq/s3.R2.fastq.gz'],
+            fp, 'output', self.params, batches=[[0, 2], [1]])
+        exp_cmd = [
+            ('%s -m qp_shogun.filter.batch -p 5 '
+             '-s fastq/s1.fastq.gz fastq/s1.R2.fastq.gz '
+             'output/s1.R1.fastq.gz output/s1.R2.fastq.gz '
+             '-s fastq/s3.fastq.gz fastq/s3.R2.fastq.gz '
+             'output/s3.R1.fastq.gz output/s3.R2.fastq.gz -- '
+             'bowtie2 -p 5 -x %sphix/phix --very-sensitive --reorder '
+             '--interleaved -') % (executable, db_path),
+            ('bowtie2 -p 5 -x %sphix/phix --very-sensitive '
+             '-1 fastq/s2.fastq.gz -2 fastq/s2.R2.fastq.gz | '
+             '%s -m qp_shogun.filter.sam_pairs -d phix -p 5 '
+             'output/s2.R1.fastq.gz output/s2.R2.fastq.gz') % (
+                 db_path, executable)]
+        self.assertEqual(obs_cmd, exp_cmd)
+        self.assertEqual([s[0] for s in obs_sample], ['s1', 's2', 's3'])
+
+    def test_databases(self):
+        phix = self.params['Bowtie2 database to filter']
+        self.assertEqual(_databases(self.params), [phix])
+        # Qiita passes the choices, and their default, as a JSON list
+        self.params['Additional Bowtie2 databases to filter'] = '[]'
+        self.assertEqual(_databases(self.params), [phix])
+        self.params['Additional Bowtie2 databases to filter'] = dumps(
+            ['/db/human', phix])
+        self.assertEqual(_databases(self.params), [phix, '/db/human'])
+        self.params['Additional Bowtie2 databases to filter'] = ['/db/human']
+        self.assertEqual(_databases(self.params), [phix, '/db/human'])
+
+    def test_generate_filter_commands_databases(self):
+        fd, fp = mkstemp()
+        close(fd)
+        with open(fp, 'w') as f:
+            f.write(MAPPING_FILE)
+        self._clean_up_files.append(fp)
+        db_path = os.environ["QC_FILTER_DB_DP"]
+        human = join(db_path, 'human', 'human')
+        self.params['Additional Bowtie2 databases to filter'] = [
+            human, join(db_path, 'phix', 'phix')]
+
+        # the unmapped pairs go from one database to the next, which share
+        # the threads, and a repeated database is only filtered once
+        exp_cmd = [
+            ('bowtie2 -p 2 -x %sphix/phix --very-sensitive '
+             '-1 fastq/s1.fastq.gz -2 fastq/s1.R2.fastq.gz | '
+             '%s -m qp_shogun.filter.sam_pairs -d phix --interleaved | '
+             'bowtie2 -p 2 -x %s --very-sensitive --interleaved - | '
+             '%s -m qp_shogun.filter.sam_pairs -d human -p 5 '
+             'output/s1.R1.fastq.gz output/s1.R2.fastq.gz') % (
+                 db_path, executable, human, executable)]
+        obs_cmd, obs_sample = generate_filter_commands(
+            ['fastq/s1.fastq.gz'], ['fastq/s1.R2.fastq.gz'], fp, 'output',
+            self.params)
+        self.assertEqual(obs_cmd, exp_cmd)
+
+        with self.assertRaisesRegex(ValueError, 'single database'):
+            generate_filter_commands(
+                ['fastq/s1.fastq.gz', 'fastq/s2.fastq.gz'],
+                ['fastq/s1.R2.fastq.gz', 'fastq/s2.R2.fastq.gz'], fp,
+                'output', self.params, batches=[[0, 1]])
+
+    def test_sam_pairs_interleaved(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        with open(join(out_dir, 'aln.sam'), 'w') as f:
+            f.write(SAM_PAIRS)
+
+        std_out, std_err, return_value = system_call(
+            '%s -m qp_shogun.filter.sam_pairs -d phix --interleaved < %s' % (
+                executable, join(out_dir, 'aln.sam')))
+        self.assertEqual(return_value, 0, std_err)
+        self.assertEqual(
+            std_err, 'phix: 4 pairs (80 bp), 2 with both reads unmapped '
+            '(40 bp)\n')
+        self.assertEqual(std_out, (
+            '@pair1\nACGTACGTAA\n+\nIIIIIIIIIA\n'
+            '@pair1\nTTGCATGCAA\n+\nIIIIIIIIIB\n'
+            '@pair4\nCCCCGGGGTT\n+\nIIIIIIIIIG\n'
+            '@pair4\nGGGGCCCCAA\n+\nIIIIIIIIIH\n'))
+
+        std_out, std_err, return_value = system_call(
+            '%s -m qp_shogun.filter.sam_pairs < %s' % (
+                executable, join(out_dir, 'aln.sam')))
+        self.assertNotEqual(return_value, 0)
+        self.assertIn('--interleaved are required', std_err)
+
+        # without a header the aligner didn't run, it's not an empty sample
+        std_out, std_err, return_value = system_call(
+            '%s -m qp_shogun.filter.sam_pairs --interleaved < /dev/null' %
+            executable)
+        self.assertNotEqual(return_value, 0)
+        self.assertIn('The alignments have no SAM header', std_err)
+
+    def test_filter_pipeline_aligner_fails(self):
+        # a bowtie2 that fails, as with a missing index, fails the command
+        # instead of writing empty outputs
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        od = partial(join, out_dir)
+        makedirs(od('bin'))
+        with open(od('bin', 'bowtie2'), 'w') as f:
+            f.write('#!/bin/sh\necho "Could not locate the index" >&2\n'
+                    'exit 1\n')
+        chmod(od('bin', 'bowtie2'), 0o755)
+        cmd = filter_pipeline(
+            self.params, od('s.R1.fastq.gz'), od('s.R2.fastq.gz'),
+            'support_files/kd_test_1_R1.fastq.gz',
+            'support_files/kd_test_1_R2.fastq.gz')
+
+        path = os.environ['PATH']
+        os.environ['PATH'] = '%s:%s' % (od('bin'), path)
+        try:
+            std_out, std_err, return_value = _system_call_logged(
+                cmd, od('s.log'))
+            self.assertNotEqual(return_value, 0)
+            self.assertIn('Could not locate the index', std_err)
+
+            # pipefail also catches a failed stage the filter can't tell,
+            # as one that fails after writing the header
+            with open(od('bin', 'bowtie2'), 'w') as f:
+                f.write('#!/bin/sh\nprintf "@HD\\tVN:1.0\\n"\nexit 1\n')
+            std_out, std_err, return_value = _system_call_logged(
+                cmd, od('s.log'))
+            self.assertNotEqual(return_value, 0)
+        finally:
+            os.environ['PATH'] = path
+
+    def test_generate_filter_commands_screens(self):
+        fd, fp = mkstemp()
+        close(fd)
+        with open(fp, 'w') as f:
+            f.write(MAPPING_FILE)
+        self._clean_up_files.append(fp)
+        db_path = os.environ["QC_FILTER_DB_DP"]
+        phix = join(db_path, 'phix', 'phix')
+        human = join(db_path, 'human', 'human')
+
+        obs_cmd, _ = generate_filter_commands(
+            ['fastq/s1.fastq.gz'], ['fastq/s1.R2.fastq.gz'], fp, 'output',
+            self.params, screens={phix})
+        self.assertEqual(obs_cmd, [
+            '%s -m qp_shogun.filter.kmer -x %s -d phix -1 fastq/s1.fastq.gz '
+            '-2 fastq/s1.R2.fastq.gz -p 5 output/s1.R1.fastq.gz '
+            'output/s1.R2.fastq.gz' % (executable, phix)])
+
+        # the screen passes the pairs to the bowtie2 of the next database,
+        # which gets all the threads
+        self.params['Additional Bowtie2 databases to filter'] = [human]
+        obs_cmd, _ = generate_filter_commands(
+            ['fastq/s1.fastq.gz'], ['fastq/s1.R2.fastq.gz'], fp, 'output',
+            self.params, screens={phix})
+        self.assertEqual(obs_cmd, [
+            '%s -m qp_shogun.filter.kmer -x %s -d phix -1 fastq/s1.fastq.gz '
+            '-2 fastq/s1.R2.fastq.gz --interleaved | bowtie2 -p 5 -x %s '
+            '--very-sensitive --interleaved - | %s -m '
+            'qp_shogun.filter.sam_pairs -d human -p 5 output/s1.R1.fastq.gz '
+            'output/s1.R2.fastq.gz' % (executable, phix, human, executable)])
+
+        # and reads them from stdin after another database
+        self.params['Bowtie2 database to filter'] = human
+        self.params['Additional Bowtie2 databases to filter'] = [phix]
+        obs_cmd, _ = generate_filter_commands(
+            ['fastq/s1.fastq.gz'], ['fastq/s1.R2.fastq.gz'], fp, 'output',
+            self.params, screens={phix})
+        self.assertEqual(obs_cmd, [
+            'bowtie2 -p 5 -x %s --very-sensitive -1 fastq/s1.fastq.gz '
+            '-2 fastq/s1.R2.fastq.gz | %s -m qp_shogun.filter.sam_pairs '
+            '-d human --interleaved | %s -m qp_shogun.filter.kmer -x %s '
+            '-d phix -p 5 output/s1.R1.fastq.gz output/s1.R2.fastq.gz' % (
+                human, executable, executable, phix)])
+
+        self.params['Additional Bowtie2 databases to filter'] = []
+        with self.assertRaisesRegex(ValueError, 'single database'):
+            generate_filter_commands(
+                ['fastq/s1.fastq.gz', 'fastq/s2.fastq.gz'],
+                ['fastq/s1.R2.fastq.gz', 'fastq/s2.R2.fastq.gz'], fp,
+                'output', self.params, batches=[[0, 1]], screens={human})
+
+    def test_kmer_screens(self):
+        db_path = os.environ["QC_FILTER_DB_DP"]
+        phix = join(db_path, 'phix', 'phix')
+        missing = join(db_path, 'phix', 'missing')
+        self.assertEqual(kmer_screens([phix, missing]), set())
+        os.environ['QC_SHOGUN_KMER_SCREEN'] = 'true'
+        try:
+            self.assertEqual(kmer_screens([phix, missing]), {phix})
+        finally:
+            del os.environ['QC_SHOGUN_KMER_SCREEN']
+
+    def test_canonical_kmers(self):
+        obs, valid = canonical_kmers(b'ACGTNAAACC', 3)
+        # ACG/CGT, CGT/ACG, GTN, TNA, NAA, AAA/TTT, AAC/GTT, ACC/GGT
+        self.assertEqual(valid.tolist(), [True, True, False, False, False,
+                                          True, True, True])
+        self.assertEqual(obs[valid].tolist(), [6, 6, 0, 1, 5])
+
+    def _phix_pairs(self, n, error_rate):
+        """Simulated pairs of 150 bp reads from phiX, with substitutions"""
+        db_path = os.environ["QC_FILTER_DB_DP"]
+        packed = np.fromfile(join(db_path, 'phix', 'phix.4.bt2'), np.uint8)
+        phix = ''.join('ACGT'[(b >> (2 * i)) & 3]
+                       for b in packed for i in range(4))[:5386]
+        pairs = []
+        for i in range(n):
+            start = randint(0, len(phix) - 300)
+            fragment = phix[start:start + 300]
+            reverse = fragment[::-1].translate(str.maketrans('ACGT', 'TGCA'))
+            for read in (fragment[:150], reverse[:150]):
+                pairs.append(''.join(
+                    choice('ACGT'.replace(b, '')) if random() < error_rate
+                    else b for b in read).encode())
+        return pairs
+
+    def test_kmer_screen_sensitivity(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        db_path = os.environ["QC_FILTER_DB_DP"]
+        for fp in glob(join(db_path, 'phix', 'phix.*')):
+            copyfile(fp, join(out_dir, fp.rsplit('/', 1)[1]))
+        screen = load_kmer_screen(join(out_dir, 'phix'))
+        # the k-mers are cached
+        self.assertTrue(exists(join(out_dir, 'phix.k31.npy')))
+        self.assertEqual(len(screen['kmers']), 5386 - 30)
+        self.assertEqual(
+            load_kmer_screen(join(out_dir, 'phix'))['kmers'].tolist(),
+            screen['kmers'].tolist())
+
+        seed(0)
+        # reads with 2% of errors still share k-mers with phiX, and
+        # random reads don't
+        obs = screen_pairs(screen, self._phix_pairs(1000, 0.02))
+        self.assertGreaterEqual(obs.sum(), 995)
+        obs = screen_pairs(screen, [''.join(choices('ACGT', k=150)).encode()
+                                    for _ in range(20000)])
+        self.assertEqual(obs.sum(), 0)
+
+    def test_kmer_screen_bowtie2(self):
+        # the k-mer screen removes at least as many phiX pairs as bowtie2
+        fd, map_fp = mkstemp()
+        close(fd)
+        with open(map_fp, 'w') as f:
+            f.write(MAPPING_FILE)
+        self._clean_up_files.append(map_fp)
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        od = partial(join, out_dir)
+
+        seed(1)
+        pairs = self._phix_pairs(500, 0.02) + [
+            ''.join(choices('ACGT', k=150)).encode() for _ in range(1000)]
+        for i, fp in enumerate([od('s1.fastq.gz'), od('s1.R2.fastq.gz')]):
+            with gzip.open(fp, 'wb') as f:
+                f.writelines(b'@r%d\n%s\n+\n%s\n' % (
+                    j, seq, b'I' * len(seq))
+                    for j, seq in enumerate(pairs[i::2]))
+
+        phix = self.params['Bowtie2 database to filter']
+        kept = {}
+        for engine, screens in (('bowtie2', None), ('kmer', {phix})):
+            makedirs(od(engine))
+            cmds, _ = generate_filter_commands(
+                [od('s1.fastq.gz')], [od('s1.R2.fastq.gz')], map_fp,
+                od(engine), self.params, screens=screens)
+            std_out, std_err, return_value = system_call(cmds[0])
+            self.assertEqual(return_value, 0, std_err)
+            with gzip.open(od(engine, 's1.R1.fastq.gz'), 'rt') as f:
+                kept[engine] = {
+                    int(line[2:]) for line in f.read().splitlines()[::4]}
+
+        # all the random pairs are kept
+        self.assertTrue(set(range(500, 1500)) <= kept['kmer'])
+        self.assertTrue(set(range(500, 1500)) <= kept['bowtie2'])
+        self.assertLessEqual(len(kept['kmer']), len(kept['bowtie2']))
+
+    def test_kmer_interleaved(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        db_path = os.environ["QC_FILTER_DB_DP"]
+        for fp in glob(join(db_path, 'phix', 'phix.*')):
+            copyfile(fp, join(out_dir, fp.rsplit('/', 1)[1]))
+        seed(2)
+        pairs = self._phix_pairs(1, 0) + [b'ACGT' * 40, b'TTGCA' * 30]
+        with open(join(out_dir, 'in.fastq'), 'wb') as f:
+            f.writelines(b'@p%d\n%s\n+\n%s\n' % (i // 2, seq, b'I' * len(seq))
+                         for i, seq in enumerate(pairs))
+
+        std_out, std_err, return_value = system_call(
+            '%s -m qp_shogun.filter.kmer -x %s -d phix --interleaved < %s' % (
+                executable, join(out_dir, 'phix'), join(out_dir, 'in.fastq')))
+        self.assertEqual(return_value, 0, std_err)
+        self.assertEqual(
+            std_err, 'phix: 2 pairs (610 bp), 1 with both reads unmapped '
+            '(310 bp)\n')
+        self.assertEqual(std_out, '@p1\n%s\n+\n%s\n@p1\n%s\n+\n%s\n' % (
+            'ACGT' * 40, 'I' * 160, 'TTGCA' * 30, 'I' * 150))
+
+    def test_batch_samples(self):
+        self.assertEqual(batch_samples([5, 1, 2, 3, 1, 1, 9, 2], 5),
+                         [[0], [1, 2, 3], [6], [4, 5, 7]])
+        self.assertEqual(batch_samples([1, 1], 5), [[0, 1]])
+        self.assertEqual(batch_samples([], 5), [])
+
+    def test_interleave_pairs(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        fwd_fp, rev_fp = join(out_dir, 'a.R1.fastq'), join(out_dir, 'a.R2.fq')
+        with open(fwd_fp, 'w') as f:
+            f.write('@a 1\nAC\n+\nII\n@b 1\nGG\n+\nII\n')
+        with open(rev_fp, 'w') as f:
+            f.write('@a 2\nTT\n+\nJJ\n@b 2\nCC\n+\nJJ\n')
+        out = BytesIO()
+        ends, bases = [], []
+        interleave_pairs([(fwd_fp, rev_fp), (fwd_fp, rev_fp)], out, ends,
+                         bases)
+        self.assertEqual(ends, [2, 4])
+        self.assertEqual(bases, [8, 8])
+        self.assertEqual(out.getvalue(), 2 * (
+            b'@a 1\nAC\n+\nII\n@a 2\nTT\n+\nJJ\n'
+            b'@b 1\nGG\n+\nII\n@b 2\nCC\n+\nJJ\n'))
+
+        with open(rev_fp, 'a') as f:
+            f.write('@c 2\nCC\n+\nJJ\n')
+        with self.assertRaisesRegex(ValueError, 'a.R2.fq has more reads'):
+            interleave_pairs([(fwd_fp, rev_fp)], BytesIO(), [])
+        with self.assertRaisesRegex(ValueError, 'a.R2.fq has more reads'):
+            interleave_pairs([(rev_fp, fwd_fp)], BytesIO(), [])
+
+    def test_batch(self):
+        # a stand-in for bowtie2 aligning the pairs whose forward read
+        # starts with an A, the outputs of each sample are the same as
+        # filtering it on its own
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        od = partial(join, out_dir)
+        with open(od('aligner.py'), 'w') as f:
+            f.write(FAKE_BOWTIE2)
+
+        samples = []
+        for name in ('kd_test_1', 'kd_test_2'):
+            samples.extend([
+                '-s', 'support_files/%s_R1.fastq.gz' % name,
+                'support_files/%s_R2.fastq.gz' % name,
+                od('%s.R1.fastq.gz' % name), od('%s.R2.fastq.gz' % name)])
+        std_out, std_err, return_value = system_call(
+            '%s -m qp_shogun.filter.batch -p 2 %s -- %s %s' % (
+                executable, ' '.join(samples), executable,
+                od('aligner.py')))
+        self.assertEqual(return_value, 0, std_err)
+
+        def _records(fp):
+            with gzip.open(fp, 'rt') as f:
+                lines = f.read().splitlines()
+            return list(zip(*[iter(lines)] * 4))
+
+        for name in ('kd_test_1', 'kd_test_2'):
+            fwd = _records('support_files/%s_R1.fastq.gz' % name)
+            rev = _records('support_files/%s_R2.fastq.gz' % name)
+            keep = [i for i, r in enumerate(fwd) if r[1][0] != 'A']
+            bases = [len(f[1]) + len(r[1]) for f, r in zip(fwd, rev)]
+            self.assertIn('%s_R1.fastq.gz: %d pairs (%d bp), %d with both '
+                          'reads unmapped (%d bp)' % (
+                              name, len(fwd), sum(bases), len(keep),
+                              sum(bases[i] for i in keep)), std_err)
+            for read, records in (('R1', fwd), ('R2', rev)):
+                exp = [('@' + records[i][0].split()[0][1:],) +
+                       records[i][1:] for i in keep]
+                self.assertEqual(
+                    _records(od('%s.%s.fastq.gz' % (name, read))), exp)
+
+    def test_batch_many_samples(self):
+        # the compressors are started a sample at a time, so a batch of many
+        # small samples doesn't need a process and a pipe per output at once
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        od = partial(join, out_dir)
+        with open(od('aligner.py'), 'w') as f:
+            f.write(FAKE_BOWTIE2)
+
+        # the pair of every third sample, and of the last two, is aligned
+        aligned = [i % 3 == 0 or i >= 198 for i in range(200)]
+        samples = []
+        for i in range(200):
+            with open(od('s%d_R1.fastq' % i), 'w') as f:
+                f.write('@r%d 1\n%sCGT\n+\nIIII\n' % (
+                    i, 'A' if aligned[i] else 'C'))
+            with open(od('s%d_R2.fastq' % i), 'w') as f:
+                f.write('@r%d 2\nTTTT\n+\nIIII\n' % i)
+            samples.extend([
+                '-s', od('s%d_R1.fastq' % i), od('s%d_R2.fastq' % i),
+                od('s%d.R1.fastq.gz' % i), od('s%d.R2.fastq.gz' % i)])
+        std_out, std_err, return_value = system_call(
+            'ulimit -n 64; %s -m qp_shogun.filter.batch -p 1 %s -- %s %s' % (
+                executable, ' '.join(samples), executable,
+                od('aligner.py')))
+        self.assertEqual(return_value, 0, std_err)
+
+        for i in range(200):
+            exp = [b'', b''] if aligned[i] else [
+                b'@r%d\nCCGT\n+\nIIII\n' % i, b'@r%d\nTTTT\n+\nIIII\n' % i]
+            for read, records in zip(('R1', 'R2'), exp):
+                with gzip.open(od('s%d.%s.fastq.gz' % (i, read))) as f:
+                    self.assertEqual(f.read(), records)
+            self.assertIn('/s%d_R1.fastq: 1 pairs (8 bp), %d with both reads '
+                          'unmapped' % (i, not aligned[i]), std_err)
+
+    def test_warm_up_index(self):
+        db_path = os.environ["QC_FILTER_DB_DP"]
+        fps = glob(join(db_path, 'phix', 'phix.*.bt2'))
+        self.assertEqual(warm_up_index(join(db_path, 'phix', 'phix')),
+                         sum(getsize(fp) for fp in fps) / 1024 ** 2)
+        self.assertEqual(warm_up_index(join(db_path, 'phix', 'none')), 0)
+
+    def test_extract_unmapped_pairs(self):
+        r1, r2 = BytesIO(), BytesIO()
+        obs = extract_unmapped_pairs(
+            BytesIO((SAM_PAIRS + SAM_PAIRS_EXTRA).encode()), r1, r2)
+        self.assertEqual(obs, (6, 120, 3, 60))
+        self.assertEqual(r1.getvalue(), (
+            b'@pair1\nACGTACGTAA\n+\nIIIIIIIIIA\n'
+            b'@pair4\nCCCCGGGGTT\n+\nIIIIIIIIIG\n'
+            b'@pair5\nTTTTACGTAC\n+\nJIIIIIIIII\n'))
+        self.assertEqual(r2.getvalue(), (
+            b'@pair1\nTTGCATGCAA\n+\nIIIIIIIIIB\n'
+            b'@pair4\nGGGGCCCCAA\n+\nIIIIIIIIIH\n'
+            b'@pair5\nGGGGCCCCAA\n+\nIIIIIIIIIK\n'))
+
+    def test_gzip_writer(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        writers = [_gzip_writer(join(out_dir, 'default.gz'), 2),
+                   _gzip_writer(join(out_dir, 'fast.gz'), 2, 1)]
+        self.assertEqual(writers[0].args, ['pigz', '-p', '2', '-c'])
+        self.assertEqual(writers[1].args, ['pigz', '-p', '2', '-1', '-c'])
+        for writer in writers:
+            writer.stdin.write(b'@r\nACGT\n+\nIIII\n')
+            writer.stdin.close()
+            self.assertEqual(writer.wait(), 0)
+        for fn in ('default.gz', 'fast.gz'):
+            with gzip.open(join(out_dir, fn)) as f:
+                self.assertEqual(f.read(), b'@r\nACGT\n+\nIIII\n')
+
+    def test_filter_counts(self):
+        # the filters finish in any order, the first reads the most pairs
+        # and the last writes the fewest
+        lines = ['Warning: skipping read',
+                 'human: 90 pairs (900 bp), 80 with both reads unmapped '
+                 '(790 bp)',
+                 'phix: 100 pairs (1000 bp), 90 with both reads unmapped '
+                 '(900 bp)',
+                 '4 pairs (80 bp), 2 with both reads unmapped (40 bp)']
+        obs = _filter_counts(lines)
+        self.assertEqual(obs, {'human': (90, 900, 80, 790),
+                               'phix': (100, 1000, 90, 900),
+                               None: (4, 80, 2, 40)})
+        del obs[None]
+        self.assertEqual(_chain_counts(obs.values()), (200, 160, 1000, 790))
+        self.assertIsNone(_chain_counts([]))
+        self.assertEqual(_filter_counts(lines[:1]), {})
+        # the reads of a pair count as 2
+        self.assertEqual(_removed_reads(obs, ['phix', 'human', 'mouse']),
+                         [20, 20, None])
+        # the benchmarks count the pairs read by the first filter, or by
+        # those of all the samples of a batch
+        self.assertEqual(_filter_seqs(lines[:3], ['phix', 'human']), 100)
+        self.assertEqual(_filter_seqs(
+            ['s1_R1.fastq.gz: 4 pairs (80 bp), 2 with both reads unmapped '
+             '(40 bp)', 's2_R1.fastq.gz: 6 pairs (120 bp), 6 with both reads '
+             'unmapped (120 bp)'], ['phix']), 10)
+        self.assertIsNone(_filter_seqs(lines[:1], ['phix']))
+
+    def test_filter_streaming_read_set(self):
+        # the streamed pairs are the same as those of sorting the
+        # alignments by name and extracting them with bedtools
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        od = partial(join, out_dir)
+        with open(od('aln.sam'), 'w') as f:
+            f.write(SAM_PAIRS)
+
+        std_out, std_err, return_value = system_call(
+            'samtools view -f 12 -F 256 -b -o {0} {1}; '
+            'samtools sort -n -o {2} {0}; '
+            'bedtools bamtofastq -i {2} -fq {3} -fq2 {4}'.format(
+                od('unsorted.bam'), od('aln.sam'), od('sorted.bam'),
+                od('bedtools.R1.fastq'), od('bedtools.R2.fastq')))
+        self.assertEqual(return_value, 0, std_err)
+        std_out, std_err, return_value = system_call(
+            '%s -m qp_shogun.filter.sam_pairs -p 2 %s %s < %s' % (
+                executable, od('s.R1.fastq.gz'), od('s.R2.fastq.gz'),
+                od('aln.sam')))
+        self.assertEqual(return_value, 0, std_err)
+        self.assertEqual(
+            std_err, '4 pairs (80 bp), 2 with both reads unmapped (40 bp)\n')
+
+        def _records(fp, opener=open):
+            with opener(fp, 'rt') as f:
+                lines = f.read().splitlines()
+            return sorted(zip(*[iter(lines)] * 4))
+
+        for read in ('R1', 'R2'):
+            obs = _records(od('s.%s.fastq.gz' % read), gzip.open)
+            self.assertEqual(obs, _records(od('bedtools.%s.fastq' % read)))
+            self.assertEqual([r[0] for r in obs], ['@pair1', '@pair4'])
+
     def test_filter(self):
         # generating filepaths
         in_dir = mkdtemp()
@@ -182,9 +719,26 @@ class QC_FilterTests(PluginTestCase):
             [(od('kd_test_1.R1.fastq.gz'), 'raw_forward_seqs'),
              (od('kd_test_1.R2.fastq.gz'), 'raw_reverse_seqs'),
              (od('kd_test_2.R1.fastq.gz'), 'raw_forward_seqs'),
-             (od('kd_test_2.R2.fastq.gz'), 'raw_reverse_seqs')]]
+             (od('kd_test_2.R2.fastq.gz'), 'raw_reverse_seqs'),
+             (od('bowtie2_logs.tar.gz'), 'log'),
+             (od('bowtie2_read_counts.tsv'), 'log')]]
         self.assertEqual(exp_fps, obs_fps)
 
+        # the reads and bases in and out of each sample, from the output of
+        # the filters
+        with open(od('bowtie2_read_counts.tsv')) as f:
+            counts = [line.split('\t') for line in f.read().splitlines()]
+        self.assertEqual(counts[0], ['sample', 'run_prefix', 'reads_in',
+                                     'reads_out', 'bases_in', 'bases_out',
+                                     'removed_phix'])
+        self.assertEqual(sorted(c[1] for c in counts[1:]),
+                         ['kd_test_1', 'kd_test_2'])
+        for c in counts[1:]:
+            self.assertLessEqual(int(c[3]), int(c[2]))
+            self.assertLessEqual(int(c[5]), int(c[4]))
+            # a single database removes all the reads filtered out
+            self.assertEqual(int(c[6]), int(c[2]) - int(c[3]))
+
     def test_per_sample_ainfo_error(self):
         in_dir = mkdtemp()
         self._clean_up_files.append(in_dir)
@@ -216,6 +770,45 @@ MAPPING_FILE_2 = (
     "SKD8.640184\tILLUMINA\tA\tA\tA\tANL\tA\ts1\tIllumina MiSeq\tdesc3\n"
 )
 
+# pair1 and pair4 are unmapped, pair2 is mapped (with a secondary
+# alignment) and only one of the reads of pair3 is mapped
+SAM_PAIRS = (
+    "@HD\tVN:1.0\tSO:unsorted\n"
+    "@SQ\tSN:phiX\tLN:5386\n"
+    "pair1\t77\t*\t0\t0\t*\t*\t0\t0\tACGTACGTAA\tIIIIIIIIIA\n"
+    "pair1\t141\t*\t0\t0\t*\t*\t0\t0\tTTGCATGCAA\tIIIIIIIIIB\n"
+    "pair2\t99\tphiX\t1\t42\t10M\t=\t11\t20\tGAGTTTTATC\tIIIIIIIIIC\n"
+    "pair2\t147\tphiX\t11\t42\t10M\t=\t1\t-20\tGCTTCGGCCC\tIIIIIIIIID\n"
+    "pair2\t355\tphiX\t21\t1\t10M\t=\t11\t0\tGAGTTTTATC\tIIIIIIIIIC\n"
+    "pair3\t73\tphiX\t31\t42\t10M\t=\t31\t0\tCTCGTCGCTG\tIIIIIIIIIE\n"
+    "pair3\t133\tphiX\t31\t0\t*\t=\t31\t0\tAAAAAAAAAA\tIIIIIIIIIF\n"
+    "pair4\t77\t*\t0\t0\t*\t*\t0\t0\tCCCCGGGGTT\tIIIIIIIIIG\n"
+    "pair4\t141\t*\t0\t0\t*\t*\t0\t0\tGGGGCCCCAA\tIIIIIIIIIH\n"
+)
+
+# the forward read of pair5 is reverse complemented, and pair6 and pair7
+# are missing a mate
+SAM_PAIRS_EXTRA = (
+    "pair5\t93\t*\t0\t0\t*\t*\t0\t0\tGTACGTAAAA\tIIIIIIIIIJ\n"
+    "pair5\t141\t*\t0\t0\t*\t*\t0\t0\tGGGGCCCCAA\tIIIIIIIIIK\n"
+    "pair6\t77\t*\t0\t0\t*\t*\t0\t0\tACGTACGTAA\tIIIIIIIIIL\n"
+    "pair7\t141\t*\t0\t0\t*\t*\t0\t0\tACGTACGTAA\tIIIIIIIIIM\n"
+)
+
+# reads interleaved pairs from stdin and writes their SAM records as bowtie2
+# does, with the pairs whose forward read starts with an A aligned
+FAKE_BOWTIE2 = """import sys
+lines = sys.stdin.buffer.read().decode().splitlines()
+print('@HD\\tVN:1.0\\tSO:unsorted')
+for i in range(0, len(lines), 8):
+    mapped = lines[i + 1].startswith('A')
+    for j, flags in ((i, (99, 77)), (i + 4, (147, 141))):
+        name = lines[j].split()[0][1:]
+        print('\\t'.join([name, str(flags[0] if mapped else flags[1]),
+                         '*', '0', '0', '*', '*', '0', '0', lines[j + 1],
+                         lines[j + 3], 'YT:Z:UP']))
+"""
+
 
 if __name__ == '__main__':
     main()
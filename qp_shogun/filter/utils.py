@@ -8,11 +8,12 @@
 
 # ------------------------------------------------------------------------------
 # This file contains functions related to generating default parameters for
-# QC_Filter
+# QC_Filter and reading its databases
 # ------------------------------------------------------------------------------
 
 import os
-from os.path import join, isdir
+from os.path import join, isdir, exists
+import struct
 
 
 def get_dbs(db_folder):
@@ -46,6 +47,40 @@ def generate_filter_dflt_params():
     # Create dict with command options per database
     for db in dbs:
         dflt_param_set[db] = {'Bowtie2 database to filter': dbs[db],
+                              'Additional Bowtie2 databases to filter': [],
                               'Number of threads': 15}
 
     return(dflt_param_set)
+
+
+def bt2_reference(index):
+    """Reads the layout of the reference of a Bowtie2 index
+
+    Parameters
+    ----------
+    index : str
+        The prefix of the index
+
+    Returns
+    -------
+    list of (int, int, bool) or None
+        For each stretch of unambiguous bases of the reference, in the order
+        they are packed in the index, the number of ambiguous bases before it,
+        its length and whether it starts a new sequence; None if the index
+        isn't a small (.bt2) index
+
+    Notes
+    -----
+    The layout is in the .3.bt2 file and the bases are packed, 4 per byte,
+    in the .4.bt2 file.
+    """
+    fp = index + '.3.bt2'
+    if not exists(fp):
+        return None
+    with open(fp, 'rb') as f:
+        data = f.read()
+    # the first integer is a 1 written in the endianness of the index
+    endian = '<' if struct.unpack('<i', data[:4])[0] == 1 else '>'
+    n = struct.unpack(endian + 'I', data[4:8])[0]
+    return [(ns, length, bool(first)) for ns, length, first in
+            struct.iter_unpack(endian + 'IIB', data[8:8 + 9 * n])]
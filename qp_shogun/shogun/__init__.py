@@ -8,8 +8,10 @@
 
 from qiita_client import QiitaCommand
 from .shogun import shogun
-from .utils import (generate_shogun_dflt_params, get_dbs_list)
+from .utils import (generate_shogun_dflt_params, get_dbs_list, RANKS,
+                    DFLT_RANKS)
 from os import environ
+from json import dumps
 
 
 __all__ = ['shogun']
@@ -31,12 +33,27 @@ opt_params = {
     'Number of threads': ['integer', '10'],
     'Capitalist': ['boolean', 'False'],
     'Percent identity': ['float', '0.95'],
+    # taxonomic ranks of the redistributed tables
+    'Taxonomic ranks': ['mchoice:[%s]' % ', '.join(
+                            '"%s"' % r for r in RANKS),
+                        dumps(DFLT_RANKS)],
+    # KEGG functional profile
+    'Functional profiling': ['boolean', 'False'],
     }
 outputs = {
     'Shogun Alignment Profile': 'BIOM',
     'Taxonomic Predictions - phylum': 'BIOM',
+    'Taxonomic Predictions - class': 'BIOM',
+    'Taxonomic Predictions - order': 'BIOM',
+    'Taxonomic Predictions - family': 'BIOM',
     'Taxonomic Predictions - genus': 'BIOM',
     'Taxonomic Predictions - species': 'BIOM',
+    'Functional Predictions - species, KEGG Modules Coverage': 'BIOM',
+    'Functional Predictions - species, KEGG Modules': 'BIOM',
+    'Functional Predictions - species, KEGG Pathways Coverage': 'BIOM',
+    'Functional Predictions - species, KEGG Pathways': 'BIOM',
+    'Functional Predictions - species, KEGG': 'BIOM',
+    'Functional Predictions - species, Normalized': 'BIOM',
     'Woltka - per genome': 'BIOM',
     'Woltka - per gene': 'BIOM',
     }
@@ -0,0 +1,281 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+# This file contains an in-process version of `shogun redistribute` so the
+# database taxonomy is only loaded once per job and all the levels are
+# computed from a single read of the profile
+# -----------------------------------------------------------------------------
+
+from os.path import exists
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix, csr_matrix
+from biom import Table
+
+from .utils import shogun_db_taxonomy_parser
+
+TAXA_LEVELS = {
+    'kingdom': 1, 'phylum': 2, 'class': 3, 'order': 4,
+    'family': 5, 'genus': 6, 'species': 7, 'strain': 8}
+
+
+def _lineage_prefixes(lineages, max_depth=None):
+    """Splits the lineages and builds all their prefixes
+
+    Parameters
+    ----------
+    lineages : pd.Series of str
+        The ';' separated lineages
+    max_depth : int, optional
+        The deepest prefix to build, defaults to the deepest lineage
+
+    Returns
+    -------
+    np.array of int, list of np.array of object
+        The depth of each lineage and, for each depth d (0-based, d + 1
+        ranks), the prefix of each lineage or NaN if the lineage is
+        shallower than d + 1
+    """
+    lineages = pd.Series(lineages, dtype=object).reset_index(drop=True)
+    ranks = lineages.str.split(';', expand=True)
+    depths = ranks.notnull().sum(axis=1).values
+    if max_depth is None:
+        max_depth = ranks.shape[1]
+
+    prefixes = []
+    current = None
+    for d in range(max_depth):
+        if d >= ranks.shape[1]:
+            current = pd.Series(np.nan, index=lineages.index, dtype=object)
+        elif current is None:
+            current = ranks[d]
+        else:
+            current = current.str.cat(ranks[d], sep=';')
+        prefixes.append(current.values.astype(object))
+
+    return depths, prefixes
+
+
+def load_redistribution_db(db_path):
+    """Loads the reference lineages and weights used to redistribute
+
+    Parameters
+    ----------
+    db_path : str
+        The path to the Shogun database
+
+    Returns
+    -------
+    dict
+        The reference lineages ('depths' and 'prefixes', see
+        _lineage_prefixes) and their 'weights', an array with one column per
+        taxonomic level
+
+    Notes
+    -----
+    As `shogun redistribute`, the weights are the number of sheared reads of
+    each reference assigned at each level (the shear file of the database).
+    If the database doesn't have a shear file, all the references in the
+    taxonomy file get the same weight.
+    """
+    fps = shogun_db_taxonomy_parser(db_path)
+    n_levels = len(TAXA_LEVELS)
+
+    if fps['shear'] is not None and exists(fps['shear']):
+        bayes = pd.read_csv(fps['shear'], sep='\t', header=None,
+                            index_col=0, dtype=str)
+        weights = bayes.iloc[:, :n_levels].apply(
+            pd.to_numeric, errors='coerce')
+        # this removes the header line, if present
+        keep = weights.notnull().all(axis=1).values
+        weights = weights[keep].values
+        lineages = pd.Series(bayes.index[keep])
+    else:
+        tax = pd.read_csv(fps['taxonomy'], sep='\t', header=None,
+                          dtype=str)
+        lineages = tax[1].drop_duplicates()
+        weights = np.ones((len(lineages), n_levels))
+
+    lineages = lineages.str.strip()
+    depths, prefixes = _lineage_prefixes(lineages, n_levels)
+
+    return {'depths': depths, 'prefixes': prefixes,
+            'weights': np.asarray(weights, dtype=np.float64)}
+
+
+def _redistribution_weights(db, depth, level):
+    """Probability of each target lineage given a lineage of depth `depth`
+
+    Parameters
+    ----------
+    db : dict
+        The database as returned by load_redistribution_db
+    depth : int
+        The number of ranks of the lineages to redistribute
+    level : int
+        The number of ranks of the target lineages
+
+    Returns
+    -------
+    pd.DataFrame
+        With columns prefix, target and prob
+    """
+    mask = db['depths'] >= depth
+    target_depth = np.minimum(db['depths'][mask], level)
+    targets = np.empty(mask.sum(), dtype=object)
+    for d in np.unique(target_depth):
+        sel = target_depth == d
+        targets[sel] = db['prefixes'][d - 1][mask][sel]
+
+    df = pd.DataFrame({
+        'prefix': db['prefixes'][depth - 1][mask],
+        'target': targets,
+        'prob': db['weights'][mask, depth - 1]})
+    df = df[df.prob > 0]
+    df = df.groupby(['prefix', 'target'], sort=False).prob.sum().reset_index()
+    df['prob'] /= df.groupby('prefix').prob.transform('sum')
+
+    return df
+
+
+def redistribute_profile(profile_fp, db, levels):
+    """Redistributes a Shogun profile to the given taxonomic levels
+
+    Parameters
+    ----------
+    profile_fp : str or file-like
+        The profile generated by `shogun assign_taxonomy`
+    db : dict
+        The database as returned by load_redistribution_db
+    levels : list of str
+        The levels to redistribute to, keys of TAXA_LEVELS
+
+    Returns
+    -------
+    dict of {str: biom.Table}
+        The redistributed tables keyed by level, with the lineages as
+        observation taxonomy
+
+    Notes
+    -----
+    Lineages at, or deeper than, the level are truncated to the level.
+    Shallower lineages are split among the references they contain,
+    proportionally to the number of reads of each reference assigned at the
+    depth of the lineage, and then truncated to the level. Lineages without
+    any reference keep their original name.
+    """
+    profile = pd.read_csv(profile_fp, sep='\t', index_col=0)
+    profile = profile[[isinstance(i, str) for i in profile.index]]
+    sample_ids = list(map(str, profile.columns))
+    data = csr_matrix(profile.values.astype(np.float64))
+
+    depths, prefixes = _lineage_prefixes(profile.index)
+    lineages = np.asarray(profile.index, dtype=object)
+    rows = np.arange(len(lineages))
+
+    tables = {}
+    for level_name in levels:
+        level = TAXA_LEVELS[level_name]
+        row_idx, keys, probs = [], [], []
+
+        deep = depths >= level
+        if deep.any():
+            row_idx.append(rows[deep])
+            keys.append(prefixes[level - 1][deep])
+            probs.append(np.ones(deep.sum()))
+
+        for depth in np.unique(depths[~deep]):
+            at_depth = depths == depth
+            lineage_rows = pd.DataFrame({
+                'row': rows[at_depth], 'prefix': lineages[at_depth]})
+            redist = lineage_rows.merge(
+                _redistribution_weights(db, depth, level), on='prefix',
+                how='left')
+            # lineages without references are kept as they are
+            missing = redist.target.isnull()
+            redist.loc[missing, 'target'] = redist.loc[missing, 'prefix']
+            redist.loc[missing, 'prob'] = 1.0
+            row_idx.append(redist.row.values)
+            keys.append(redist.target.values)
+            probs.append(redist.prob.values)
+
+        if row_idx:
+            row_idx = np.concatenate(row_idx)
+            codes, obs_ids = pd.factorize(np.concatenate(keys))
+            probs = np.concatenate(probs)
+        else:
+            row_idx, codes, obs_ids, probs = [], [], [], []
+        transform = coo_matrix(
+            (probs, (codes, row_idx)),
+            shape=(len(obs_ids), len(lineages))).tocsr()
+        redist = transform @ data
+
+        # sorting by lineage and removing empty lineages
+        order = np.argsort(np.asarray(obs_ids, dtype=str), kind='stable')
+        redist = redist[order]
+        obs_ids = [obs_ids[i] for i in order]
+        keep = np.asarray(redist.sum(axis=1)).ravel() != 0
+        redist = redist[np.flatnonzero(keep)]
+        obs_ids = [o for o, k in zip(obs_ids, keep) if k]
+
+        tb = Table(redist, observation_ids=obs_ids, sample_ids=sample_ids)
+        tb.add_metadata({x: {'taxonomy': x.split(';')} for x in obs_ids},
+                        axis='observation')
+        tables[level_name] = tb
+
+    return tables
+
+
+def collapse_ranks(table, ranks):
+    """Collapses a redistributed table to the given taxonomic ranks
+
+    Parameters
+    ----------
+    table : biom.Table
+        The redistributed table, its observation ids are ';' separated
+        lineages
+    ranks : list of str
+        The ranks to collapse to, keys of TAXA_LEVELS
+
+    Returns
+    -------
+    dict of {str: biom.Table}
+        The collapsed tables keyed by rank, with the lineages as observation
+        taxonomy
+
+    Notes
+    -----
+    The lineages are split once and each rank is a single sparse product of
+    the table with the lineage to rank prefix indicator matrix. Lineages
+    shallower than a rank keep their name, as in redistribute_profile, so
+    collapsing the species table gives the same result as redistributing the
+    profile to the rank.
+    """
+    obs_ids = np.asarray(table.ids(axis='observation'), dtype=object)
+    depths, prefixes = _lineage_prefixes(obs_ids, len(TAXA_LEVELS))
+    data = table.matrix_data.tocsr()
+    sample_ids = table.ids(axis='sample')
+
+    tables = {}
+    for rank in ranks:
+        level = TAXA_LEVELS[rank]
+        keys = np.where(depths >= level, prefixes[level - 1], obs_ids)
+        codes, rank_ids = pd.factorize(keys, sort=True)
+        indicator = coo_matrix(
+            (np.ones(len(codes)), (codes, np.arange(len(codes)))),
+            shape=(len(rank_ids), len(codes))).tocsr()
+        rank_ids = list(rank_ids)
+
+        tb = Table(indicator @ data, observation_ids=rank_ids,
+                   sample_ids=sample_ids)
+        tb.add_metadata({x: {'taxonomy': x.split(';')} for x in rank_ids},
+                        axis='observation')
+        tables[rank] = tb
+
+    return tables
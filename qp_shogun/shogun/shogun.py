@@ -6,17 +6,27 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 from os.path import join
-from .utils import readfq, import_shogun_biom
+from .utils import (readfq, import_shogun_biom, write_biom_table,
+                    write_biom_table_streaming, use_biom_streaming,
+                    shogun_db_functional_parser, parse_annotation_table)
+from .redistribute import (
+    load_redistribution_db, redistribute_profile, collapse_ranks)
 from qp_shogun.utils import (make_read_pairs_per_sample, _run_commands)
 import gzip
+import pandas as pd
+from json import loads
+from concurrent.futures import ThreadPoolExecutor
+from os import killpg
+from signal import SIGTERM
+from subprocess import Popen, PIPE
 from qiita_client import ArtifactInfo
 from qiita_client.util import system_call
-from biom import util
 
 SHOGUN_PARAMS = {
     'Database': 'database', 'Aligner tool': 'aligner',
     'Number of threads': 'threads', 'Capitalist': 'capitalist',
-    'Percent identity': 'percent_id'}
+    'Percent identity': 'percent_id', 'Taxonomic ranks': 'ranks',
+    'Functional profiling': 'functional'}
 
 ALN2EXT = {
     # if you uncomment these lines, also uncomment the tests:
@@ -26,6 +36,19 @@ ALN2EXT = {
     'bowtie2': 'sam'
 }
 
+# Tables generated by `shogun functional`: file suffix, annotation file and
+# annotation type used for the observation metadata, if the names should be
+# used as taxonomy and the artifact name
+FUNCTIONAL_TABLES = [
+    ('kegg.modules.coverage', 'module', 'module', False,
+     'KEGG Modules Coverage'),
+    ('kegg.modules', 'module', 'module', False, 'KEGG Modules'),
+    ('kegg.pathways.coverage', 'pathway', 'pathway', False,
+     'KEGG Pathways Coverage'),
+    ('kegg.pathways', 'pathway', 'pathway', False, 'KEGG Pathways'),
+    ('kegg', 'enzyme', 'enzyme', True, 'KEGG'),
+    ('normalized', 'enzyme', 'pathway', True, 'Normalized')]
+
 
 def generate_fna_file(temp_path, samples):
     # Combines reverse and forward seqs per sample
@@ -145,14 +168,60 @@ def run_shogun_to_biom(in_fp, biom_in, out_dir, level, version='alignment'):
     else:
         output_fp = join(out_dir, 'otu_table.%s.%s.%s.biom'
                          % (version, level, biom_in[0]))
-    tb = import_shogun_biom(in_fp, biom_in[1],
-                            biom_in[2], biom_in[3])
-    with util.biom_open(output_fp, 'w') as f:
-        tb.to_hdf5(f, "shogun")
+    n_samples = pd.read_csv(in_fp, sep='\t', index_col=0, nrows=0).shape[1]
+    if biom_in[1] is None and use_biom_streaming(n_samples):
+        # wide tables are converted without loading them in memory
+        write_biom_table_streaming(in_fp, output_fp, biom_in[3])
+    else:
+        tb = import_shogun_biom(in_fp, biom_in[1],
+                                biom_in[2], biom_in[3])
+        write_biom_table(tb, output_fp)
 
     return output_fp
 
 
+def run_functional_to_biom(func_dp, db_path, out_dir, level, threads):
+    """Converts the `shogun functional` tables to BIOM
+
+    Parameters
+    ----------
+    func_dp : str
+        The `shogun functional` output directory
+    db_path : str
+        The Shogun database path
+    out_dir : str
+        The job output directory
+    level : str
+        The level used to run `shogun functional`
+    threads : int
+        The number of tables to convert at the same time
+
+    Returns
+    -------
+    list of (str, str)
+        The artifact name and BIOM filepath of each table
+    """
+    func_db_fp = shogun_db_functional_parser(db_path)
+
+    with ThreadPoolExecutor(max_workers=max(1, int(threads))) as executor:
+        # each annotation file is parsed once and shared by all the tables
+        # that use it
+        annotations = {(func_db_fp[key], atype)
+                       for _, key, atype, _, _ in FUNCTIONAL_TABLES}
+        list(executor.map(lambda x: parse_annotation_table(*x), annotations))
+
+        futures = []
+        for suffix, key, atype, names_to_taxonomy, name in FUNCTIONAL_TABLES:
+            biom_in_fp = join(func_dp, "profile.%s.%s.txt" % (level, suffix))
+            biom_in = [suffix, func_db_fp[key], atype, names_to_taxonomy]
+            aname = 'Functional Predictions - %s, %s' % (level, name)
+            futures.append((aname, executor.submit(
+                run_shogun_to_biom, biom_in_fp, biom_in, out_dir, level,
+                'func')))
+
+        return [(aname, f.result()) for aname, f in futures]
+
+
 def shogun(qclient, job_id, parameters, out_dir):
     """Run Shogun with the given parameters
 
@@ -220,44 +289,91 @@ def shogun(qclient, job_id, parameters, out_dir):
     if not success:
         return False, None, msg
 
-    sys_msg = "Step 5 of 7: Compressing and converting alignment to BIOM"
-    qclient.update_job_step(job_id, sys_msg)
-    alignment_fp = join(out_dir, 'alignment.%s.%s' % (
-        parameters['aligner'], ALN2EXT[parameters['aligner']]))
-    xz_cmd = 'xz -9 -T%s %s' % (parameters['threads'], alignment_fp)
-    std_out, std_err, return_value = system_call(xz_cmd)
-    if return_value != 0:
-        error_msg = ("Error during %s:\nStd out: %s\nStd err: %s"
-                     "\n\nCommand run was:\n%s"
-                     % (sys_msg, std_out, std_err, xz_cmd))
-        return False, None, error_msg
-    output = run_shogun_to_biom(profile_fp, [None, None, None, True],
-                                out_dir, 'profile')
-
-    alignment_fp_xz = '%s.xz' % alignment_fp
-    ainfo = [ArtifactInfo('Shogun Alignment Profile', 'BIOM',
-                          [(output, 'biom'),
-                           (alignment_fp_xz, 'log')])]
-
-    # Step 5 redistribute profile
-    sys_msg = "Step 6 of 7: Redistributed profile with Shogun (%d/{0})"
-    levels = ['phylum', 'genus', 'species']
-    redist_fps = []
-    for level in levels:
-        redist_cmd, output = generate_shogun_redist_commands(
-            profile_fp, out_dir, parameters, level)
-        redist_fps.append(output)
-        success, msg = _run_commands(
-            qclient, job_id, redist_cmd, sys_msg, 'Shogun redistribute')
-        if not success:
-            return False, None, msg
-    # Converting redistributed files to biom
-    for redist_fp, level in zip(redist_fps, levels):
-        biom_in = ["redist", None, '', True]
-        output = run_shogun_to_biom(
-            redist_fp, biom_in, out_dir, level, 'redist')
-        aname = 'Taxonomic Predictions - %s' % level
-        ainfo.append(ArtifactInfo(aname, 'BIOM', [(output, 'biom')]))
+    # the functional profile only depends on the taxonomic profile so it
+    # runs in the background while the alignment and the profile are
+    # converted and redistributed, in its own process group so it can be
+    # stopped if they fail
+    functional = parameters['functional']
+    func_proc = None
+    if functional:
+        func_level = 'species'
+        func_cmd, func_dp = generate_shogun_functional_commands(
+            profile_fp, out_dir, parameters, func_level)
+        func_proc = Popen(func_cmd[0], shell=True, stdout=PIPE, stderr=PIPE,
+                          universal_newlines=True, start_new_session=True)
+        # its output is read in the background so it doesn't block on it
+        func_executor = ThreadPoolExecutor(max_workers=1)
+        func_future = func_executor.submit(func_proc.communicate)
+
+    try:
+        sys_msg = "Step 5 of 7: Compressing and converting alignment to BIOM"
+        qclient.update_job_step(job_id, sys_msg)
+        alignment_fp = join(out_dir, 'alignment.%s.%s' % (
+            parameters['aligner'], ALN2EXT[parameters['aligner']]))
+        xz_cmd = 'xz -9 -T%s %s' % (parameters['threads'], alignment_fp)
+        std_out, std_err, return_value = system_call(xz_cmd)
+        if return_value != 0:
+            error_msg = ("Error during %s:\nStd out: %s\nStd err: %s"
+                         "\n\nCommand run was:\n%s"
+                         % (sys_msg, std_out, std_err, xz_cmd))
+            return False, None, error_msg
+        output = run_shogun_to_biom(profile_fp, [None, None, None, True],
+                                    out_dir, 'profile')
+
+        alignment_fp_xz = '%s.xz' % alignment_fp
+        ainfo = [ArtifactInfo('Shogun Alignment Profile', 'BIOM',
+                              [(output, 'biom'),
+                               (alignment_fp_xz, 'log')])]
+
+        # Step 6 redistribute profile
+        sys_msg = "Step 6 of 7: Redistributed profile"
+        qclient.update_job_step(job_id, sys_msg)
+        ranks = parameters['ranks']
+        if isinstance(ranks, str):
+            ranks = loads(ranks)
+        # the species table is always needed as the other ranks are
+        # collapsed from it
+        redist_db = load_redistribution_db(parameters['database'])
+        redist_tables = redistribute_profile(
+            profile_fp, redist_db, ['species'])
+        redist_tables.update(collapse_ranks(
+            redist_tables['species'], [r for r in ranks if r != 'species']))
+        redist_ainfo = []
+        for level in ranks:
+            output = join(out_dir, 'otu_table.redist.%s.biom' % level)
+            write_biom_table(redist_tables[level], output)
+            aname = 'Taxonomic Predictions - %s' % level
+            redist_ainfo.append(
+                ArtifactInfo(aname, 'BIOM', [(output, 'biom')]))
+
+        # the artifacts are only added once the functional profile succeeded
+        func_ainfo = []
+        if functional:
+            qclient.update_job_step(job_id, "Step 6 of 7: Functional profile")
+            std_out, std_err = func_future.result()
+            if func_proc.returncode != 0:
+                error_msg = ("Error running Shogun functional:\nStd out: %s\n"
+                             "Std err: %s\n\nCommand run was:\n%s"
+                             % (std_out, std_err, func_cmd[0]))
+                return False, None, error_msg
+            for aname, output in run_functional_to_biom(
+                    func_dp, parameters['database'], out_dir, func_level,
+                    parameters['threads']):
+                func_ainfo.append(
+                    ArtifactInfo(aname, 'BIOM', [(output, 'biom')]))
+        ainfo.extend(redist_ainfo)
+        ainfo.extend(func_ainfo)
+    finally:
+        if func_proc is not None:
+            # on an error the functional profile is stopped, and waited for
+            # so it doesn't keep writing to out_dir
+            if func_proc.poll() is None:
+                try:
+                    killpg(func_proc.pid, SIGTERM)
+                except ProcessLookupError:
+                    pass
+            func_future.result()
+            func_executor.shutdown(wait=True)
 
     # Woltka only works with WOL databases
     if 'wol' in parameters['database']:
@@ -282,56 +398,3 @@ def shogun(qclient, job_id, parameters, out_dir):
                 (per_gene_fp, 'biom')])])
 
     return True, ainfo, ""
-
-#
-# This code is not currently needed but it will be used for analysis, so
-# leaving here to avoid having to rewrite it
-#
-
-# # Step 6 functional profile
-# sys_msg = "Step 6 of 7: Functional profile with Shogun (%d/{0})"
-# levels = ['species']
-# func_fp = ''
-# for level in levels:
-#     func_cmd, output = generate_shogun_functional_commands(
-#         profile_fp, out_dir, parameters, level)
-#     func_fp = output
-#     success, msg = _run_commands(
-#         qclient, job_id, func_cmd, sys_msg, 'Shogun functional')
-#     if not success:
-#         return False, None, msg
-# # Coverting funcitonal files to biom
-# func_db_fp = shogun_db_functional_parser(parameters['database'])
-# for level in levels:
-#     func_to_biom_fps = [
-#         ["kegg.modules.coverage", func_db_fp['module'],
-#          'module', False],
-#         ["kegg.modules", func_db_fp['module'], 'module', False],
-#         ["kegg.pathways.coverage", func_db_fp['pathway'],
-#          'pathway', False],
-#         ["kegg.pathways", func_db_fp['pathway'], 'pathway', False],
-#         ["kegg", func_db_fp['enzyme'], 'enzyme', True],
-#         ["normalized", func_db_fp['enzyme'], 'pathway', True]]
-#
-#     for biom_in in func_to_biom_fps:
-#         biom_in_fp = join(func_fp, "profile.%s.%s.txt"
-#                           % (level, biom_in[0]))
-#         output = run_shogun_to_biom(biom_in_fp, biom_in, out_dir,
-#                                     level, 'func')
-#         if biom_in[0] == 'kegg.modules.coverage':
-#             atype = 'KEGG Modules Coverage'
-#         elif biom_in[0] == 'kegg.modules':
-#             atype = 'KEGG Modules'
-#         elif biom_in[0] == 'kegg.pathways.coverage':
-#             atype = 'KEGG Pathways Coverage'
-#         elif biom_in[0] == 'kegg.pathways':
-#             atype = 'KEGG Pathways'
-#         elif biom_in[0] == 'kegg':
-#             atype = 'KEGG'
-#         elif biom_in[0] == 'normalized':
-#             atype = 'Normalized'
-#         else:
-#             # this should never happen but adding for completeness
-#             return False, None, "Not a valid format: %s" % biom_in[0]
-#         aname = 'Functional Predictions - %s, %s' % (level, atype)
-#         ainfo.append(ArtifactInfo(aname, 'BIOM', [(output, 'biom')]))
@@ -18,18 +18,25 @@ from tempfile import TemporaryDirectory
 from qp_shogun import plugin
 from tempfile import mkdtemp
 from json import dumps
-from biom import Table
+from biom import Table, load_table
+import h5py
 import numpy as np
 from io import StringIO
+import numpy.testing as npt
+from qiita_client.util import system_call
 from qp_shogun.shogun.utils import (
     get_dbs, get_dbs_list, generate_shogun_dflt_params,
     import_shogun_biom, shogun_db_functional_parser, shogun_parse_module_table,
-    shogun_parse_enzyme_table, shogun_parse_pathway_table)
+    shogun_parse_enzyme_table, shogun_parse_pathway_table,
+    get_biom_write_settings, write_biom_table, shogun_db_taxonomy_parser,
+    parse_annotation_table, write_biom_table_streaming, use_biom_streaming)
+from qp_shogun.shogun.redistribute import (
+    load_redistribution_db, redistribute_profile, collapse_ranks)
 from qp_shogun.shogun.shogun import (
     generate_shogun_align_commands, _format_params,
     generate_shogun_assign_taxonomy_commands, generate_fna_file,
     generate_shogun_functional_commands, generate_shogun_redist_commands,
-    shogun, SHOGUN_PARAMS)
+    shogun, SHOGUN_PARAMS, FUNCTIONAL_TABLES)
 
 
 class ShogunTests(PluginTestCase):
@@ -47,6 +54,8 @@ class ShogunTests(PluginTestCase):
             'Number of threads': 5,
             'Capitalist': False,
             'Percent identity': 0.95,
+            'Taxonomic ranks': ['phylum', 'genus', 'species'],
+            'Functional profiling': False,
         }
         self._clean_up_files = []
         self._clean_up_files.append(out_dir)
@@ -176,7 +185,9 @@ class ShogunTests(PluginTestCase):
                 'Aligner tool': 'bowtie2',
                 'Capitalist': False,
                 'Number of threads': 15,
-                'Percent identity': 0.95},
+                'Percent identity': 0.95,
+                'Taxonomic ranks': ['phylum', 'genus', 'species'],
+                'Functional profiling': False},
             # 'rep82_utree': {
             #     'Database': join(self.db_path, 'rep82'),
             #     'Aligner tool': 'utree',
@@ -194,7 +205,9 @@ class ShogunTests(PluginTestCase):
                 'Aligner tool': 'bowtie2',
                 'Capitalist': False,
                 'Number of threads': 15,
-                'Percent identity': 0.95},
+                'Percent identity': 0.95,
+                'Taxonomic ranks': ['phylum', 'genus', 'species'],
+                'Functional profiling': False},
             # 'wol_utree': {
             #     'Database': join(self.db_path, 'wol'),
             #     'Aligner tool': 'utree',
@@ -244,6 +257,134 @@ class ShogunTests(PluginTestCase):
 
         self.assertEqual(obs, exp)
 
+    def test_shogun_db_taxonomy_parser(self):
+        db_path = self._helper_redistribution_db()
+        exp = {'taxonomy': join(db_path, 'ref.tax'),
+               'shear': join(db_path, 'sheared_bayes.txt')}
+        obs = shogun_db_taxonomy_parser(db_path)
+
+        self.assertEqual(obs, exp)
+
+    def _helper_redistribution_db(self):
+        db_path = mkdtemp()
+        self._clean_up_files.append(db_path)
+        with open(join(db_path, 'metadata.yaml'), 'w') as f:
+            f.write('general:\n  taxonomy: ref.tax\n  fasta: ref.fna\n'
+                    '  shear: sheared_bayes.txt\nfunction: function/ko\n')
+        lineages = ['k__B;p__F;c__C;o__O;f__F;g__G1;s__S1;t__T1',
+                    'k__B;p__F;c__C;o__O;f__F;g__G1;s__S2;t__T2',
+                    'k__B;p__F;c__C;o__O;f__F;g__G2;s__S3;t__T3']
+        with open(join(db_path, 'ref.tax'), 'w') as f:
+            for i, lineage in enumerate(lineages):
+                f.write('G%d\t%s\n' % (i, lineage))
+        counts = ['0\t0\t0\t0\t10\t30\t60\t0\t100',
+                  '0\t0\t0\t0\t30\t10\t60\t0\t100',
+                  '0\t0\t0\t0\t60\t10\t30\t0\t100']
+        with open(join(db_path, 'sheared_bayes.txt'), 'w') as f:
+            f.write('Taxonomy\tk\tp\tc\to\tf\tg\ts\tt\ttotal\n')
+            for lineage, c in zip(lineages, counts):
+                f.write('%s\t%s\n' % (lineage, c))
+
+        return db_path
+
+    def test_redistribute_profile(self):
+        db = load_redistribution_db(self._helper_redistribution_db())
+        profile = ('#OTU ID\t1450\t2563\n'
+                   'k__B;p__F;c__C;o__O;f__F\t100\t0\n'
+                   'k__B;p__F;c__C;o__O;f__F;g__G1\t40\t4\n'
+                   'k__B;p__F;c__C;o__O;f__F;g__G1;s__S2\t5\t5\n'
+                   'k__X\t3\t0\n')
+        obs = redistribute_profile(
+            StringIO(profile), db, ['phylum', 'genus', 'species'])
+
+        exp_data = {
+            'phylum': {'k__B;p__F': [145, 9], 'k__X': [3, 0]},
+            'genus': {'k__B;p__F;c__C;o__O;f__F;g__G1': [85, 9],
+                      'k__B;p__F;c__C;o__O;f__F;g__G2': [60, 0],
+                      'k__X': [3, 0]},
+            'species': {'k__B;p__F;c__C;o__O;f__F;g__G1;s__S1': [40, 3],
+                        'k__B;p__F;c__C;o__O;f__F;g__G1;s__S2': [45, 6],
+                        'k__B;p__F;c__C;o__O;f__F;g__G2;s__S3': [60, 0],
+                        'k__X': [3, 0]}}
+        for level, data in exp_data.items():
+            ids = sorted(data)
+            exp = Table(np.array([data[i] for i in ids]), ids,
+                        ['1450', '2563'])
+            exp.add_metadata({i: {'taxonomy': i.split(';')} for i in ids},
+                             axis='observation')
+            self.assertEqual(obs[level], exp)
+
+        # without the shear file all references weight the same
+        db_path = self._helper_redistribution_db()
+        remove(join(db_path, 'sheared_bayes.txt'))
+        db = load_redistribution_db(db_path)
+        obs = redistribute_profile(StringIO(profile), db, ['genus'])
+        npt.assert_allclose(
+            obs['genus'].data('k__B;p__F;c__C;o__O;f__F;g__G2',
+                              axis='observation'),
+            [100 / 3, 0])
+
+    def test_collapse_ranks(self):
+        db = load_redistribution_db(self._helper_redistribution_db())
+        profile = ('#OTU ID\t1450\t2563\n'
+                   'k__B;p__F;c__C;o__O;f__F\t100\t0\n'
+                   'k__B;p__F;c__C;o__O;f__F;g__G1\t40\t4\n'
+                   'k__B;p__F;c__C;o__O;f__F;g__G1;s__S2\t5\t5\n'
+                   'k__X\t3\t0\n')
+        ranks = ['phylum', 'class', 'order', 'family', 'genus']
+        exp = redistribute_profile(StringIO(profile), db, ranks + ['species'])
+        obs = collapse_ranks(exp['species'], ranks)
+
+        self.assertCountEqual(obs, ranks)
+        for rank in ranks:
+            self.assertEqual(obs[rank], exp[rank])
+
+        exp_family = Table(
+            np.array([[145, 9], [3, 0]]),
+            ['k__B;p__F;c__C;o__O;f__F', 'k__X'], ['1450', '2563'])
+        exp_family.add_metadata(
+            {'k__B;p__F;c__C;o__O;f__F': {
+                'taxonomy': ['k__B', 'p__F', 'c__C', 'o__O', 'f__F']},
+             'k__X': {'taxonomy': ['k__X']}}, axis='observation')
+        self.assertEqual(obs['family'], exp_family)
+
+    def test_redistribute_profile_matches_shogun(self):
+        # validates the in-process redistribution against
+        # `shogun redistribute` using the test database
+        db_path = self.params['Database']
+        tax = shogun_db_taxonomy_parser(db_path)['taxonomy']
+        with open(tax) as f:
+            lineages = [line.rstrip('\n').split('\t')[1] for line in f]
+        # profile with lineages of all depths
+        profile = {}
+        for i, lineage in enumerate(lineages[:300]):
+            ranks = lineage.split(';')
+            profile[';'.join(ranks[:1 + i % len(ranks)])] = (
+                1 + i % 7, 2 * i % 5)
+        profile_fp = join(self.out_dir, 'profile.tsv')
+        with open(profile_fp, 'w') as f:
+            f.write('#OTU ID\t1450\t2563\n')
+            for lineage, (v1, v2) in profile.items():
+                f.write('%s\t%d\t%d\n' % (lineage, v1, v2))
+
+        levels = ['phylum', 'genus', 'species']
+        obs = redistribute_profile(
+            profile_fp, load_redistribution_db(db_path), levels)
+        params = _format_params(self.params, SHOGUN_PARAMS)
+        for level in levels:
+            cmds, output = generate_shogun_redist_commands(
+                profile_fp, self.out_dir, params, level)
+            std_out, std_err, return_value = system_call(cmds[0])
+            self.assertEqual(return_value, 0, std_err)
+            exp = import_shogun_biom(output, names_to_taxonomy=True)
+            exp.remove_empty(axis='observation')
+
+            obs_ids = obs[level].ids(axis='observation')
+            self.assertCountEqual(obs_ids, exp.ids(axis='observation'))
+            exp = exp.sort_order(obs_ids, axis='observation')
+            npt.assert_allclose(obs[level].matrix_data.toarray(),
+                                exp.matrix_data.toarray())
+
     def test_shogun_parse_enzyme_table(self):
         out_table = shogun_parse_enzyme_table(StringIO(self.enzymes))
 
@@ -259,6 +400,19 @@ class ShogunTests(PluginTestCase):
 
         self.assertDictEqual(self.path_md, out_table)
 
+    def test_parse_annotation_table(self):
+        fp = join(self.out_dir, 'module-annotations.txt')
+        with open(fp, 'w') as f:
+            f.write(self.modules)
+
+        obs = parse_annotation_table(fp, 'module')
+        self.assertDictEqual(self.mod_md, obs)
+        # the parsed file is cached
+        self.assertIs(parse_annotation_table(fp, 'module'), obs)
+        # but file-like objects are not
+        obs = parse_annotation_table(StringIO(self.modules), 'module')
+        self.assertDictEqual(self.mod_md, obs)
+
     def test_import_shogun_biom(self):
         shogun_table = ('#OTU ID\t1450\t2563\n'
                         'k__Archaea\t26\t25\n'
@@ -364,6 +518,108 @@ class ShogunTests(PluginTestCase):
 
         self.assertEqual(exp_empty_biom, obs_empty_biom)
 
+    def test_get_biom_write_settings(self):
+        env_vars = ['QC_SHOGUN_BIOM_COMPRESSION',
+                    'QC_SHOGUN_BIOM_COMPRESSION_LEVEL',
+                    'QC_SHOGUN_BIOM_CHUNKS']
+        original = {k: os.environ.pop(k) for k in env_vars
+                    if k in os.environ}
+        self.addCleanup(os.environ.update, original)
+        for k in env_vars:
+            self.addCleanup(os.environ.pop, k, None)
+
+        obs = get_biom_write_settings()
+        exp = {'compression': 'gzip', 'compression_opts': 4,
+               'shuffle': True, 'chunks': None}
+        self.assertEqual(obs, exp)
+
+        os.environ['QC_SHOGUN_BIOM_COMPRESSION'] = 'lzf'
+        os.environ['QC_SHOGUN_BIOM_CHUNKS'] = '1000'
+        obs = get_biom_write_settings()
+        exp = {'compression': 'lzf', 'compression_opts': None,
+               'shuffle': True, 'chunks': 1000}
+        self.assertEqual(obs, exp)
+
+        os.environ['QC_SHOGUN_BIOM_COMPRESSION'] = 'none'
+        obs = get_biom_write_settings()
+        exp = {'compression': None, 'compression_opts': None,
+               'shuffle': False, 'chunks': 1000}
+        self.assertEqual(obs, exp)
+
+        os.environ['QC_SHOGUN_BIOM_COMPRESSION'] = 'bzip2'
+        with self.assertRaises(ValueError):
+            get_biom_write_settings()
+        os.environ['QC_SHOGUN_BIOM_COMPRESSION'] = 'gzip'
+        os.environ['QC_SHOGUN_BIOM_COMPRESSION_LEVEL'] = '10'
+        with self.assertRaises(ValueError):
+            get_biom_write_settings()
+        os.environ['QC_SHOGUN_BIOM_COMPRESSION_LEVEL'] = '9'
+        os.environ['QC_SHOGUN_BIOM_CHUNKS'] = '0'
+        with self.assertRaises(ValueError):
+            get_biom_write_settings()
+
+    def test_write_biom_table(self):
+        ids = ['k__Archaea', 'k__Archaea;p__Crenarchaeota']
+        exp = Table(np.array([[26, 0, 1], [3, 5, 0]]), ids,
+                    ['1450', '2563', '2564'])
+        exp.add_metadata({i: {'taxonomy': i.split(';')} for i in ids},
+                         axis='observation')
+        settings = {'compression': 'gzip', 'compression_opts': 9,
+                    'shuffle': True, 'chunks': 2}
+        out_fp = join(self.out_dir, 'test.biom')
+        write_biom_table(exp, out_fp, settings)
+
+        self.assertEqual(load_table(out_fp), exp)
+        with h5py.File(out_fp, 'r') as f:
+            data = f['observation/matrix/data']
+            self.assertEqual(data.compression, 'gzip')
+            self.assertEqual(data.compression_opts, 9)
+            self.assertTrue(data.shuffle)
+            self.assertEqual(data.chunks, (2, ))
+
+        # empty tables can be written too
+        empty = Table(np.zeros((0, 2)), [], ['1450', '2563'])
+        write_biom_table(empty, out_fp, settings)
+        self.assertEqual(load_table(out_fp), empty)
+
+    def test_write_biom_table_streaming(self):
+        shogun_table = ('#OTU ID\t1450\t2563\t2564\n'
+                        'k__Archaea\t26\t0\t1\n'
+                        'k__Archaea;p__Crenarchaeota\t3\t5\t0\n'
+                        'k__Archaea;p__Crenarchaeota;c__Thermoprotei\t0\t0'
+                        '\t0\n'
+                        'k__Bacteria;p__Firmicutes\t0\t2\t7\n')
+        in_fp = join(self.out_dir, 'profile.tsv')
+        with open(in_fp, 'w') as f:
+            f.write(shogun_table)
+        settings = {'compression': 'gzip', 'compression_opts': 4,
+                    'shuffle': True, 'chunks': 2}
+        out_fp = join(self.out_dir, 'test.biom')
+
+        for names_to_taxonomy in (True, False):
+            exp = import_shogun_biom(StringIO(shogun_table),
+                                     names_to_taxonomy=names_to_taxonomy)
+            # tiny blocks so the rows and columns are read in several passes
+            for block_size in (1, 3, 1000):
+                write_biom_table_streaming(
+                    in_fp, out_fp, names_to_taxonomy, settings, block_size)
+                self.assertEqual(load_table(out_fp), exp)
+
+        with h5py.File(out_fp, 'r') as f:
+            self.assertEqual(f.attrs['nnz'], 6)
+            self.assertEqual(
+                f['sample/matrix/data'].compression, 'gzip')
+
+    def test_use_biom_streaming(self):
+        self.assertFalse(use_biom_streaming(10))
+        self.assertTrue(use_biom_streaming(5000))
+        os.environ['QC_SHOGUN_BIOM_STREAMING_SAMPLES'] = '3'
+        try:
+            self.assertTrue(use_biom_streaming(3))
+            self.assertFalse(use_biom_streaming(2))
+        finally:
+            del os.environ['QC_SHOGUN_BIOM_STREAMING_SAMPLES']
+
     def test_format_shogun_params(self):
         obs = _format_params(self.params, SHOGUN_PARAMS)
         exp = {
@@ -371,7 +627,9 @@ class ShogunTests(PluginTestCase):
             'aligner': 'bowtie2',
             'threads': 5,
             'percent_id': 0.95,
-            'capitalist': False
+            'capitalist': False,
+            'ranks': ['phylum', 'genus', 'species'],
+            'functional': False
         }
 
         self.assertEqual(obs, exp)
@@ -490,6 +748,7 @@ class ShogunTests(PluginTestCase):
         aid = self.qclient.post('/apitest/artifact/', data=data)['artifact']
 
         self.params['input'] = aid
+        self.params['Functional profiling'] = True
         data = {'user': 'demo@microbio.me',
                 'command': dumps(['qp-shogun', '072020', 'Shogun v1.0.8']),
                 'status': 'running',
@@ -519,7 +778,12 @@ class ShogunTests(PluginTestCase):
                            'biom')]),
             ArtifactInfo('Taxonomic Predictions - species', 'BIOM',
                          [(pout_dir('otu_table.redist.species.biom'),
-                           'biom')])])
+                           'biom')])] + [
+            ArtifactInfo('Functional Predictions - species, %s' % name,
+                         'BIOM',
+                         [(pout_dir('otu_table.func.species.%s.biom' % suffix),
+                           'biom')])
+            for suffix, _, _, _, name in FUNCTIONAL_TABLES])
 
     def test_wol_bt2(self):
         # inserting new prep template
@@ -547,6 +811,8 @@ class ShogunTests(PluginTestCase):
 
         self.params['input'] = aid
         self.params['Database'] = join(self.db_path, 'wol')
+        self.params['Taxonomic ranks'] = [
+            'phylum', 'class', 'order', 'family', 'genus', 'species']
         data = {'user': 'demo@microbio.me',
                 'command': dumps(['qp-shogun', '072020', 'Shogun v1.0.8']),
                 'status': 'running',
@@ -571,6 +837,15 @@ class ShogunTests(PluginTestCase):
             ArtifactInfo('Taxonomic Predictions - phylum', 'BIOM',
                          [(pout_dir('otu_table.redist.phylum.biom'),
                            'biom')]),
+            ArtifactInfo('Taxonomic Predictions - class', 'BIOM',
+                         [(pout_dir('otu_table.redist.class.biom'),
+                           'biom')]),
+            ArtifactInfo('Taxonomic Predictions - order', 'BIOM',
+                         [(pout_dir('otu_table.redist.order.biom'),
+                           'biom')]),
+            ArtifactInfo('Taxonomic Predictions - family', 'BIOM',
+                         [(pout_dir('otu_table.redist.family.biom'),
+                           'biom')]),
             ArtifactInfo('Taxonomic Predictions - genus', 'BIOM',
                          [(pout_dir('otu_table.redist.genus.biom'),
                            'biom')]),
@@ -12,15 +12,39 @@
 # ------------------------------------------------------------------------------
 
 import os
-from os.path import join, isdir
+from os.path import join, isdir, getmtime
+from functools import lru_cache
+from datetime import datetime
+import numpy as np
 import pandas as pd
 from biom import Table
+from biom.util import biom_open
+from biom.table import H5PY_VLEN_STR
 
 ALIGNERS = [
     # "utree",
     # "burst",
     "bowtie2"]
 
+# Ranks that can be generated from the redistributed profile
+RANKS = ['phylum', 'class', 'order', 'family', 'genus', 'species']
+DFLT_RANKS = ['phylum', 'genus', 'species']
+
+# HDF5 settings used when writing the BIOM tables. These can be changed per
+# plugin installation via the environment (see get_biom_write_settings); the
+# defaults were picked benchmarking write time, file size and read time on
+# synthetic species-like count tables (3-5% non-zero, up to 6000 x 5000), not
+# on real SHOGUN profiles, so they may need revisiting on production tables
+BIOM_COMPRESSION_FILTERS = ('gzip', 'lzf', 'none')
+BIOM_DFLT_COMPRESSION = 'gzip'
+BIOM_DFLT_COMPRESSION_LEVEL = 4
+BIOM_DFLT_CHUNKS = 'auto'
+# Tables with at least this many samples are written by streaming blocks of
+# the input (QC_SHOGUN_BIOM_STREAMING_SAMPLES) and the number of matrix
+# cells/non-zero values held in memory at any time while doing so
+BIOM_DFLT_STREAMING_SAMPLES = 5000
+BIOM_STREAMING_BLOCK = 5000000
+
 
 def get_dbs(db_folder):
     dbs = {}
@@ -57,7 +81,10 @@ def generate_shogun_dflt_params():
                                               'Aligner tool': aligner,
                                               'Percent identity': 0.95,
                                               'Capitalist': False,
-                                              'Number of threads': 15}
+                                              'Number of threads': 15,
+                                              'Taxonomic ranks': list(
+                                                  DFLT_RANKS),
+                                              'Functional profiling': False}
 
     return(dflt_param_set)
 
@@ -109,45 +136,98 @@ def shogun_db_functional_parser(db_path):
     return fp_array
 
 
+def shogun_db_taxonomy_parser(db_path):
+    # Metadata file path
+    md_fp = join(db_path, 'metadata.yaml')
+    metadata = pd.read_csv(md_fp, sep=':', index_col=0)
+    # the general section is indented so we need to strip the keys
+    metadata.index = metadata.index.str.strip()
+    fp_array = {
+        'taxonomy': join(
+            db_path, metadata.loc['taxonomy'].values[0].strip()),
+        'shear': None}
+    if 'shear' in metadata.index:
+        fp_array['shear'] = join(
+            db_path, metadata.loc['shear'].values[0].strip())
+
+    return fp_array
+
+
 def shogun_parse_enzyme_table(f):
     md = pd.read_csv(
         f, sep='\t', header=None, error_bad_lines=False, warn_bad_lines=False)
     md.set_index(0, inplace=True)
-    metadata = {}
-    for i, row in md.iterrows():
-        metadata[i] = {'taxonomy': [x for x in row.values]}
+    # the last annotation of each enzyme wins
+    md = md[~md.index.duplicated(keep='last')]
+    metadata = {i: {'taxonomy': row}
+                for i, row in zip(md.index, md.values.tolist())}
     return(metadata)
 
 
 def shogun_parse_module_table(f):
     md = pd.read_csv(
         f, sep='\t', header=None, error_bad_lines=False, warn_bad_lines=False)
-    metadata = {}
-    for i, row in md.iterrows():
-        module = row[4].split('  ')[0]
-        name = row[4].split('  ')[1]
-        if module not in metadata:
-            metadata[module] = {'taxonomy': [row[1], row[2], row[3], name]}
+    names = md[4].str.split('  ')
+    md['module'] = names.str[0]
+    md['name'] = names.str[1]
+    # the first annotation of each module wins
+    md = md.drop_duplicates('module')
+    metadata = {
+        module: {'taxonomy': row} for module, row in zip(
+            md['module'], md[[1, 2, 3, 'name']].values.tolist())}
     return(metadata)
 
 
 def shogun_parse_pathway_table(f):
     md = pd.read_csv(
         f, sep='\t', header=None, error_bad_lines=False, warn_bad_lines=False)
-    metadata = {}
-    for i, row in md.iterrows():
-        pathway = row[4]
-        if pathway not in metadata:
-            metadata[pathway] = {'taxonomy': [row[1], row[2], row[3]]}
+    # the first annotation of each pathway wins
+    md = md.drop_duplicates(4)
+    metadata = {pathway: {'taxonomy': row} for pathway, row in zip(
+        md[4], md[[1, 2, 3]].values.tolist())}
     return(metadata)
 
 
+ANNOTATION_PARSERS = {'module': shogun_parse_module_table,
+                      'pathway': shogun_parse_pathway_table,
+                      'enzyme': shogun_parse_enzyme_table}
+
+
+@lru_cache(maxsize=None)
+def _parse_annotation_file(annotation_fp, annotation_type, mtime):
+    # mtime is only part of the cache key
+    return ANNOTATION_PARSERS[annotation_type](annotation_fp)
+
+
+def parse_annotation_table(annotation_table, annotation_type):
+    """Parses a functional annotation table
+
+    Parameters
+    ----------
+    annotation_table : str or file-like
+        The annotation table
+    annotation_type : str
+        The annotation type: module, pathway or enzyme
+
+    Returns
+    -------
+    dict
+        The observation metadata keyed by annotation
+
+    Notes
+    -----
+    The annotation files of a database are large and used by several tables
+    so, when a filepath is given, the parsed annotations are cached by
+    filepath and modification time
+    """
+    if isinstance(annotation_table, str):
+        return _parse_annotation_file(
+            annotation_table, annotation_type, getmtime(annotation_table))
+    return ANNOTATION_PARSERS[annotation_type](annotation_table)
+
+
 def import_shogun_biom(f, annotation_table=None,
                        annotation_type=None, names_to_taxonomy=False):
-    import_funcs = {'module': shogun_parse_module_table,
-                    'pathway': shogun_parse_pathway_table,
-                    'enzyme': shogun_parse_enzyme_table}
-
     table = pd.read_csv(f, sep='\t', index_col=0)
 
     bt = Table(table.values,
@@ -160,7 +240,312 @@ def import_shogun_biom(f, annotation_table=None,
         bt.add_metadata(metadata, axis='observation')
 
     if annotation_table is not None:
-        metadata = import_funcs[annotation_type](annotation_table)
+        metadata = parse_annotation_table(annotation_table, annotation_type)
         bt.add_metadata(metadata, axis='observation')
 
     return(bt)
+
+
+def get_biom_write_settings():
+    """Retrieves the HDF5 settings to use when writing BIOM tables
+
+    Returns
+    -------
+    dict
+        The compression filter, compression level, whether to use the byte
+        shuffle filter and the number of elements per chunk (None means that
+        h5py picks the chunk size)
+
+    Raises
+    ------
+    ValueError
+        If any of the environment values is not valid
+
+    Notes
+    -----
+    The settings are read from the QC_SHOGUN_BIOM_COMPRESSION (gzip, lzf or
+    none), QC_SHOGUN_BIOM_COMPRESSION_LEVEL (0-9, only used by gzip) and
+    QC_SHOGUN_BIOM_CHUNKS (auto or a positive number of elements) environment
+    variables so they are set once per plugin installation
+    """
+    compression = os.environ.get(
+        'QC_SHOGUN_BIOM_COMPRESSION', BIOM_DFLT_COMPRESSION).lower()
+    if compression not in BIOM_COMPRESSION_FILTERS:
+        raise ValueError('Not a valid BIOM compression filter: %s. Valid '
+                         'options are: %s' % (
+                             compression, ', '.join(BIOM_COMPRESSION_FILTERS)))
+
+    level = os.environ.get(
+        'QC_SHOGUN_BIOM_COMPRESSION_LEVEL', BIOM_DFLT_COMPRESSION_LEVEL)
+    try:
+        level = int(level)
+    except ValueError:
+        level = -1
+    if not 0 <= level <= 9:
+        raise ValueError('Not a valid BIOM compression level: %s'
+                         % os.environ['QC_SHOGUN_BIOM_COMPRESSION_LEVEL'])
+
+    chunks = os.environ.get('QC_SHOGUN_BIOM_CHUNKS', BIOM_DFLT_CHUNKS)
+    if chunks.lower() == 'auto':
+        chunks = None
+    else:
+        try:
+            chunks = int(chunks)
+        except ValueError:
+            chunks = 0
+        if chunks < 1:
+            raise ValueError('Not a valid BIOM chunk size: %s'
+                             % os.environ['QC_SHOGUN_BIOM_CHUNKS'])
+
+    settings = {'compression': None, 'compression_opts': None,
+                'shuffle': False, 'chunks': chunks}
+    if compression == 'gzip':
+        settings.update({'compression': 'gzip', 'compression_opts': level,
+                         'shuffle': True})
+    elif compression == 'lzf':
+        settings.update({'compression': 'lzf', 'shuffle': True})
+
+    return settings
+
+
+class _H5SettingsGroup(object):
+    """Wraps an h5py group so all new datasets use the given HDF5 settings
+
+    Table.to_hdf5 only allows to enable/disable gzip so this proxy replaces
+    the compression keyword arguments in every create_dataset call it makes
+    """
+    def __init__(self, group, settings):
+        self._group = group
+        self._settings = settings
+
+    def __getattr__(self, name):
+        return getattr(self._group, name)
+
+    def __getitem__(self, name):
+        return self._group[name]
+
+    def create_group(self, name):
+        return _H5SettingsGroup(self._group.create_group(name), self._settings)
+
+    def create_dataset(self, name, shape=None, **kwargs):
+        kwargs.pop('compression', None)
+        if shape is None:
+            shape = getattr(kwargs.get('data'), 'shape', None)
+        # empty datasets can not be chunked/compressed
+        if shape and all(shape):
+            s = self._settings
+            kwargs['compression'] = s['compression']
+            if s['compression_opts'] is not None:
+                kwargs['compression_opts'] = s['compression_opts']
+            if s['shuffle']:
+                kwargs['shuffle'] = True
+            if s['chunks'] is not None:
+                kwargs['chunks'] = (min(s['chunks'], shape[0]),) + tuple(
+                    shape[1:])
+        return self._group.create_dataset(name, shape=shape, **kwargs)
+
+
+def write_biom_table(table, output_fp, settings=None):
+    """Writes a BIOM table in HDF5 format using the plugin settings
+
+    Parameters
+    ----------
+    table : biom.Table
+        The table to write
+    output_fp : str
+        The output filepath
+    settings : dict, optional
+        The HDF5 settings, as returned by get_biom_write_settings. If None,
+        the settings are retrieved from the environment
+    """
+    if settings is None:
+        settings = get_biom_write_settings()
+    with biom_open(output_fp, 'w') as f:
+        table.to_hdf5(_H5SettingsGroup(f, settings), "shogun")
+
+
+def use_biom_streaming(n_samples):
+    """Whether a table with n_samples should be written by streaming it
+
+    Parameters
+    ----------
+    n_samples : int
+        The number of samples in the table
+
+    Returns
+    -------
+    bool
+        True if n_samples is at least QC_SHOGUN_BIOM_STREAMING_SAMPLES
+    """
+    return n_samples >= int(os.environ.get(
+        'QC_SHOGUN_BIOM_STREAMING_SAMPLES', BIOM_DFLT_STREAMING_SAMPLES))
+
+
+def _h5_extendable(grp, name, dtype, settings, width=None):
+    """Creates an empty dataset that can be extended along the first axis"""
+    chunk = settings['chunks'] or 2 ** 16
+    kwargs = {}
+    if settings['compression'] is not None:
+        kwargs['compression'] = settings['compression']
+        if settings['compression_opts'] is not None:
+            kwargs['compression_opts'] = settings['compression_opts']
+        kwargs['shuffle'] = settings['shuffle']
+    if width is None:
+        shape, maxshape, chunks = (0, ), (None, ), (chunk, )
+    else:
+        shape, maxshape = (0, width), (None, None)
+        chunks = (max(1, chunk // width), width)
+    return grp.create_dataset(name, shape=shape, maxshape=maxshape,
+                              dtype=dtype, chunks=chunks, **kwargs)
+
+
+def _h5_append(dataset, values):
+    """Appends values to an extendable dataset"""
+    start = dataset.shape[0]
+    dataset.resize(start + len(values), axis=0)
+    dataset[start:] = values
+
+
+def write_biom_table_streaming(in_fp, output_fp, names_to_taxonomy=False,
+                               settings=None, block_size=None):
+    """Converts a tab separated table to BIOM without loading it in memory
+
+    Parameters
+    ----------
+    in_fp : str
+        The tab separated table, observations as rows and samples as columns
+    output_fp : str
+        The output filepath
+    names_to_taxonomy : bool, optional
+        Whether to add the observation ids split by ';' as the taxonomy
+        metadata, as import_shogun_biom does
+    settings : dict, optional
+        The HDF5 settings, as returned by get_biom_write_settings. If None,
+        the settings are retrieved from the environment
+    block_size : int, optional
+        The maximum number of matrix cells (input) or non-zero values
+        (output) to keep in memory. Defaults to BIOM_STREAMING_BLOCK
+
+    Notes
+    -----
+    The observation oriented (CSR) matrix, the observation ids and their
+    taxonomy are written while reading blocks of rows of the input. The
+    sample oriented (CSC) matrix is then written by blocks of columns read
+    back from the CSR matrix, so memory only depends on block_size and on
+    the number of samples. The result is the same table that
+    write_biom_table generates from import_shogun_biom.
+    """
+    if settings is None:
+        settings = get_biom_write_settings()
+    if block_size is None:
+        block_size = BIOM_STREAMING_BLOCK
+
+    sample_ids = list(map(str, pd.read_csv(
+        in_fp, sep='\t', index_col=0, nrows=0).columns))
+    n_samples = len(sample_ids)
+    rows_per_block = max(1, block_size // max(1, n_samples))
+
+    with biom_open(output_fp, 'w') as f:
+        obs_grp = f.create_group('observation')
+        obs_grp.create_group('metadata')
+        obs_grp.create_group('group-metadata')
+        obs_ids = _h5_extendable(obs_grp, 'ids', H5PY_VLEN_STR, settings)
+        obs_data = _h5_extendable(
+            obs_grp, 'matrix/data', np.float64, settings)
+        obs_indices = _h5_extendable(
+            obs_grp, 'matrix/indices', np.int32, settings)
+        obs_indptr = _h5_extendable(
+            obs_grp, 'matrix/indptr', np.int32, settings)
+        _h5_append(obs_indptr, [0])
+        taxonomy = None
+        if names_to_taxonomy:
+            taxonomy = _h5_extendable(
+                obs_grp, 'metadata/taxonomy', H5PY_VLEN_STR, settings,
+                width=1)
+
+        # observation oriented matrix, by blocks of rows
+        nnz = 0
+        n_obs = 0
+        col_counts = np.zeros(n_samples, dtype=np.int64)
+        for block in pd.read_csv(in_fp, sep='\t', index_col=0,
+                                 chunksize=rows_per_block):
+            ids = list(map(str, block.index))
+            values = block.values.astype(np.float64)
+            rows, cols = np.nonzero(values)
+            _h5_append(obs_data, values[rows, cols])
+            _h5_append(obs_indices, cols.astype(np.int32))
+            _h5_append(obs_indptr, nnz + np.cumsum(
+                np.bincount(rows, minlength=len(ids))))
+            col_counts += np.bincount(cols, minlength=n_samples)
+            nnz += len(rows)
+            n_obs += len(ids)
+            _h5_append(obs_ids, [i.encode('utf8') for i in ids])
+
+            if taxonomy is not None:
+                lineages = [i.split(';') for i in ids]
+                width = max(taxonomy.shape[1], max(map(len, lineages)))
+                if width > taxonomy.shape[1]:
+                    taxonomy.resize(width, axis=1)
+                md = np.full((len(ids), width), b'', dtype=object)
+                for i, lineage in enumerate(lineages):
+                    md[i, :len(lineage)] = [x.encode('utf8') for x in lineage]
+                _h5_append(taxonomy, md)
+
+        # sample oriented matrix, by blocks of columns
+        smp_grp = f.create_group('sample')
+        smp_grp.create_group('metadata')
+        smp_grp.create_group('group-metadata')
+        if sample_ids:
+            smp_grp.create_dataset(
+                'ids', shape=(n_samples, ), dtype=H5PY_VLEN_STR,
+                data=[i.encode('utf8') for i in sample_ids])
+        else:
+            smp_grp.create_dataset('ids', shape=(0, ), data=[])
+        smp_data = _h5_extendable(
+            smp_grp, 'matrix/data', np.float64, settings)
+        smp_indices = _h5_extendable(
+            smp_grp, 'matrix/indices', np.int32, settings)
+        smp_indptr = np.zeros(n_samples + 1, dtype=np.int64)
+        smp_indptr[1:] = np.cumsum(col_counts)
+        smp_grp.create_dataset('matrix/indptr', dtype=np.int32,
+                               data=smp_indptr.astype(np.int32))
+
+        col_start = 0
+        indptr = obs_indptr[:]
+        while col_start < n_samples:
+            # as many columns as fit in a block, but at least one
+            col_end = max(col_start + 1, int(np.searchsorted(
+                smp_indptr, smp_indptr[col_start] + block_size,
+                side='right')) - 1)
+            col_end = min(col_end, n_samples)
+            rows, cols, vals = [], [], []
+            for row_start in range(0, n_obs, rows_per_block):
+                row_end = min(row_start + rows_per_block, n_obs)
+                start, end = indptr[row_start], indptr[row_end]
+                indices = obs_indices[start:end]
+                keep = (indices >= col_start) & (indices < col_end)
+                if keep.any():
+                    counts = np.diff(indptr[row_start:row_end + 1])
+                    block_rows = np.repeat(
+                        np.arange(row_start, row_end), counts)
+                    rows.append(block_rows[keep])
+                    cols.append(indices[keep])
+                    vals.append(obs_data[start:end][keep])
+            if rows:
+                rows = np.concatenate(rows)
+                cols = np.concatenate(cols)
+                vals = np.concatenate(vals)
+                # rows are already sorted within each column
+                order = np.argsort(cols, kind='stable')
+                _h5_append(smp_data, vals[order])
+                _h5_append(smp_indices, rows[order].astype(np.int32))
+            col_start = col_end
+
+        f.attrs['id'] = "No Table ID"
+        f.attrs['type'] = ""
+        f.attrs['format-url'] = "http://biom-format.org"
+        f.attrs['format-version'] = (2, 1)
+        f.attrs['generated-by'] = "shogun"
+        f.attrs['creation-date'] = datetime.now().isoformat()
+        f.attrs['shape'] = (n_obs, n_samples)
+        f.attrs['nnz'] = nnz
@@ -0,0 +1,80 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+# This file contains the compression of the SortMeRNA outputs, which counts
+# their reads and bases while it streams them to pigz
+# -----------------------------------------------------------------------------
+
+from io import open as io_open
+
+import click
+
+from qp_shogun.filter.sam_pairs import _gzip_writer, READ_BUFFER
+
+# the counts written to stderr, see sortmerna._sortmerna_counts
+COUNTS_MSG = '%d reads (%d bp)'
+
+
+def count_fastq(fastq, out):
+    """Copies a FASTQ counting its reads and bases
+
+    Parameters
+    ----------
+    fastq : file-like
+        The binary FASTQ
+    out : file-like
+        The binary output
+
+    Returns
+    -------
+    int, int
+        The number of reads and of bases
+    """
+    reads = bases = 0
+    # the line of the FASTQ the lines read start at, modulo 4
+    line = 0
+    while True:
+        lines = fastq.readlines(READ_BUFFER)
+        if not lines:
+            break
+        out.write(b''.join(lines))
+        seqs = lines[(1 - line) % 4::4]
+        reads += len(seqs)
+        bases += sum(len(seq.rstrip(b'\r\n')) for seq in seqs)
+        line = (line + len(lines)) % 4
+    return reads, bases
+
+
+@click.command()
+@click.option('--threads', '-p', type=int, default=1, show_default=True,
+              help='The number of threads of the compressor')
+@click.option('--level', '-l', type=click.IntRange(1, 9), default=None,
+              help='The gzip level, by default the one of pigz')
+@click.option('--label', '-d', default=None, help='The label of the counts')
+@click.argument('fastq_fp', type=click.Path(exists=True, dir_okay=False))
+@click.argument('gz_fp', type=click.Path(dir_okay=False))
+def main(threads, level, label, fastq_fp, gz_fp):
+    """Compresses FASTQ_FP to GZ_FP, counting its reads and bases"""
+    writer = _gzip_writer(gz_fp, threads, level)
+    try:
+        with io_open(fastq_fp, 'rb', buffering=READ_BUFFER) as fastq:
+            counts = count_fastq(fastq, writer.stdin)
+    finally:
+        writer.stdin.close()
+    if writer.wait() != 0:
+        raise click.ClickException('Error compressing %s' % gz_fp)
+
+    msg = COUNTS_MSG % counts
+    if label is not None:
+        msg = '%s: %s' % (label, msg)
+    click.echo(msg, err=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,11 +7,17 @@
 # -----------------------------------------------------------------------------
 
 
-from os.path import join, basename
-from os import environ
+from os.path import join, basename, exists, getsize
+from os import environ, remove
+from sys import executable
+import re
+from shutil import rmtree
+from itertools import zip_longest
 from qp_shogun.utils import (
-    _format_params, make_read_pairs_per_sample,
-    _run_commands, _per_sample_ainfo)
+    _format_params, make_read_pairs_per_sample, _run_commands,
+    _per_sample_ainfo, plan_concurrency, _plan_commands, _estimate_seqs,
+    _archive_logs, _scratch_dir, _log_lines, _write_read_counts,
+    _counted_seqs, FASTQ_GZ_RATIO)
 
 DIR = environ["QC_SORTMERNA_DB_DP"]
 
@@ -40,6 +46,37 @@ SORTMERNA_PARAMS = {
     'num_alignments': 'Number of alignments',
     'a': 'Number of threads',
     'm': 'Memory'}
+# the counts of each output in the output of qp_shogun.sortmerna.counts
+SORTMERNA_COUNTS_RE = re.compile(
+    r'^(ribosomal|nonribosomal): (\d+) reads \((\d+) bp\)$')
+
+
+def _sortmerna_counts(lines):
+    """The reads and bases in and out of a file from its output
+
+    Parameters
+    ----------
+    lines : list of str
+        The output of the command, see _log_lines
+
+    Returns
+    -------
+    tuple of int or None
+        The reads in, reads out, bases in and bases out, None without the
+        counts of both outputs. Every read is in one of the outputs, so the
+        reads in are the sum of both and the reads out the non-ribosomal
+    """
+    counts = {}
+    for line in lines:
+        match = SORTMERNA_COUNTS_RE.match(line)
+        if match is not None:
+            counts[match.group(1)] = (int(match.group(2)),
+                                      int(match.group(3)))
+    if len(counts) < 2:
+        return None
+    reads, bases = counts['nonribosomal']
+    return (reads + counts['ribosomal'][0], reads,
+            bases + counts['ribosomal'][1], bases)
 
 
 def generate_sortmerna_commands(forward_seqs, reverse_seqs, map_file,
@@ -83,17 +120,23 @@ def generate_sortmerna_commands(forward_seqs, reverse_seqs, map_file,
     # Sortmerna 2.1 does not support direct processing of
     # compressed files currently
     # note SMR auto-detects file type and adds .fastq extension
-    # to the generated output files
+    # to the generated output files. The uncompressed files are removed
+    # as soon as they are compressed so they don't take space in the
+    # scratch directory while the other files are processed. Their reads
+    # and bases are counted while they are compressed
 
     template = ("unpigz -p {thrds} -c {ip} > {ip_unpigz} && "
                 "sortmerna --ref {ref_db} --reads {ip_unpigz} "
                 "--aligned {smr_r_op} --other {smr_nr_op} "
                 "--fastx {params} && "
-                "pigz -p {thrds} -c {smr_r_op}.fastq > {smr_r_op_gz} && "
-                "pigz -p {thrds} -c {smr_nr_op}.fastq > {smr_nr_op_gz};"
+                "{python} -m qp_shogun.sortmerna.counts -p {thrds} "
+                "-d ribosomal {smr_r_op}.fastq {smr_r_op_gz} && "
+                "{python} -m qp_shogun.sortmerna.counts -p {thrds} "
+                "-d nonribosomal {smr_nr_op}.fastq {smr_nr_op_gz} && "
+                "rm -f {ip_unpigz} {smr_r_op}.fastq {smr_nr_op}.fastq;"
                 )
 
-    arguments = {'thrds': threads,
+    arguments = {'thrds': threads, 'python': executable,
                  'ref_db': RNA_REF_DB, 'params': param_string}
 
     for run_prefix, sample, f_fp, r_fp in samples:
@@ -154,21 +197,73 @@ def sortmerna(qclient, job_id, parameters, out_dir):
     qiime_map = prep_info['qiime-map']
 
     # Step 2 generating command for Sortmerna
-    qclient.update_job_step(job_id, "Step 2 of 4: Generating"
-                                    " SortMeRNA commands")
     rs = fps['raw_reverse_seqs'] if 'raw_reverse_seqs' in fps else []
-    commands, samples = generate_sortmerna_commands(
-                                                fps['raw_forward_seqs'],
-                                                rs, qiime_map, out_dir,
-                                                parameters)
+    # there is one independent command per file so they run concurrently,
+    # each with a share of the threads
+    file_seqs = [_estimate_seqs(fp)
+                 for pair in zip_longest(sorted(fps['raw_forward_seqs']),
+                                         sorted(rs))
+                 for fp in pair if fp is not None]
+    plan = plan_concurrency('sortmerna', parameters['Number of threads'],
+                            file_seqs, parameters['Memory'])
+    parameters['Number of threads'] = plan['threads']
+    qclient.update_job_step(
+        job_id, "Step 2 of 4: Generating SortMeRNA commands (%s)"
+        % plan['estimate'])
+    # the intermediate files are in a scratch directory and only the
+    # compressed outputs are moved to out_dir; each file needs space for its
+    # uncompressed reads and sortmerna's outputs
+    file_sizes = [getsize(fp)
+                  for pair in zip_longest(sorted(fps['raw_forward_seqs']),
+                                          sorted(rs))
+                  for fp in pair if fp is not None]
+    scratch = _scratch_dir(out_dir, sum(sorted(
+        file_sizes, reverse=True)[:plan['concurrency']]) * (
+            2 * FASTQ_GZ_RATIO + 1))
+    commands, samples = _plan_commands(
+        plan, lambda params: generate_sortmerna_commands(
+            fps['raw_forward_seqs'], rs, qiime_map, scratch, params),
+        parameters, 'Number of threads')
 
     # Step 3 executing Sortmerna
     len_cmd = len(commands)
-    msg = "Step 3 of 4: Executing ribosomal filtering (%d/{0})".format(len_cmd)
-    success, msg = _run_commands(qclient, job_id,
-                                 commands, msg, 'QC_Sortmerna')
+    msg = "Step 3 of 4: Executing ribosomal filtering (%d/{0}, {1})".format(
+        len_cmd, plan['description'])
+    # one log per file, in the same order as the commands
+    log_names = []
+    outputs = []
+    for rp, _, f_fp, r_fp in samples:
+        for index, fp in enumerate([f_fp, r_fp]):
+            if fp is None:
+                continue
+            log_names.append('%s.R%d' % (rp, index + 1))
+            outputs.append([
+                join(out_dir, '%s.%s.R%d.fastq.gz' % (rp, kind, index + 1))
+                for kind in ('ribosomal', 'nonribosomal')])
+    log_dir = join(out_dir, 'sortmerna_logs')
+    try:
+        success, run_msg = _run_commands(
+            qclient, job_id, commands, msg, 'QC_Sortmerna',
+            plan['concurrency'], log_dir,
+            [log_names[i] for i in plan['order']],
+            [file_seqs[i] for i in plan['order']],
+            [outputs[i] for i in plan['order']],
+            join(out_dir, 'sortmerna_ledger.json'),
+            [[(join(scratch, basename(fp)), fp) for fp in outputs[i]]
+             for i in plan['order']],
+            lambda lines: _counted_seqs(_sortmerna_counts(lines), False))
+    finally:
+        rmtree(scratch, ignore_errors=True)
     if not success:
-        return False, None, msg
+        return False, None, run_msg
+    if run_msg and rs:
+        # a sample is only kept if both of its files were processed
+        for i in range(0, len(outputs), 2):
+            pair = outputs[i] + outputs[i + 1]
+            if not all(exists(fp) for fp in pair):
+                for fp in pair:
+                    if exists(fp):
+                        remove(fp)
 
     ainfo = []
 
@@ -181,8 +276,22 @@ def sortmerna(qclient, job_id, parameters, out_dir):
     suffixes = ['%s.nonribosomal.R1.fastq.gz', '%s.nonribosomal.R2.fastq.gz']
     prg_name = 'Sortmerna'
     file_type_name = 'Non-ribosomal reads'
+    # the counts of a sample are the sum of those of its files
+    counts = {}
+    for rp, _, f_fp, r_fp in samples:
+        file_counts = [_sortmerna_counts(_log_lines(
+            join(log_dir, '%s.R%d.log' % (rp, index + 1))))
+            for index, fp in enumerate([f_fp, r_fp]) if fp is not None]
+        if None not in file_counts:
+            counts[rp] = tuple(map(sum, zip(*file_counts)))
+    counts_fp = _write_read_counts(
+        join(out_dir, 'sortmerna_read_counts.tsv'),
+        [s for s in samples if exists(join(out_dir, suffixes[0] % s[0]))],
+        counts)
+    log_fp = _archive_logs(log_dir, join(out_dir, 'sortmerna_logs.tar.gz'))
     ainfo.extend(_per_sample_ainfo(
-        out_dir, samples, suffixes, prg_name, file_type_name, bool(rs)))
+        out_dir, samples, suffixes, prg_name, file_type_name, bool(rs),
+        log_fp, counts_fp))
 
     # Step 5 generating artifacts for Ribosomal reads
     msg = ("Step 5 of 5: Generating artifacts "
@@ -194,4 +303,4 @@ def sortmerna(qclient, job_id, parameters, out_dir):
     ainfo.extend(_per_sample_ainfo(
         out_dir, samples, suffixes, prg_name, file_type_name, bool(rs)))
 
-    return True, ainfo, ""
+    return True, ainfo, run_msg
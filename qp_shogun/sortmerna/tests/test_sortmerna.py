@@ -13,13 +13,16 @@ from shutil import rmtree, copyfile
 from tempfile import mkstemp, mkdtemp
 from json import dumps
 from functools import partial
+from io import BytesIO
+from sys import executable
 import os
 
 from qiita_client.testing import PluginTestCase
 
 from qp_shogun import plugin
 from qp_shogun.sortmerna.sortmerna import (
-    generate_sortmerna_commands, sortmerna)
+    generate_sortmerna_commands, sortmerna, _sortmerna_counts)
+from qp_shogun.sortmerna.counts import count_fastq
 from qp_shogun.utils import (
     _format_params, _per_sample_ainfo)
 
@@ -99,11 +102,17 @@ class QC_SortmernaTests(PluginTestCase):
              '--other output/s1.nonribosomal.R1 '
              '--fastx -a 5 --blast 1 -m 3988 --num_alignments 1 && '
 
-             'pigz -p 5 -c output/s1.ribosomal.R1.fastq > '
+             '%s -m qp_shogun.sortmerna.counts -p 5 -d ribosomal '
+             'output/s1.ribosomal.R1.fastq '
              'output/s1.ribosomal.R1.fastq.gz && '
 
-             'pigz -p 5 -c output/s1.nonribosomal.R1.fastq > '
-             'output/s1.nonribosomal.R1.fastq.gz;') % rna_ref_db,
+             '%s -m qp_shogun.sortmerna.counts -p 5 -d nonribosomal '
+             'output/s1.nonribosomal.R1.fastq '
+             'output/s1.nonribosomal.R1.fastq.gz && '
+
+             'rm -f output/s1.fastq output/s1.ribosomal.R1.fastq '
+             'output/s1.nonribosomal.R1.fastq;') % (
+                 rna_ref_db, executable, executable),
             ('unpigz -p 5 -c fastq/s1.R2.fastq.gz > output/s1.R2.fastq && '
 
              'sortmerna --ref %s --reads output/s1.R2.fastq '
@@ -111,11 +120,17 @@ class QC_SortmernaTests(PluginTestCase):
              '--other output/s1.nonribosomal.R2 '
              '--fastx -a 5 --blast 1 -m 3988 --num_alignments 1 && '
 
-             'pigz -p 5 -c output/s1.ribosomal.R2.fastq > '
+             '%s -m qp_shogun.sortmerna.counts -p 5 -d ribosomal '
+             'output/s1.ribosomal.R2.fastq '
              'output/s1.ribosomal.R2.fastq.gz && '
 
-             'pigz -p 5 -c output/s1.nonribosomal.R2.fastq > '
-             'output/s1.nonribosomal.R2.fastq.gz;') % rna_ref_db
+             '%s -m qp_shogun.sortmerna.counts -p 5 -d nonribosomal '
+             'output/s1.nonribosomal.R2.fastq '
+             'output/s1.nonribosomal.R2.fastq.gz && '
+
+             'rm -f output/s1.R2.fastq output/s1.ribosomal.R2.fastq '
+             'output/s1.nonribosomal.R2.fastq;') % (
+                 rna_ref_db, executable, executable)
         ]
 
         exp_sample = [
@@ -128,6 +143,23 @@ class QC_SortmernaTests(PluginTestCase):
         self.assertEqual(obs_cmd, exp_cmd)
         self.assertEqual(obs_sample, exp_sample)
 
+    def test_count_fastq(self):
+        # the counts don't depend on how the lines are read
+        fastq = b''.join(b'@r%d\n%s\n+\n%s\n' % (i, b'A' * i, b'I' * i)
+                         for i in range(1, 5000))
+        out = BytesIO()
+        self.assertEqual(count_fastq(BytesIO(fastq), out),
+                         (4999, 4999 * 5000 // 2))
+        self.assertEqual(out.getvalue(), fastq)
+        self.assertEqual(count_fastq(BytesIO(b''), BytesIO()), (0, 0))
+
+    def test_sortmerna_counts(self):
+        lines = ['Warning: skipping read',
+                 'ribosomal: 10 reads (1500 bp)',
+                 'nonribosomal: 90 reads (13000 bp)']
+        self.assertEqual(_sortmerna_counts(lines), (100, 90, 14500, 13000))
+        self.assertIsNone(_sortmerna_counts(lines[:2]))
+
     def test_sortmerna(self):
         # generating filepaths
         in_dir = mkdtemp()
@@ -184,7 +216,9 @@ class QC_SortmernaTests(PluginTestCase):
 
         exp_fps = [
             [(od('kd_test_1.nonribosomal.R1.fastq.gz'), 'raw_forward_seqs'),
-             (od('kd_test_1.nonribosomal.R2.fastq.gz'), 'raw_reverse_seqs')],
+             (od('kd_test_1.nonribosomal.R2.fastq.gz'), 'raw_reverse_seqs'),
+             (od('sortmerna_logs.tar.gz'), 'log'),
+             (od('sortmerna_read_counts.tsv'), 'log')],
             [(od('kd_test_1.ribosomal.R1.fastq.gz'), 'raw_forward_seqs'),
              (od('kd_test_1.ribosomal.R2.fastq.gz'), 'raw_reverse_seqs')]]
 
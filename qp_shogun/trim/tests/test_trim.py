@@ -7,19 +7,31 @@
 # -----------------------------------------------------------------------------
 
 from unittest import main
-from os import close, remove, makedirs
+from os import close, remove, makedirs, environ, utime, stat
 from os.path import exists, isdir, join, dirname
 from shutil import rmtree, copyfile
 from tempfile import mkstemp, mkdtemp
-from json import dumps
+import tarfile
+from time import time, sleep
+from json import dumps, load
 from functools import partial
+from gzip import compress
+from random import seed, choices, randint
 
 from qiita_client.testing import PluginTestCase
 
 from qp_shogun import plugin
-from qp_shogun.trim.trim import (generate_trim_commands, trim)
+from qp_shogun.trim.trim import (
+    generate_trim_commands, trim, _atropos_counts)
 from qp_shogun.utils import (
-    _format_params, make_read_pairs_per_sample, _per_sample_ainfo)
+    _format_params, make_read_pairs_per_sample, _per_sample_ainfo,
+    _run_prefix_index, _match_run_prefixes, _load_map_cache,
+    _map_file_key, _map_cache_fp, _split_threads, _run_commands,
+    plan_concurrency, _plan_commands, _pipe_model, _predict_makespan,
+    _estimate_seqs, _system_call_logged, _archive_logs, _StatusReporter,
+    _scratch_dir, _gzip_level, _log_lines, _write_read_counts,
+    _write_benchmarks, _cgroup_memory, _node_resources, _counted_seqs,
+    BENCHMARK_COLUMNS)
 import qp_shogun.trim as kd
 
 ATROPOS_PARAMS = {
@@ -188,6 +200,664 @@ class QC_TrimTests(PluginTestCase):
         with self.assertRaises(ValueError):
             make_read_pairs_per_sample(fwd_fp, rev_fp, fp)
 
+    def test_make_read_pairs_per_sample_nested_prefixes(self):
+        fd, fp = mkstemp()
+        close(fd)
+        with open(fp, 'w') as f:
+            f.write(MAPPING_FILE.replace('\ts3\t', '\ts11\t'))
+        self._clean_up_files.append(fp)
+
+        # s11 also starts with s1
+        fwd_fp = ['./folder/s11_S013_L001_R1.fastq.gz',
+                  './folder/s2_S011_L001_R1.fastq.gz']
+
+        with self.assertRaisesRegex(ValueError, 'Multiple run prefixes match '
+                                    'this fwd read: s11_S013_L001_R1'):
+            make_read_pairs_per_sample(fwd_fp, [], fp)
+
+    def test_make_read_pairs_per_sample_cache(self):
+        cache_dp = mkdtemp()
+        self._clean_up_files.append(cache_dp)
+        environ['QC_SHOGUN_CACHE_DP'] = cache_dp
+        _load_map_cache.cache_clear()
+        fd, fp = mkstemp()
+        close(fd)
+        with open(fp, 'w') as f:
+            f.write(MAPPING_FILE)
+        self._clean_up_files.append(fp)
+
+        fwd_fp = ['./folder/s3_S013_L001_R1.fastq.gz',
+                  './folder/s1_S009_L001_R1.fastq.gz']
+        exp = [('s1', 'SKB8.640193', './folder/s1_S009_L001_R1.fastq.gz',
+                None),
+               ('s3', 'SKB7.640196', './folder/s3_S013_L001_R1.fastq.gz',
+                None)]
+        try:
+            self.assertEqual(
+                make_read_pairs_per_sample(list(fwd_fp), [], fp), exp)
+            key = _map_file_key(fp)
+            self.assertTrue(exists(_map_cache_fp(key)))
+
+            # the on-disk cache is used by new processes, simulated by
+            # clearing the in-process cache, and the pairing is reused
+            _load_map_cache.cache_clear()
+            obs = _load_map_cache(key)
+            self.assertEqual(obs['run_prefixes'], {
+                's1': 'SKB8.640193', 's2': 'SKD8.640184',
+                's3': 'SKB7.640196'})
+            self.assertEqual(len(obs['pairings']), 1)
+            self.assertEqual(
+                make_read_pairs_per_sample(list(fwd_fp), [], fp), exp)
+
+            # a modified mapping file is parsed again
+            with open(fp, 'w') as f:
+                f.write(MAPPING_FILE.replace('SKB8.640193', 'SKB9.640200'))
+            st = stat(fp)
+            utime(fp, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+            exp[0] = ('s1', 'SKB9.640200', './folder/s1_S009_L001_R1.fastq.gz',
+                      None)
+            self.assertEqual(
+                make_read_pairs_per_sample(list(fwd_fp), [], fp), exp)
+        finally:
+            del environ['QC_SHOGUN_CACHE_DP']
+            _load_map_cache.cache_clear()
+
+    def test_match_run_prefixes(self):
+        index = _run_prefix_index(['s1', 's11', 's2', 'sample_12'])
+        self.assertEqual(index, [(2, {'s1', 's2'}), (3, {'s11'}),
+                                 (9, {'sample_12'})])
+        self.assertEqual(_match_run_prefixes(index, 's11_R1.fastq.gz'),
+                         ['s1', 's11'])
+        self.assertEqual(_match_run_prefixes(index, 's2_R1.fastq.gz'),
+                         ['s2'])
+        self.assertEqual(_match_run_prefixes(index, 's3_R1.fastq.gz'), [])
+        self.assertEqual(_match_run_prefixes(index, 's'), [])
+
+    def test_split_threads(self):
+        self.assertEqual(_split_threads(15, 10, 4), (3, 5))
+        self.assertEqual(_split_threads(16, 10, 4), (4, 4))
+        self.assertEqual(_split_threads(15, 2, 4), (2, 7))
+        self.assertEqual(_split_threads(15, 1, 4), (1, 15))
+        self.assertEqual(_split_threads(3, 10, 4), (1, 3))
+        self.assertEqual(_split_threads(8, 10, 1), (8, 1))
+        self.assertEqual(_split_threads(8, 0, 4), (1, 8))
+        environ['QC_SHOGUN_THREADS_PER_COMMAND'] = '2'
+        try:
+            self.assertEqual(_split_threads(8, 10), (4, 2))
+        finally:
+            del environ['QC_SHOGUN_THREADS_PER_COMMAND']
+
+    def test_predict_makespan(self):
+        self.assertEqual(_predict_makespan([4, 3, 2, 1], 1), 10)
+        self.assertEqual(_predict_makespan([4, 3, 2, 1], 2), 5)
+        self.assertEqual(_predict_makespan([1, 2, 3, 4], 2), 6)
+        self.assertEqual(_predict_makespan([4, 3], 8), 4)
+        self.assertEqual(_predict_makespan([], 2), 0)
+
+    def test_plan_concurrency(self):
+        seqs = [1e6] * 20
+        # bowtie2 keeps ~1.8 cores busy so many samples with a few threads
+        # each are better, and each copy keeps 2 threads for sam_pairs and
+        # the compressors
+        obs = plan_concurrency('bowtie2', 15, seqs, resources=(64, 64000))
+        self.assertEqual((obs['concurrency'], obs['threads']), (3, 3))
+        self.assertEqual(obs['description'], '3 at a time with 3 threads '
+                         'each, predicted 0:24:43')
+        self.assertEqual(obs['order'], list(range(20)))
+        self.assertEqual(obs['command_threads'], [3] * 20)
+        # the threads left over go to the first commands
+        obs = plan_concurrency('bowtie2', 17, seqs, resources=(64, 64000))
+        self.assertEqual(obs['description'], '4 at a time with 2 threads '
+                         'each (1 with 3), predicted 0:17:39')
+        self.assertEqual(obs['command_threads'], [3] + [2] * 19)
+        # but each copy needs the index in memory
+        obs = plan_concurrency('bowtie2', 15, seqs, resources=(64, 6000))
+        self.assertEqual((obs['concurrency'], obs['threads']), (1, 13))
+        # and the node CPUs limit the threads
+        obs = plan_concurrency('bowtie2', 15, seqs, resources=(4, 64000))
+        self.assertEqual((obs['concurrency'], obs['threads']), (1, 2))
+        # no more commands than samples
+        obs = plan_concurrency('atropos', 32, seqs[:2], resources=(64, 64000))
+        self.assertEqual((obs['concurrency'], obs['threads']), (2, 16))
+        # the threads left over are used by the largest commands
+        obs = plan_concurrency('atropos', 30, [1e6] * 6 + [2e6],
+                               resources=(64, 64000))
+        self.assertEqual((obs['concurrency'], obs['threads']), (4, 7))
+        self.assertEqual(obs['command_threads'], [8, 7, 7, 7, 7, 7, 8])
+        self.assertEqual(obs['order'], [6, 0, 1, 2, 3, 4, 5])
+        # sortmerna has no model so the threads are split as _split_threads,
+        # with as many commands as fit in the memory set in its parameters
+        obs = plan_concurrency('sortmerna', 10, seqs, 31000,
+                               resources=(64, 64000))
+        self.assertEqual((obs['concurrency'], obs['threads']), (1, 10))
+        obs = plan_concurrency('sortmerna', 32, seqs, 10000,
+                               resources=(64, 64000))
+        self.assertEqual((obs['concurrency'], obs['threads']), (5, 6))
+        self.assertEqual(obs['description'], '5 at a time with 6 threads each')
+        self.assertIsNone(obs['makespan'])
+        obs = plan_concurrency('sortmerna', 32, seqs, resources=(64, 64000))
+        self.assertEqual((obs['concurrency'], obs['threads']), (8, 4))
+
+        # the largest samples run first
+        seqs = [3e5] * 10 + [3e6] + [3e5] * 10
+        obs = plan_concurrency('bowtie2', 15, seqs, resources=(64, 64000))
+        self.assertEqual((obs['concurrency'], obs['threads']), (3, 3))
+        self.assertEqual(obs['order'], [10] + list(range(10)) +
+                         list(range(11, 21)))
+        self.assertEqual(
+            obs['description'], '3 at a time with 3 threads each, predicted '
+            '0:11:44, 0:02:02 (15%) less running largest first')
+        # without concurrency the order is kept
+        obs = plan_concurrency('bowtie2', 15, seqs, resources=(64, 6000))
+        self.assertEqual(obs['order'], list(range(21)))
+
+        environ['QC_SHOGUN_THREADS_PER_COMMAND'] = '5'
+        try:
+            obs = plan_concurrency('bowtie2', 15, seqs, resources=(64, 64000))
+            self.assertEqual((obs['concurrency'], obs['threads']), (3, 5))
+            self.assertEqual(obs['command_threads'], [5] * 21)
+        finally:
+            del environ['QC_SHOGUN_THREADS_PER_COMMAND']
+
+    def test_plan_concurrency_estimate(self):
+        seqs = [1e6] * 19 + [2e6]
+        obs = plan_concurrency('bowtie2', 15, seqs, resources=(64, 64000))
+        self.assertEqual((obs['concurrency'], obs['threads']), (3, 3))
+        # the index and the reads of the 3 largest samples
+        self.assertAlmostEqual(obs['memory'], 3 * 2907 + 4 * 447, delta=1)
+        self.assertEqual(
+            obs['estimate'], 'estimated 21,000,000 sequences, predicted '
+            '0:24:43 and 10.3 GB of memory')
+        # a memory-mapped index is only counted once
+        obs = plan_concurrency('bowtie2', 15, seqs, resources=(64, 6000))
+        self.assertEqual((obs['concurrency'], obs['threads']), (1, 13))
+        obs = plan_concurrency('bowtie2', 15, seqs, resources=(64, 6000),
+                               shared_mb=2907)
+        self.assertEqual((obs['concurrency'], obs['threads']), (2, 5))
+        self.assertAlmostEqual(obs['memory'], 2907 + 894 + 447, delta=1)
+        # chaining two databases doubles the memory, the runtime and the
+        # helper threads
+        obs = plan_concurrency('bowtie2', 15, seqs, resources=(64, 64000),
+                               stages=2)
+        self.assertEqual((obs['concurrency'], obs['threads']), (2, 3))
+        self.assertAlmostEqual(obs['memory'], 2 * (2 * 2907 + 3 * 447),
+                               delta=1)
+        self.assertIn('predicted 1:17:21', obs['estimate'])
+        # the memory of sortmerna is a parameter, and nothing is predicted
+        # without a model
+        obs = plan_concurrency('sortmerna', 10, seqs, 31000,
+                               resources=(64, 64000))
+        self.assertEqual(obs['memory'], 31000)
+        self.assertEqual(obs['estimate'], 'estimated 21,000,000 sequences '
+                         'and 30.3 GB of memory')
+        obs = plan_concurrency('sortmerna', 10, seqs, resources=(64, 64000))
+        self.assertIsNone(obs['memory'])
+        self.assertEqual(obs['estimate'], 'estimated 21,000,000 sequences')
+
+    def test_plan_concurrency_pipe(self):
+        # the cores, CPU time and memory of piped tools add up
+        model = _pipe_model(['atropos', 'bowtie2'])
+        self.assertAlmostEqual(model['cores'], 6.5)
+        self.assertAlmostEqual(model['seconds_per_seq'], (
+            6.94e-05 * 4.7 + 2.02e-04 * 1.8) / 6.5)
+        self.assertEqual(model['mb'], 114 + 2907)
+        self.assertEqual(model['helper_threads'], 2)
+
+        # a pipe of atropos and bowtie2 gets at least a thread per tool, and
+        # with atropos it needs more of them than bowtie2 alone
+        seqs = [3e5] * 20
+        obs = plan_concurrency(['atropos', 'bowtie2'], 15, seqs,
+                               resources=(64, 64000))
+        self.assertEqual((obs['concurrency'], obs['threads']), (2, 5))
+        self.assertEqual(
+            obs['estimate'], 'estimated 6,000,000 sequences, predicted '
+            '0:08:22 and 7.4 GB of memory')
+        obs = plan_concurrency(['atropos', 'bowtie2'], 3, seqs,
+                               resources=(64, 64000))
+        self.assertEqual((obs['concurrency'], obs['threads']), (1, 2))
+        obs = plan_concurrency(['atropos', 'kmer'], 8, seqs,
+                               resources=(64, 64000))
+        self.assertGreaterEqual(obs['threads'], 2)
+
+    def test_plan_commands(self):
+        def generate(params):
+            return (['cmd%d -p %d' % (i, params['Number of threads'])
+                     for i in range(3)], ['samples'])
+
+        plan = {'threads': 2, 'command_threads': [2, 3, 2], 'order': [1, 0, 2]}
+        obs = _plan_commands(plan, generate, {'Number of threads': 8},
+                             'Number of threads')
+        self.assertEqual(obs, (['cmd1 -p 3', 'cmd0 -p 2', 'cmd2 -p 2'],
+                               ['samples']))
+
+        plan = {'threads': 2, 'command_threads': [], 'order': []}
+        obs = _plan_commands(plan, lambda params: ([], []),
+                             {'Number of threads': 8}, 'Number of threads')
+        self.assertEqual(obs, ([], []))
+
+    def test_cgroup_memory(self):
+        cgroup_dp = mkdtemp()
+        self._clean_up_files.append(cgroup_dp)
+        proc_fp = join(cgroup_dp, 'proc_cgroup')
+
+        def write(fp, value):
+            makedirs(dirname(fp), exist_ok=True)
+            with open(fp, 'w') as f:
+                f.write(value)
+
+        # no limit
+        self.assertIsNone(_cgroup_memory(cgroup_dp, proc_fp))
+        write(join(cgroup_dp, 'memory.max'), 'max\n')
+        self.assertIsNone(_cgroup_memory(cgroup_dp, proc_fp))
+        # cgroup v2, the limit of the job is in the cgroup of the process
+        write(proc_fp, '0::/slurm/job_1\n')
+        write(join(cgroup_dp, 'slurm', 'job_1', 'memory.max'),
+              '%d\n' % (8 * 1024 ** 3))
+        self.assertEqual(_cgroup_memory(cgroup_dp, proc_fp), 8192)
+        # cgroup v1, and the lowest limit is used
+        write(proc_fp, '5:cpuacct,cpu:/job_1\n4:memory:/job_1\n'
+              '0::/slurm/job_1\n')
+        write(join(cgroup_dp, 'memory', 'job_1', 'memory.limit_in_bytes'),
+              '%d\n' % (4 * 1024 ** 3))
+        self.assertEqual(_cgroup_memory(cgroup_dp, proc_fp), 4096)
+
+        # QC_SHOGUN_MEMORY_MB overrides the node and cgroup memory
+        environ['QC_SHOGUN_MEMORY_MB'] = '1000'
+        try:
+            self.assertEqual(_node_resources()[1], 1000)
+        finally:
+            del environ['QC_SHOGUN_MEMORY_MB']
+        self.assertGreater(_node_resources()[1], 0)
+
+    def test_estimate_seqs(self):
+        # short files are counted
+        self.assertEqual(
+            _estimate_seqs('support_files/kd_test_1_R1.fastq.gz'), 2500)
+
+        # larger ones are estimated from their first records
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        seed(0)
+        records = []
+        for i in range(5000):
+            length = randint(100, 150)
+            records.append('@seq_%d\n%s\n+\n%s\n' % (
+                i, ''.join(choices('ACGT', k=length)),
+                ''.join(choices('FGHIJ', k=length))))
+        records = ''.join(records).encode()
+
+        fp = join(out_dir, 'single.fastq.gz')
+        with open(fp, 'wb') as f:
+            f.write(compress(records, 1))
+        self.assertAlmostEqual(_estimate_seqs(fp, 30000), 5000, delta=250)
+
+        # several gzip members, as written by pigz or bgzip, make the ISIZE
+        # trailer unreliable
+        fp = join(out_dir, 'members.fastq.gz')
+        with open(fp, 'wb') as f:
+            half = len(records) // 2
+            f.write(compress(records[:half], 1))
+            f.write(compress(records[half:], 1))
+            f.write(compress(b''))
+        self.assertAlmostEqual(_estimate_seqs(fp, 30000), 5000, delta=250)
+
+        fp = join(out_dir, 'plain.fastq')
+        with open(fp, 'wb') as f:
+            f.write(records)
+        self.assertAlmostEqual(_estimate_seqs(fp, 30000), 5000, delta=250)
+
+        # files that can't be read are estimated from their size
+        fp = join(out_dir, 'corrupt.fastq.gz')
+        with open(fp, 'wb') as f:
+            f.write(b'\x1f\x8b' + b'\x00' * 8998)
+        self.assertEqual(_estimate_seqs(fp), 100)
+
+    def test_status_reporter(self):
+        # a slow server doesn't slow down the updates, which are coalesced
+        qclient = StepRecorder(delay=0.2)
+        start = time()
+        with _StatusReporter(qclient, 'job', 0.1) as reporter:
+            for i in range(1000):
+                reporter.update('Step %d' % i)
+            self.assertLess(time() - start, 0.2)
+            sleep(1)
+            reporter.update('Last step')
+        self.assertLess(len(qclient.steps), 5)
+        self.assertEqual(qclient.steps[-1], 'Last step')
+        self.assertEqual(qclient.steps[-2], 'Step 999')
+
+        # failed updates are ignored
+        qclient = StepRecorder(fail=True)
+        with _StatusReporter(qclient, 'job', 0) as reporter:
+            reporter.update('Step 1')
+        self.assertEqual(qclient.steps, ['Step 1'])
+
+    def test_run_commands_concurrent(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        # the later commands finish first
+        commands = ['sleep 0.%d; echo %d > %s'
+                    % (3 - i, i, join(out_dir, str(i))) for i in range(3)]
+        qclient = StepRecorder()
+        obs = _run_commands(qclient, 'job', commands, 'Step (%d/3)', 'test',
+                            3)
+        self.assertEqual(obs, (True, ''))
+        # the updates are coalesced but they are in order and the last one
+        # is always sent
+        self.assertEqual(qclient.steps[-1], 'Step (3/3)')
+        self.assertEqual(qclient.steps, sorted(qclient.steps))
+        for i in range(3):
+            self.assertTrue(exists(join(out_dir, str(i))))
+
+        # the first failure in the list is reported, even if a later one
+        # fails before it
+        commands = ['echo ok', 'sleep 0.3; echo first >&2; exit 2',
+                    'echo second >&2; exit 3']
+        for concurrency in (1, 3):
+            qclient = StepRecorder()
+            success, msg = _run_commands(
+                qclient, 'job', commands, 'Step (%d/3)', 'test', concurrency)
+            self.assertFalse(success)
+            self.assertEqual(msg, 'Error running test:\nStd out: \nStd err: '
+                             'first\n\n\nCommand run was:\n%s' % commands[1])
+            self.assertEqual(qclient.steps[-1], 'Step (2/3)')
+
+    def test_system_call_logged(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        log_fp = join(out_dir, 'test.log')
+
+        cmd = 'for i in $(seq 1 250); do echo out $i; echo err $i >&2; done'
+        std_out, std_err, return_value = _system_call_logged(cmd, log_fp)
+        self.assertEqual(return_value, 0)
+        # only the tail is kept in memory
+        self.assertEqual(std_out, ''.join(
+            'out %d\n' % i for i in range(151, 251)))
+        self.assertEqual(std_err, ''.join(
+            'err %d\n' % i for i in range(151, 251)))
+        with open(log_fp) as f:
+            obs = f.read().splitlines()
+        self.assertEqual(obs[0], '[command] %s' % cmd)
+        self.assertEqual(obs[-1], '[return value] 0')
+        self.assertEqual(len(obs), 502)
+        self.assertIn('[stdout] out 1', obs)
+        self.assertIn('[stderr] err 250', obs)
+
+        # the log rotates
+        environ['QC_SHOGUN_LOG_MAX_BYTES'] = '1000'
+        try:
+            _system_call_logged(cmd, log_fp)
+        finally:
+            del environ['QC_SHOGUN_LOG_MAX_BYTES']
+        self.assertTrue(exists(log_fp + '.1'))
+        self.assertTrue(exists(log_fp + '.2'))
+        self.assertFalse(exists(log_fp + '.3'))
+
+    def test_log_lines(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        log_fp = join(out_dir, 'test.log')
+        self.assertEqual(_log_lines(log_fp), [])
+
+        # only the output of the last run is returned
+        _system_call_logged('echo first; exit 1', log_fp)
+        _system_call_logged('echo out; echo err >&2', log_fp)
+        self.assertEqual(sorted(_log_lines(log_fp)), ['err', 'out'])
+
+    def test_write_read_counts(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        counts_fp = join(out_dir, 'counts.tsv')
+        samples = [('s1', 'SKB8.640193', 'fastq/s1.fastq.gz', None),
+                   ('s2', 'SKD8.640184', 'fastq/s2.fastq.gz', None),
+                   ('s3', 'SKB7.640196', 'fastq/s3.fastq.gz', None)]
+
+        # the samples without counts are left out
+        obs = _write_read_counts(counts_fp, samples, {
+            's1': (10, 8, 1000, 790), 's2': None, 's3': (4, 4, 600, 600)})
+        self.assertEqual(obs, counts_fp)
+        with open(counts_fp) as f:
+            self.assertEqual(f.read(), (
+                'sample\trun_prefix\treads_in\treads_out\tbases_in\t'
+                'bases_out\n'
+                'SKB8.640193\ts1\t10\t8\t1000\t790\n'
+                'SKB7.640196\ts3\t4\t4\t600\t600\n'))
+
+        # the extra columns follow, with their unknown values as NA
+        _write_read_counts(counts_fp, samples[:1], {
+            's1': (10, 8, 1000, 790, 2, None)},
+            ['removed_human', 'removed_phix'])
+        with open(counts_fp) as f:
+            self.assertEqual(f.read(), (
+                'sample\trun_prefix\treads_in\treads_out\tbases_in\t'
+                'bases_out\tremoved_human\tremoved_phix\n'
+                'SKB8.640193\ts1\t10\t8\t1000\t790\t2\tNA\n'))
+
+    def test_atropos_counts(self):
+        # the reads of a pair count as 2
+        self.assertEqual(_atropos_counts(ATROPOS_REPORT_PE.splitlines()),
+                         (20000, 19000, 3000000, 2800000))
+        self.assertEqual(_atropos_counts(ATROPOS_REPORT_SE.splitlines()),
+                         (10000, 9900, 1500000, 1450000))
+        self.assertIsNone(_atropos_counts(
+            ATROPOS_REPORT_SE.splitlines()[:4]))
+
+    def test_run_commands_ledger(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        ledger_fp = join(out_dir, 'ledger.json')
+        outputs = [[join(out_dir, 's1.txt')], [join(out_dir, 's2.txt')]]
+
+        commands = ['echo s1 > %s' % outputs[0][0],
+                    'echo s2 > %s; exit 1' % outputs[1][0]]
+        success, msg = _run_commands(
+            StepRecorder(), 'job', commands, 'Step (%d/2)', 'test', 1, None,
+            ['s1', 's2'], None, outputs, ledger_fp)
+        self.assertFalse(success)
+        with open(ledger_fp) as f:
+            self.assertEqual(load(f), {'s1': {outputs[0][0]: 3}})
+
+        # the outputs of s1 are still there so it's not run again
+        commands[0] = 'exit 2'
+        commands[1] = 'echo s2 > %s' % outputs[1][0]
+        success, msg = _run_commands(
+            StepRecorder(), 'job', commands, 'Step (%d/2)', 'test', 1, None,
+            ['s1', 's2'], None, outputs, ledger_fp)
+        self.assertEqual((success, msg), (True, ''))
+
+        # but it is if they changed
+        with open(outputs[0][0], 'w') as f:
+            f.write('truncated')
+        success, msg = _run_commands(
+            StepRecorder(), 'job', commands, 'Step (%d/2)', 'test', 1, None,
+            ['s1', 's2'], None, outputs, ledger_fp)
+        self.assertFalse(success)
+        self.assertIn('Command run was:\nexit 2', msg)
+
+    def test_run_commands_publish(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        scratch = mkdtemp()
+        self._clean_up_files.append(scratch)
+        commands = ['echo s1 > %s' % join(scratch, 's1.txt'),
+                    'echo s2 > %s; exit 1' % join(scratch, 's2.txt')]
+        publish = [[(join(scratch, fn), join(out_dir, fn))]
+                   for fn in ('s1.txt', 's2.txt')]
+        success, msg = _run_commands(
+            StepRecorder(), 'job', commands, 'Step (%d/2)', 'test', 1, None,
+            ['s1', 's2'], None, [[dst for _, dst in p] for p in publish],
+            join(out_dir, 'ledger.json'), publish)
+        self.assertFalse(success)
+        # only the outputs of the commands that succeed are moved
+        self.assertFalse(exists(join(scratch, 's1.txt')))
+        with open(join(out_dir, 's1.txt')) as f:
+            self.assertEqual(f.read(), 's1\n')
+        self.assertTrue(exists(join(scratch, 's2.txt')))
+        self.assertFalse(exists(join(out_dir, 's2.txt')))
+        with open(join(out_dir, 'ledger.json')) as f:
+            self.assertEqual(load(f), {'s1': {join(out_dir, 's1.txt'): 3}})
+
+    def test_gzip_level(self):
+        self.assertIsNone(_gzip_level())
+        try:
+            environ['QC_SHOGUN_GZIP_LEVEL'] = '1'
+            self.assertEqual(_gzip_level(), 1)
+            environ['QC_SHOGUN_GZIP_LEVEL'] = '10'
+            with self.assertRaisesRegex(ValueError, 'from 1 to 9, not 10'):
+                _gzip_level()
+        finally:
+            del environ['QC_SHOGUN_GZIP_LEVEL']
+
+    def test_scratch_dir(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        root = join(mkdtemp(), 'scratch')
+        self._clean_up_files.append(dirname(root))
+
+        self.assertEqual(dirname(_scratch_dir(out_dir, 10)), out_dir)
+        environ['QC_SHOGUN_SCRATCH_DP'] = root
+        try:
+            obs = _scratch_dir(out_dir, 10)
+            self.assertEqual(dirname(obs), root)
+            self.assertTrue(isdir(obs))
+            # without enough free space the output directory is used
+            self.assertEqual(dirname(_scratch_dir(out_dir, 2 ** 62)), out_dir)
+        finally:
+            del environ['QC_SHOGUN_SCRATCH_DP']
+
+    def test_run_commands_stop_at_failure(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        outputs = [join(out_dir, 's%d.txt' % i) for i in range(3, 5)]
+        # the second command fails while the first one is still running, so
+        # the queued commands don't start
+        commands = ['sleep 2', 'echo failed >&2; exit 1',
+                    'touch %s' % outputs[0], 'touch %s' % outputs[1]]
+        success, msg = _run_commands(
+            StepRecorder(), 'job', commands, 'Step (%d/4)', 'test', 2)
+        self.assertFalse(success)
+        self.assertEqual(
+            msg, 'Error running test:\nStd out: \nStd err: failed\n\n\n'
+            'Command run was:\n%s' % commands[1])
+        self.assertEqual([exists(fp) for fp in outputs], [False, False])
+
+    def test_run_commands_allow_failures(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        outputs = [[join(out_dir, 's%d.txt' % i)] for i in range(1, 4)]
+        commands = ['echo s1 > %s' % outputs[0][0],
+                    'echo s2 > %s; echo failed >&2; exit 1' % outputs[1][0],
+                    'echo s3 > %s' % outputs[2][0]]
+
+        environ['QC_SHOGUN_ALLOW_SAMPLE_FAILURES'] = 'true'
+        try:
+            for concurrency in (1, 3):
+                qclient = StepRecorder()
+                success, msg = _run_commands(
+                    qclient, 'job', commands, 'Step (%d/3)', 'test',
+                    concurrency, None, ['s1', 's2', 's3'], None, outputs)
+                self.assertTrue(success)
+                self.assertEqual(
+                    msg, '1 of 3 test commands failed: s2\n\nError running '
+                    'test:\nStd out: \nStd err: failed\n\n\nCommand run '
+                    'was:\n%s' % commands[1])
+                self.assertEqual(qclient.steps[-1],
+                                 '1 of 3 test commands failed: s2')
+                # the outputs of the failed command are removed
+                self.assertEqual([exists(o[0]) for o in outputs],
+                                 [True, False, True])
+
+            # if all of them fail, the job fails
+            success, msg = _run_commands(
+                StepRecorder(), 'job', ['exit 1', 'exit 2'], 'Step (%d/2)',
+                'test')
+            self.assertFalse(success)
+            self.assertIn('Command run was:\nexit 1', msg)
+        finally:
+            del environ['QC_SHOGUN_ALLOW_SAMPLE_FAILURES']
+
+    def test_run_commands_logs(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        log_dir = join(out_dir, 'logs')
+        commands = ['echo s1', 'echo s2 failed >&2; exit 1']
+        success, msg = _run_commands(
+            StepRecorder(), 'job', commands, 'Step (%d/2)', 'test', 2,
+            log_dir, ['s1', 's2'])
+        self.assertFalse(success)
+        self.assertEqual(
+            msg, 'Error running test:\nStd out: \nStd err: s2 failed\n\n\n'
+            'Command run was:\n%s\n\nThe full output is in %s'
+            % (commands[1], join(log_dir, 's2.log')))
+
+        # the resources of the commands that ran are in benchmarks.tsv
+        with open(join(log_dir, 'benchmarks.tsv')) as f:
+            obs = [line.rstrip('\n').split('\t') for line in f]
+        self.assertEqual(obs[0], [
+            'sample', 'seqs', 's', 'h:m:s', 'max_rss', 'max_vms', 'max_uss',
+            'max_pss', 'io_in', 'io_out', 'mean_load', 'seqs_estimate'])
+        self.assertEqual(len(obs), 3)
+        # without count_seqs and estimates the sequences are unknown
+        self.assertEqual((obs[1][1], obs[1][11]), ('NA', 'NA'))
+
+        # the writes of all the processes of the command are counted, the
+        # sequences are counted from its output next to the estimate, and
+        # the rows of the commands that ran before are kept
+        commands = ['dd if=/dev/zero of=%s bs=1M count=8 status=none '
+                    'conv=fsync; echo 1000 reads' % join(out_dir, 'zeros')]
+        success, msg = _run_commands(
+            StepRecorder(), 'job', commands, 'Step (%d/1)', 'test', 1,
+            log_dir, ['s3'], [1234.5],
+            count_seqs=lambda lines: int(lines[-1].split()[0]))
+        self.assertTrue(success)
+        with open(join(log_dir, 'benchmarks.tsv')) as f:
+            obs = [line.rstrip('\n').split('\t') for line in f]
+        self.assertEqual([row[0] for row in obs[1:]], ['s1', 's2', 's3'])
+        self.assertEqual(obs[3][:2], ['s3', '1000'])
+        self.assertEqual(obs[3][11], '1234')
+        self.assertGreaterEqual(float(obs[3][9]), 8)
+
+        archive_fp = _archive_logs(log_dir, join(out_dir, 'logs.tar.gz'))
+        self.assertFalse(exists(log_dir))
+        with tarfile.open(archive_fp) as tar:
+            self.assertEqual(sorted(tar.getnames()), [
+                'logs', 'logs/benchmarks.tsv', 'logs/s1.log', 'logs/s2.log',
+                'logs/s3.log'])
+
+    def test_counted_seqs(self):
+        self.assertEqual(_counted_seqs((20, 18, 3000, 2700), True), 10)
+        self.assertEqual(_counted_seqs((20, 18, 3000, 2700), False), 20)
+        self.assertIsNone(_counted_seqs(None, True))
+        self.assertIsNone(_counted_seqs((None, None, None, None), True))
+
+    def test_write_benchmarks(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        benchmark_fp = join(out_dir, 'benchmarks.tsv')
+        row = {'sample': 's1', 'seqs': 10.0, 's': 1.5, 'h:m:s': '0:00:01',
+               'max_rss': 2.0, 'max_vms': 3.0, 'max_uss': 1.0,
+               'max_pss': 1.5, 'io_in': 0.0, 'io_out': 0.5,
+               'mean_load': 95.0, 'seqs_estimate': 12.5}
+        _write_benchmarks(benchmark_fp, [
+            row, dict(row, sample='s2', max_rss=None, max_vms=None,
+                      max_uss=None, max_pss=None)])
+        with open(benchmark_fp) as f:
+            obs = f.read().splitlines()
+        self.assertEqual(obs, [
+            '\t'.join(BENCHMARK_COLUMNS),
+            's1\t10\t1.5000\t0:00:01\t2.00\t3.00\t1.00\t1.50\t0.00\t0.50\t'
+            '95.00\t12',
+            's2\t10\t1.5000\t0:00:01\tNA\tNA\tNA\tNA\t0.00\t0.50\t95.00\t'
+            '12'])
+
+        # a rerun replaces the rows of its samples and keeps the others
+        _write_benchmarks(benchmark_fp, [dict(row, sample='s2', seqs=20),
+                                         dict(row, sample='s3')])
+        with open(benchmark_fp) as f:
+            obs = [line.split('\t')[:2] for line in f.read().splitlines()]
+        self.assertEqual(obs, [['sample', 'seqs'], ['s1', '10'],
+                               ['s2', '20'], ['s3', '10']])
+
     def test_generate_trim_analysis_commands_forward_reverse(self):
         fd, fp = mkstemp()
         close(fd)
@@ -296,8 +966,14 @@ class QC_TrimTests(PluginTestCase):
             [(od('kd_test_1.R1.fastq.gz'), 'raw_forward_seqs'),
              (od('kd_test_1.R2.fastq.gz'), 'raw_reverse_seqs'),
              (od('kd_test_2.R1.fastq.gz'), 'raw_forward_seqs'),
-             (od('kd_test_2.R2.fastq.gz'), 'raw_reverse_seqs')]]
+             (od('kd_test_2.R2.fastq.gz'), 'raw_reverse_seqs'),
+             (od('atropos_logs.tar.gz'), 'log'),
+             (od('atropos_read_counts.tsv'), 'log')]]
         self.assertEqual(exp_fps, obs_fps)
+        with open(od('atropos_read_counts.tsv')) as f:
+            counts = [line.split('\t') for line in f.read().splitlines()]
+        self.assertEqual(sorted(c[1] for c in counts[1:]),
+                         ['kd_test_1', 'kd_test_2'])
 
     def test_trim_just_fwd(self):
         # generating filepaths
@@ -357,7 +1033,9 @@ class QC_TrimTests(PluginTestCase):
         # ftype = 'per_sample_FASTQ'
         exp_fps = [
             [(od('kd_test_1.R1.fastq.gz'), 'raw_forward_seqs'),
-             (od('kd_test_2.R1.fastq.gz'), 'raw_forward_seqs')]]
+             (od('kd_test_2.R1.fastq.gz'), 'raw_forward_seqs'),
+             (od('atropos_logs.tar.gz'), 'log'),
+             (od('atropos_read_counts.tsv'), 'log')]]
         self.assertEqual(exp_fps, obs_fps)
 
     def test_per_sample_ainfo_error(self):
@@ -373,6 +1051,53 @@ class QC_TrimTests(PluginTestCase):
                               'Atropos', 'QC_Trim Files', True)
 
 
+class StepRecorder(object):
+    """Records the job steps, optionally slowly or failing"""
+    def __init__(self, delay=0, fail=False):
+        self.steps = []
+        self.delay = delay
+        self.fail = fail
+
+    def update_job_step(self, job_id, msg):
+        sleep(self.delay)
+        self.steps.append(msg)
+        if self.fail:
+            raise ValueError('The server is down')
+
+
+ATROPOS_REPORT_PE = """
+=======
+Summary
+=======
+
+Total read pairs processed:             10,000
+  Read 1 with adapter:                   1,200 (12.0%)
+  Read 2 with adapter:                   1,100 (11.0%)
+Pairs that were too short:                 500 (5.0%)
+Pairs written (passing filters):         9,500 (95.0%)
+
+Total basepairs processed:       3,000,000 bp
+  Read 1:       1,500,000 bp
+  Read 2:       1,500,000 bp
+Quality-trimmed:                    50,000 bp (1.7%)
+  Read 1:          20,000 bp
+  Read 2:          30,000 bp
+Total written (filtered):        2,800,000 bp (93.3%)
+  Read 1:       1,410,000 bp
+  Read 2:       1,390,000 bp
+"""
+
+ATROPOS_REPORT_SE = """
+Total reads processed:                  10,000
+Reads with adapters:                     1,200 (12.0%)
+Reads that were too short:                 100 (1.0%)
+Reads written (passing filters):         9,900 (99.0%)
+
+Total basepairs processed:       1,500,000 bp
+Quality-trimmed:                    20,000 bp (1.3%)
+Total written (filtered):        1,450,000 bp (96.7%)
+"""
+
 MAPPING_FILE = (
     "#SampleID\tplatform\tbarcode\texperiment_design_description\t"
     "library_construction_protocol\tcenter_name\tprimer\trun_prefix\t"
@@ -6,10 +6,12 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 
-from os.path import join
+from os.path import join, exists
+import re
 from qp_shogun.utils import (
-    _format_params, make_read_pairs_per_sample,
-    _run_commands, _per_sample_ainfo)
+    _format_params, make_read_pairs_per_sample, _run_commands,
+    _per_sample_ainfo, plan_concurrency, _plan_commands, _estimate_seqs,
+    _archive_logs, _log_lines, _write_read_counts, _counted_seqs)
 
 ATROPOS_PARAMS = {
     'adapter': 'Fwd read adapter', 'A': 'Rev read adapter',
@@ -19,6 +21,43 @@ ATROPOS_PARAMS = {
     'max-n': 'Maximum number of N bases in a read to keep it',
     'trim-n': 'Trim Ns on ends of reads', 'threads': 'Number of threads used',
     'nextseq-trim': 'NextSeq-specific quality trimming'}
+# the totals of the atropos report, as in cutadapt's
+ATROPOS_REPORT_RE = {
+    'reads_in': re.compile(r'^Total (read pairs|reads) processed:\s+([\d,]+)'),
+    'reads_out': re.compile(
+        r'^(Pairs|Reads) written \(passing filters\):\s+([\d,]+)'),
+    'bases_in': re.compile(r'^Total (basepairs) processed:\s+([\d,]+) bp'),
+    'bases_out': re.compile(r'^Total (written) \(filtered\):\s+([\d,]+) bp')}
+
+
+def _atropos_counts(lines):
+    """The reads and bases in and out of a sample from its atropos report
+
+    Parameters
+    ----------
+    lines : list of str
+        The output of atropos, see _log_lines
+
+    Returns
+    -------
+    tuple of int or None
+        The reads in, reads out, bases in and bases out, None if the report
+        doesn't have all of them. The reads of a pair count as 2
+    """
+    counts = {}
+    for line in lines:
+        line = line.strip()
+        for key, regex in ATROPOS_REPORT_RE.items():
+            match = regex.match(line)
+            if match is not None:
+                n = int(match.group(2).replace(',', ''))
+                if match.group(1) in ('read pairs', 'Pairs'):
+                    n *= 2
+                counts[key] = n
+    if len(counts) < len(ATROPOS_REPORT_RE):
+        return None
+    return (counts['reads_in'], counts['reads_out'], counts['bases_in'],
+            counts['bases_out'])
 
 
 def generate_trim_commands(forward_seqs, reverse_seqs, map_file,
@@ -105,26 +144,51 @@ def trim(qclient, job_id, parameters, out_dir):
     qiime_map = prep_info['qiime-map']
 
     # Step 2 generating command atropos
-    qclient.update_job_step(job_id, "Step 2 of 4: Generating"
-                                    " QC_Trim commands")
     rs = fps['raw_reverse_seqs'] if 'raw_reverse_seqs' in fps else []
-    commands, samples = generate_trim_commands(fps['raw_forward_seqs'],
-                                               rs, qiime_map, out_dir,
-                                               parameters)
+    # the samples are independent so they are trimmed concurrently, each
+    # with a share of the threads
+    sample_seqs = [
+        _estimate_seqs(fp) for fp in sorted(fps['raw_forward_seqs'])]
+    plan = plan_concurrency(
+        'atropos', parameters['Number of threads used'], sample_seqs)
+    parameters['Number of threads used'] = plan['threads']
+    qclient.update_job_step(
+        job_id, "Step 2 of 4: Generating QC_Trim commands (%s)"
+        % plan['estimate'])
+    commands, samples = _plan_commands(
+        plan, lambda params: generate_trim_commands(
+            fps['raw_forward_seqs'], rs, qiime_map, out_dir, params),
+        parameters, 'Number of threads used')
 
     # Step 3 execute atropos
     len_cmd = len(commands)
-    msg = "Step 3 of 4: Executing QC_Trim job (%d/{0})".format(len_cmd)
-    success, msg = _run_commands(qclient, job_id, commands, msg, 'QC_Trim')
+    msg = "Step 3 of 4: Executing QC_Trim job (%d/{0}, {1})".format(
+        len_cmd, plan['description'])
+    log_dir = join(out_dir, 'atropos_logs')
+    suffixes = ['%s.R1.fastq.gz', '%s.R2.fastq.gz']
+    run_prefixes = [samples[i][0] for i in plan['order']]
+    success, run_msg = _run_commands(
+        qclient, job_id, commands, msg, 'QC_Trim', plan['concurrency'],
+        log_dir, run_prefixes, [sample_seqs[i] for i in plan['order']],
+        [[join(out_dir, suff % rp) for suff in suffixes]
+         for rp in run_prefixes], join(out_dir, 'atropos_ledger.json'),
+        count_seqs=lambda lines: _counted_seqs(
+            _atropos_counts(lines), bool(rs)))
     if not success:
-        return False, None, msg
+        return False, None, run_msg
 
     # Step 4 generating artifacts
     msg = "Step 4 of 4: Generating new artifacts (%d/{0})".format(len_cmd)
-    suffixes = ['%s.R1.fastq.gz', '%s.R2.fastq.gz']
     prg_name = 'Atropos'
     file_type_name = 'Adapter trimmed files'
+    counts_fp = _write_read_counts(
+        join(out_dir, 'atropos_read_counts.tsv'),
+        [s for s in samples if exists(join(out_dir, suffixes[0] % s[0]))],
+        {rp: _atropos_counts(_log_lines(join(log_dir, '%s.log' % rp)))
+         for rp in run_prefixes})
+    log_fp = _archive_logs(log_dir, join(out_dir, 'atropos_logs.tar.gz'))
     ainfo = _per_sample_ainfo(
-        out_dir, samples, suffixes, prg_name, file_type_name, bool(rs))
+        out_dir, samples, suffixes, prg_name, file_type_name, bool(rs),
+        log_fp, counts_fp)
 
-    return True, ainfo, ""
+    return True, ainfo, run_msg
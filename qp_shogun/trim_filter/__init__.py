@@ -0,0 +1,35 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from qiita_client import QiitaCommand
+
+from .trim_filter import trim_filter
+from qp_shogun.trim import (
+    opt_params as trim_opt_params, dflt_param_set as trim_dflt_param_set)
+from qp_shogun.filter import (
+    opt_params as filter_opt_params, dflt_param_set as filter_dflt_param_set)
+
+__all__ = ['trim_filter']
+
+# Define the trim + filter command, with the parameters of both commands
+# and a single number of threads
+req_params = {'input': ('artifact', ['per_sample_FASTQ'])}
+opt_params = {k: v for k, v in trim_opt_params.items()
+              if k != 'Number of threads used'}
+opt_params.update(filter_opt_params)
+outputs = {'Filtered files': 'per_sample_FASTQ'}
+dflt_param_set = {}
+for trim_name, trim_dflt in trim_dflt_param_set.items():
+    for db, filter_dflt in filter_dflt_param_set.items():
+        dflt_param_set['%s, %s' % (trim_name, db)] = dict(
+            {k: v for k, v in trim_dflt.items()
+             if k != 'Number of threads used'}, **filter_dflt)
+
+trim_filter_cmd = QiitaCommand(
+    'QC_Trim_Filter', "Sequence QC - adapter trimming and host filtering",
+    trim_filter, req_params, opt_params, outputs, dflt_param_set)
@@ -0,0 +1,266 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import main
+from os import close, remove, makedirs, chmod
+from os.path import exists, isdir, join
+from shutil import rmtree, copyfile
+from tempfile import mkstemp, mkdtemp
+from json import dumps
+from functools import partial
+from sys import executable
+import os
+
+from qiita_client.testing import PluginTestCase
+
+from qp_shogun import plugin
+from qp_shogun.trim_filter.trim_filter import (
+    generate_trim_filter_commands, trim_filter, _split_sample_threads,
+    _trim_filter_counts)
+from qp_shogun.utils import _system_call_logged
+import qp_shogun.trim_filter as tf
+
+
+class QC_TrimFilterTests(PluginTestCase):
+    maxDiff = None
+
+    def setUp(self):
+        plugin("https://localhost:21174", 'register', 'ignored')
+        db_path = os.environ["QC_FILTER_DB_DP"]
+        self.params = {
+                       'Fwd read adapter': 'GATCGGAAGAGCACACGTCTGAACTCCAGTCAC',
+                       'Rev read adapter': 'GATCGGAAGAGCGTCGTGTAGGGAAAGGAGTGT',
+                       'Trim low-quality bases': '15',
+                       'Minimum trimmed read length': '80',
+                       'Pair-end read required to match': 'any',
+                       'Maximum number of N bases in a read to keep it': '80',
+                       'Trim Ns on ends of reads': True,
+                       'NextSeq-specific quality trimming': False,
+                       'Bowtie2 database to filter': join(db_path,
+                                                          'phix/phix'),
+                       'Number of threads': '5'
+        }
+        self._clean_up_files = []
+
+    def tearDown(self):
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def test_dflt_param_set(self):
+        # the default sets combine those of QC_Trim and QC_Filter, with a
+        # single number of threads
+        self.assertNotIn('Number of threads used', tf.opt_params)
+        for name, params in tf.dflt_param_set.items():
+            self.assertEqual(set(params), set(tf.opt_params))
+
+    def test_split_sample_threads(self):
+        # atropos is faster than bowtie2 so it gets the smaller share, and
+        # both get at least one thread
+        self.assertEqual(_split_sample_threads(1), (1, 1))
+        self.assertEqual(_split_sample_threads(2), (1, 1))
+        self.assertEqual(_split_sample_threads('5'), (1, 4))
+        self.assertEqual(_split_sample_threads(15), (4, 11))
+
+    def test_generate_trim_filter_commands(self):
+        fd, fp = mkstemp()
+        close(fd)
+        with open(fp, 'w') as f:
+            f.write(MAPPING_FILE)
+        self._clean_up_files.append(fp)
+        db_path = os.environ["QC_FILTER_DB_DP"]
+
+        atropos = (
+            'atropos trim -A GATCGGAAGAGCGTCGTGTAGGGAAAGGAGTGT '
+            '--adapter GATCGGAAGAGCACACGTCTGAACTCCAGTCAC --max-n 80 '
+            '--minimum-length 80 --pair-filter any --quality-cutoff 15 '
+            '--threads 1 --trim-n --report-file /dev/stderr -L - '
+            '-pe1 fastq/%s.fastq.gz -pe2 fastq/%s.R2.fastq.gz | ')
+        exp_cmd = [
+            (atropos + 'bowtie2 -p 4 -x %sphix/phix --very-sensitive '
+             '--interleaved - | %s -m qp_shogun.filter.sam_pairs -d phix '
+             '-p 4 output/%s.R1.fastq.gz output/%s.R2.fastq.gz') % (
+                 s, s, db_path, executable, s, s)
+            for s in ('s1', 's2', 's3')]
+        exp_sample = [
+            ('s1', 'SKB8.640193', 'fastq/s1.fastq.gz',
+             'fastq/s1.R2.fastq.gz'),
+            ('s2', 'SKD8.640184', 'fastq/s2.fastq.gz',
+             'fastq/s2.R2.fastq.gz'),
+            ('s3', 'SKB7.640196', 'fastq/s3.fastq.gz',
+             'fastq/s3.R2.fastq.gz')]
+
+        obs_cmd, obs_sample = generate_trim_filter_commands(
+            ['fastq/s1.fastq.gz', 'fastq/s2.fastq.gz', 'fastq/s3.fastq.gz'],
+            ['fastq/s1.R2.fastq.gz', 'fastq/s2.R2.fastq.gz',
+             'fastq/s3.R2.fastq.gz'], fp, 'output', self.params)
+        self.assertEqual(obs_cmd, exp_cmd)
+        self.assertEqual(obs_sample, exp_sample)
+
+        # the k-mer screens and the gzip level are the ones of QC_Filter
+        phix = join(db_path, 'phix/phix')
+        obs_cmd, _ = generate_trim_filter_commands(
+            ['fastq/s1.fastq.gz'], ['fastq/s1.R2.fastq.gz'], fp, 'output',
+            self.params, screens={phix}, level=1)
+        self.assertEqual(obs_cmd, [
+            (atropos + '%s -m qp_shogun.filter.kmer -x %s -d phix -p 4 '
+             '-l 1 output/s1.R1.fastq.gz output/s1.R2.fastq.gz') % (
+                 's1', 's1', executable, phix)])
+
+    def test_generate_trim_filter_commands_forward(self):
+        fd, fp = mkstemp()
+        close(fd)
+        with open(fp, 'w') as f:
+            f.write(MAPPING_FILE)
+        self._clean_up_files.append(fp)
+
+        with self.assertRaisesRegex(ValueError, 'reverse reads of s1'):
+            generate_trim_filter_commands(
+                ['fastq/s1.fastq.gz'], [], fp, 'output', self.params)
+
+    def test_generate_trim_filter_commands_atropos_fails(self):
+        # a failed atropos fails the command even if the filters after it
+        # succeed with the pairs it wrote
+        fd, fp = mkstemp()
+        close(fd)
+        with open(fp, 'w') as f:
+            f.write(MAPPING_FILE)
+        self._clean_up_files.append(fp)
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        od = partial(join, out_dir)
+        makedirs(od('bin'))
+        for name, script in (('atropos', 'exit 1'),
+                             ('bowtie2', 'cat > /dev/null\n'
+                                         'printf "@HD\\tVN:1.0\\n"')):
+            with open(od('bin', name), 'w') as f:
+                f.write('#!/bin/sh\n%s\n' % script)
+            chmod(od('bin', name), 0o755)
+        cmds, _ = generate_trim_filter_commands(
+            ['fastq/s1.fastq.gz'], ['fastq/s1.R2.fastq.gz'], fp, out_dir,
+            dict(self.params, **{'Number of threads': '2'}))
+
+        path = os.environ['PATH']
+        os.environ['PATH'] = '%s:%s' % (od('bin'), path)
+        try:
+            std_out, std_err, return_value = _system_call_logged(
+                cmds[0], od('s.log'))
+        finally:
+            os.environ['PATH'] = path
+        self.assertNotEqual(return_value, 0)
+        self.assertIn('0 pairs (0 bp)', std_err)
+
+    def test_trim_filter_counts(self):
+        # the reads in are the ones of atropos and the reads out the ones
+        # of the last filter
+        lines = ['Total read pairs processed:             10,000',
+                 'Pairs written (passing filters):         9,500 (95.0%)',
+                 'Total basepairs processed:       3,000,000 bp',
+                 'Total written (filtered):        2,800,000 bp (93.3%)',
+                 'human: 9000 pairs (2600000 bp), 8000 with both reads '
+                 'unmapped (2300000 bp)',
+                 'phix: 9500 pairs (2800000 bp), 9000 with both reads '
+                 'unmapped (2600000 bp)']
+        self.assertEqual(_trim_filter_counts(lines),
+                         (20000, 16000, 3000000, 2300000))
+        # with the reads removed by each database
+        self.assertEqual(_trim_filter_counts(lines, ['phix', 'human']),
+                         (20000, 16000, 3000000, 2300000, 1000, 2000))
+        self.assertIsNone(_trim_filter_counts(lines[:4]))
+        self.assertIsNone(_trim_filter_counts(lines[4:]))
+
+    def test_trim_filter(self):
+        # generating filepaths
+        in_dir = mkdtemp()
+        self._clean_up_files.append(in_dir)
+
+        fp1_1 = join(in_dir, 'kd_test_1_R1.fastq.gz')
+        fp1_2 = join(in_dir, 'kd_test_1_R2.fastq.gz')
+        fp2_1 = join(in_dir, 'kd_test_2_R1.fastq.gz')
+        fp2_2 = join(in_dir, 'kd_test_2_R2.fastq.gz')
+        copyfile('support_files/kd_test_1_R1.fastq.gz', fp1_1)
+        copyfile('support_files/kd_test_1_R2.fastq.gz', fp1_2)
+        copyfile('support_files/kd_test_1_R1.fastq.gz', fp2_1)
+        copyfile('support_files/kd_test_1_R2.fastq.gz', fp2_2)
+
+        # inserting new prep template
+        prep_info_dict = {
+            'SKB7.640196': {'run_prefix': 'kd_test_1'},
+            'SKB8.640193': {'run_prefix': 'kd_test_2'}
+        }
+        data = {'prep_info': dumps(prep_info_dict),
+                # magic #1 = testing study
+                'study': 1,
+                'data_type': 'Metagenomic'}
+        pid = self.qclient.post('/apitest/prep_template/', data=data)['prep']
+
+        # inserting artifacts
+        data = {
+            'filepaths': dumps([
+                (fp1_1, 'raw_forward_seqs'),
+                (fp1_2, 'raw_reverse_seqs'),
+                (fp2_1, 'raw_forward_seqs'),
+                (fp2_2, 'raw_reverse_seqs')]),
+            'type': "per_sample_FASTQ",
+            'name': "Test QC_Trim_Filter artifact",
+            'prep': pid}
+        aid = self.qclient.post('/apitest/artifact/', data=data)['artifact']
+
+        self.params['input'] = aid
+        data = {'user': 'demo@microbio.me',
+                'command': dumps(['qp-shogun', '072020', 'QC_Trim_Filter']),
+                'status': 'running',
+                'parameters': dumps(self.params)}
+        jid = self.qclient.post('/apitest/processing_job/', data=data)['job']
+
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+
+        success, ainfo, msg = trim_filter(
+            self.qclient, jid, self.params, out_dir)
+
+        self.assertEqual("", msg)
+        self.assertTrue(success)
+
+        self.assertEqual(1, len(ainfo))
+
+        obs_fps = []
+        for a in ainfo:
+            self.assertEqual("per_sample_FASTQ", a.artifact_type)
+            obs_fps.append(a.files)
+        od = partial(join, out_dir)
+
+        exp_fps = [
+            [(od('kd_test_1.R1.fastq.gz'), 'raw_forward_seqs'),
+             (od('kd_test_1.R2.fastq.gz'), 'raw_reverse_seqs'),
+             (od('kd_test_2.R1.fastq.gz'), 'raw_forward_seqs'),
+             (od('kd_test_2.R2.fastq.gz'), 'raw_reverse_seqs'),
+             (od('trim_filter_logs.tar.gz'), 'log'),
+             (od('trim_filter_read_counts.tsv'), 'log')]]
+        self.assertEqual(exp_fps, obs_fps)
+        with open(od('trim_filter_read_counts.tsv')) as f:
+            counts = [line.split('\t') for line in f.read().splitlines()]
+        self.assertEqual(sorted(c[1] for c in counts[1:]),
+                         ['kd_test_1', 'kd_test_2'])
+
+
+MAPPING_FILE = (
+    "#SampleID\tplatform\tbarcode\texperiment_design_description\t"
+    "library_construction_protocol\tcenter_name\tprimer\trun_prefix\t"
+    "instrument_model\tDescription\n"
+    "SKB7.640196\tILLUMINA\tA\tA\tA\tANL\tA\ts3\tIllumina MiSeq\tdesc1\n"
+    "SKB8.640193\tILLUMINA\tA\tA\tA\tANL\tA\ts1\tIllumina MiSeq\tdesc2\n"
+    "SKD8.640184\tILLUMINA\tA\tA\tA\tANL\tA\ts2\tIllumina MiSeq\tdesc3\n"
+)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os.path import join, getsize, exists, basename
+from itertools import zip_longest
+from shutil import rmtree
+from qp_shogun.utils import (
+    _format_params, make_read_pairs_per_sample, _run_commands,
+    _per_sample_ainfo, plan_concurrency, _plan_commands, _estimate_seqs,
+    _archive_logs, _env_flag, _scratch_dir, _gzip_level, _log_lines,
+    _write_read_counts, _counted_seqs, TOOL_MODELS)
+from qp_shogun.trim.trim import ATROPOS_PARAMS, _atropos_counts
+from qp_shogun.filter.filter import (
+    filter_pipeline, kmer_screens, warm_up_index, _databases, _index_fps,
+    _filter_counts, _chain_counts, _removed_reads)
+
+# the share of the threads of a sample given to atropos, the rest go to the
+# filter; both run at the same time so it's their share of the runtime
+ATROPOS_THREADS_SHARE = TOOL_MODELS['atropos']['seconds_per_seq'] / (
+    TOOL_MODELS['atropos']['seconds_per_seq'] +
+    TOOL_MODELS['bowtie2']['seconds_per_seq'])
+
+
+def _split_sample_threads(threads):
+    """The threads of atropos and of the filter of a sample"""
+    threads = int(threads)
+    atropos = min(max(1, int(round(threads * ATROPOS_THREADS_SHARE))),
+                  max(1, threads - 1))
+    return atropos, max(1, threads - atropos)
+
+
+def _trim_filter_counts(lines, names=()):
+    """The reads and bases in and out of a sample from its output
+
+    Parameters
+    ----------
+    lines : list of str
+        The output of the command, see _log_lines
+    names : list of str, optional
+        The names of the databases, to add the reads each one removed
+
+    Returns
+    -------
+    tuple of int or None
+        The reads and bases read by atropos and written by the last filter,
+        as in _atropos_counts, and the reads removed by each database (see
+        _removed_reads), None without counts
+    """
+    trimmed = _atropos_counts(lines)
+    stages = _filter_counts(lines)
+    filtered = _chain_counts(stages.values())
+    if trimmed is None or filtered is None:
+        return None
+    return (trimmed[0], filtered[1], trimmed[2], filtered[3]) + tuple(
+        _removed_reads(stages, names))
+
+
+def generate_trim_filter_commands(forward_seqs, reverse_seqs, map_file,
+                                  out_dir, parameters, mm=False,
+                                  screens=None, level=None):
+    """Generates the QC_Trim_Filter commands
+
+    Parameters
+    ----------
+    forward_seqs : list of str
+        The list of forward seqs filepaths
+    reverse_seqs : list of str
+        The list of reverse seqs filepaths
+    map_file : str
+        The path to the mapping file
+    out_dir : str
+        The job output directory
+    parameters : dict
+        The command's parameters, keyed by parameter name
+    mm : bool, optional
+        Whether bowtie2 memory-maps the index (--mm)
+    screens : set of str, optional
+        The databases screened by k-mers instead of aligned with bowtie2
+    level : int, optional
+        The gzip level of the outputs, defaults to the one of pigz
+
+    Returns
+    -------
+    cmds: list of str
+        The QC_Trim_Filter commands
+    samples: list of tup
+        list of 4-tuples with run prefix, sample name, fwd read fp, rev read fp
+
+    Raises
+    ------
+    ValueError
+        If a sample doesn't have reverse reads
+
+    Notes
+    -----
+    Atropos writes the trimmed pairs interleaved and uncompressed to its
+    stdout, which is the input of the same commands as QC_Filter (see
+    filter_pipeline), so only the filtered reads are written. Its report
+    goes to stderr, so it's in the log of the sample.
+    """
+    # we match filenames, samples, and run prefixes
+    samples = make_read_pairs_per_sample(forward_seqs, reverse_seqs, map_file)
+
+    atropos_threads, filter_threads = _split_sample_threads(
+        parameters['Number of threads'])
+    trim_params = dict(parameters)
+    trim_params[ATROPOS_PARAMS['threads']] = atropos_threads
+    param_string = _format_params(trim_params, ATROPOS_PARAMS)
+    filter_params = dict(parameters)
+    filter_params['Number of threads'] = filter_threads
+
+    cmds = []
+    for run_prefix, sample, f_fp, r_fp in samples:
+        if r_fp is None:
+            raise ValueError('QC_Trim_Filter needs the reverse reads of %s'
+                             % run_prefix)
+        cmds.append(
+            'atropos trim %s --report-file /dev/stderr -L - -pe1 %s -pe2 %s'
+            ' | %s' % (param_string, f_fp, r_fp, filter_pipeline(
+                filter_params,
+                join(out_dir, '%s.R1.fastq.gz' % run_prefix),
+                join(out_dir, '%s.R2.fastq.gz' % run_prefix),
+                mm=mm, screens=screens, level=level)))
+
+    return cmds, samples
+
+
+def trim_filter(qclient, job_id, parameters, out_dir):
+    """Run Atropos and filter its output using Bowtie2
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    job_id : str
+        The job id
+    parameters : dict
+        The parameter values
+    out_dir : str
+        The path to the job's output directory
+
+    Returns
+    -------
+    bool, list, str
+        The results of the job
+    """
+    # Step 1 get the rest of the information need to run the job
+    qclient.update_job_step(job_id, "Step 1 of 4: Collecting information")
+    artifact_id = parameters['input']
+    del parameters['input']
+
+    # Get the artifact filepath information
+    artifact_info = qclient.get("/qiita_db/artifacts/%s/" % artifact_id)
+    fps = artifact_info['files']
+
+    # Get the artifact metadata
+    prep_info = qclient.get('/qiita_db/prep_template/%s/'
+                            % artifact_info['prep_information'][0])
+    qiime_map = prep_info['qiime-map']
+
+    # Step 2 generating command
+    if 'raw_reverse_seqs' not in fps:
+        return False, None, 'QC_Trim_Filter needs paired-end reads'
+    rs = fps['raw_reverse_seqs']
+    # the samples are independent so they are processed concurrently, each
+    # with a share of the threads. Atropos runs at the same time as the
+    # filters, so the plan is the one of all of them piped
+    sample_seqs = [
+        _estimate_seqs(fp) for fp in sorted(fps['raw_forward_seqs'])]
+    databases = _databases(parameters)
+    screens = kmer_screens(databases)
+    aligned = [db for db in databases if db not in screens]
+    mm = _env_flag('QC_SHOGUN_BOWTIE2_MM')
+    shared_mb = None
+    if mm:
+        shared_mb = sum(getsize(fp) for db in aligned
+                        for fp in _index_fps(db)) / 1024 ** 2
+    plan = plan_concurrency(
+        ['atropos'] + ['bowtie2'] * len(aligned) + ['kmer'] * len(screens),
+        parameters['Number of threads'], sample_seqs, shared_mb=shared_mb)
+    parameters['Number of threads'] = plan['threads']
+    qclient.update_job_step(
+        job_id, "Step 2 of 4: Generating QC_Trim_Filter commands (%s)"
+        % plan['estimate'])
+    # the outputs are written to a scratch directory and moved to out_dir
+    # when their command succeeds, the outputs are smaller than the inputs
+    sample_bytes = [sum(getsize(fp) for fp in pair if fp is not None)
+                    for pair in zip_longest(sorted(fps['raw_forward_seqs']),
+                                            sorted(rs))]
+    scratch = _scratch_dir(out_dir, sum(sorted(
+        sample_bytes, reverse=True)[:plan['concurrency']]))
+    try:
+        commands, samples = _plan_commands(
+            plan, lambda params: generate_trim_filter_commands(
+                fps['raw_forward_seqs'], rs, qiime_map, scratch, params, mm,
+                screens, _gzip_level()),
+            parameters, 'Number of threads')
+
+        # Step 3 execute the commands
+        len_cmd = len(commands)
+        if mm and aligned:
+            qclient.update_job_step(
+                job_id, "Step 3 of 4: Loading the Bowtie2 database")
+            for db in aligned:
+                warm_up_index(db)
+        msg = "Step 3 of 4: Executing QC_Trim_Filter job (%d/{0}, {1})".format(
+            len_cmd, plan['description'])
+        log_dir = join(out_dir, 'trim_filter_logs')
+        suffixes = ['%s.R1.fastq.gz', '%s.R2.fastq.gz']
+        run_prefixes = [samples[i][0] for i in plan['order']]
+        success, run_msg = _run_commands(
+            qclient, job_id, commands, msg, 'QC_Trim_Filter',
+            plan['concurrency'], log_dir, run_prefixes,
+            [sample_seqs[i] for i in plan['order']],
+            [[join(out_dir, suff % rp) for suff in suffixes]
+             for rp in run_prefixes],
+            join(out_dir, 'trim_filter_ledger.json'),
+            [[(join(scratch, suff % rp), join(out_dir, suff % rp))
+              for suff in suffixes] for rp in run_prefixes],
+            lambda lines: _counted_seqs(_atropos_counts(lines), bool(rs)))
+    finally:
+        rmtree(scratch, ignore_errors=True)
+    if not success:
+        return False, None, run_msg
+
+    # Step 4 generating artifacts
+    msg = "Step 4 of 4: Generating new artifacts (%d/{0})".format(len_cmd)
+    prg_name = 'Trimming and filtering'
+    file_type_name = 'Filtered files'
+    names = [basename(db) for db in databases]
+    counts_fp = _write_read_counts(
+        join(out_dir, 'trim_filter_read_counts.tsv'),
+        [s for s in samples if exists(join(out_dir, suffixes[0] % s[0]))],
+        {rp: _trim_filter_counts(
+            _log_lines(join(log_dir, '%s.log' % rp)), names)
+         for rp in run_prefixes}, ['removed_%s' % name for name in names])
+    log_fp = _archive_logs(log_dir, join(out_dir, 'trim_filter_logs.tar.gz'))
+    ainfo = _per_sample_ainfo(
+        out_dir, samples, suffixes, prg_name, file_type_name, bool(rs),
+        log_fp, counts_fp)
+
+    return True, ainfo, run_msg
@@ -11,10 +11,216 @@
 # -----------------------------------------------------------------------------
 from qiita_client.util import system_call, get_sample_names_by_run_prefix
 from itertools import zip_longest
-from os.path import basename, join, exists
-from functools import partial
+import os
+from os import (environ, stat, makedirs, replace, cpu_count, sysconf,
+                listdir, remove, wait4, WIFSIGNALED, WTERMSIG, WEXITSTATUS)
+from os.path import basename, join, exists, abspath, getsize, dirname
+from functools import partial, lru_cache
+from hashlib import sha1
+from json import dumps, load, dump
+from tempfile import gettempdir, NamedTemporaryFile, mkdtemp
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heapreplace
+from datetime import timedelta
+from collections import deque, OrderedDict
+from subprocess import Popen, PIPE
+from threading import Thread, Event, Lock
+from time import time
+import struct
+import zlib
+from logging import Formatter, makeLogRecord
+from logging.handlers import RotatingFileHandler
+from shutil import rmtree, move, disk_usage
+import tarfile
 from qiita_client import ArtifactInfo
 
+# the number of threads a single per-sample command uses efficiently, see
+# _split_threads
+DFLT_THREADS_PER_COMMAND = 4
+
+# Scaling models of the per-sample tools, used by plan_concurrency. The
+# runtime and memory are linear in the number of sequences of the sample and
+# cores is the number of cores a single process keeps busy (mean_load). The
+# atropos and bowtie2 models are fit from the benchmarks in
+# notebooks/support_files/benchmarks, and the kmer model (the k-mer screen of
+# QC_Filter) from 200,000 simulated pairs. There is no benchmark for sortmerna
+# so it has no model, see plan_concurrency. helper_threads are the threads
+# kept for the processes each copy of the tool writes its outputs through:
+# bowtie2 pipes its alignments to sam_pairs, a thread, and the unmapped pairs
+# to the compressors, which share another as they compress them at the rate
+# bowtie2 writes them; the k-mer screen has the compressors, and atropos
+# compresses its outputs with its own threads.
+TOOL_MODELS = {
+    'atropos': {'seconds_per_seq': 6.94e-05, 'seconds': 5.68, 'cores': 4.7,
+                'mb_per_seq': 2.12e-03, 'mb': 114, 'mb_per_thread': 0,
+                'helper_threads': 0},
+    'bowtie2': {'seconds_per_seq': 2.02e-04, 'seconds': 9.89, 'cores': 1.8,
+                'mb_per_seq': 4.47e-04, 'mb': 2907, 'mb_per_thread': 0,
+                'helper_threads': 2},
+    'kmer': {'seconds_per_seq': 1.75e-05, 'seconds': 0.5, 'cores': 1,
+             'mb_per_seq': 0, 'mb': 180, 'mb_per_thread': 0,
+             'helper_threads': 1}}
+# approximate size of a gzipped 150 bp FASTQ record, used to estimate the
+# number of sequences of a sample from its file size when it can't be read
+GZ_BYTES_PER_SEQ = 90
+# the sequences of a file are estimated from its first ESTIMATE_SAMPLE_BYTES
+# (uncompressed), read ESTIMATE_CHUNK compressed bytes at a time
+ESTIMATE_SAMPLE_BYTES = 2 * 1024 ** 2
+ESTIMATE_CHUNK = 64 * 1024
+# where the cgroup filesystem is mounted, to read the memory limit of the job
+CGROUP_DP = '/sys/fs/cgroup'
+# fraction of the node memory the concurrent commands can use
+MEMORY_FRACTION = 0.9
+# the per-command logs rotate when they reach QC_SHOGUN_LOG_MAX_BYTES, keeping
+# LOG_BACKUPS previous files, and only the last LOG_TAIL_LINES lines of each
+# stream, of at most LOG_LINE_MAX characters, are kept for the error messages
+LOG_DFLT_MAX_BYTES = 10 * 1024 ** 2
+LOG_BACKUPS = 2
+LOG_TAIL_LINES = 100
+LOG_LINE_MAX = 64 * 1024
+# the uncompressed size of a gzipped FASTQ relative to its compressed size,
+# used to size the scratch space of the intermediate files
+FASTQ_GZ_RATIO = 4
+# the columns of the benchmarks TSV, as in notebooks/support_files/benchmarks
+# followed by the estimate of the sequences used to plan the commands, and
+# the seconds between samples of the memory and I/O of the processes
+BENCHMARK_COLUMNS = ['sample', 'seqs', 's', 'h:m:s', 'max_rss', 'max_vms',
+                     'max_uss', 'max_pss', 'io_in', 'io_out', 'mean_load',
+                     'seqs_estimate']
+BENCHMARK_INTERVAL = 1
+# the shell of the logged commands, it needs pipefail
+SHELL = '/bin/bash'
+# the columns of the read counts of the commands, see _write_read_counts
+READ_COUNTS_COLUMNS = ['sample', 'run_prefix', 'reads_in', 'reads_out',
+                       'bases_in', 'bases_out']
+# the minimum number of seconds between two job step updates sent to Qiita,
+# QC_SHOGUN_STATUS_INTERVAL
+STATUS_DFLT_INTERVAL = 10
+# a plan with more concurrent commands is only chosen if its predicted
+# makespan is below this fraction of the best plan with fewer
+PLAN_MIN_GAIN = 0.95
+
+
+def _cache_dir():
+    """The directory where the parsed mapping files are cached
+
+    Returns
+    -------
+    str
+        QC_SHOGUN_CACHE_DP if set, qp-shogun-cache in the system temporary
+        directory otherwise
+    """
+    return environ.get('QC_SHOGUN_CACHE_DP',
+                       join(gettempdir(), 'qp-shogun-cache'))
+
+
+def _map_file_key(map_file):
+    """The cache key of a mapping file: its path, mtime and size"""
+    st = stat(map_file)
+    return (abspath(map_file), st.st_mtime_ns, st.st_size)
+
+
+def _map_cache_fp(key):
+    """The on-disk cache filepath of a mapping file key"""
+    return join(_cache_dir(), 'map_%s.json' % sha1(
+        dumps(key).encode('utf-8')).hexdigest())
+
+
+def _save_json(fp, obj):
+    """Atomically writes an object as JSON"""
+    with NamedTemporaryFile('w', dir=dirname(fp), suffix='.tmp',
+                            delete=False) as f:
+        dump(obj, f)
+    replace(f.name, fp)
+
+
+def _save_map_cache(key, cache):
+    """Atomically writes the cache of a mapping file, errors are ignored"""
+    try:
+        makedirs(_cache_dir(), exist_ok=True)
+        _save_json(_map_cache_fp(key), cache)
+    except OSError:
+        # the cache is only an optimization
+        pass
+
+
+@lru_cache(maxsize=32)
+def _load_map_cache(key):
+    """Loads, or creates, the cache of a mapping file
+
+    Parameters
+    ----------
+    key : tuple of (str, int, int)
+        The mapping file key, as returned by _map_file_key
+
+    Returns
+    -------
+    dict
+        The run prefix to sample name mapping ('run_prefixes') and the
+        pairings already computed with it ('pairings')
+
+    Notes
+    -----
+    The on-disk cache is shared by all the jobs that use the same prep
+    information, and the in-process cache by all the jobs run by the same
+    worker. As the mtime and size are part of the key, a modified mapping
+    file is parsed again.
+    """
+    try:
+        with open(_map_cache_fp(key)) as f:
+            cache = load(f)
+        if set(cache) != {'run_prefixes', 'pairings'}:
+            raise ValueError('Unexpected cache format')
+    except (OSError, ValueError):
+        cache = {'run_prefixes': get_sample_names_by_run_prefix(key[0]),
+                 'pairings': {}}
+        _save_map_cache(key, cache)
+
+    return cache
+
+
+def _run_prefix_index(run_prefixes):
+    """Indexes the run prefixes by their length
+
+    Parameters
+    ----------
+    run_prefixes : iterable of str
+        The run prefixes
+
+    Returns
+    -------
+    list of (int, set of str)
+        The run prefixes grouped by length, sorted by length
+    """
+    index = {}
+    for rp in run_prefixes:
+        index.setdefault(len(rp), set()).add(rp)
+    return sorted(index.items())
+
+
+def _match_run_prefixes(index, fn):
+    """Finds all the run prefixes that match a filename
+
+    Parameters
+    ----------
+    index : list of (int, set of str)
+        The run prefixes index, as returned by _run_prefix_index
+    fn : str
+        The filename
+
+    Returns
+    -------
+    list of str
+        The run prefixes fn starts with
+    """
+    matches = []
+    for length, prefixes in index:
+        if length > len(fn):
+            break
+        if fn[:length] in prefixes:
+            matches.append(fn[:length])
+    return matches
+
 
 def make_read_pairs_per_sample(forward_seqs, reverse_seqs, map_file):
     """Recovers read pairing information
@@ -60,10 +266,23 @@ def make_read_pairs_per_sample(forward_seqs, reverse_seqs, map_file):
                               ', '.join(reverse_seqs)))
         reverse_seqs.sort()
 
+    # the parsed mapping file and the pairings are cached, so chained jobs
+    # on the same prep information don't recompute them
+    map_key = _map_file_key(map_file)
+    cache = _load_map_cache(map_key)
+    pairing_key = sha1(dumps(
+        [forward_seqs, reverse_seqs]).encode('utf-8')).hexdigest()
+    if pairing_key in cache['pairings']:
+        return [tuple(s) for s in cache['pairings'][pairing_key]]
+
     # get run prefixes
     # These are prefixes that should match uniquely to forward reads
     # sn_by_rp is dict of samples keyed by run prefixes
-    sn_by_rp = get_sample_names_by_run_prefix(map_file)
+    sn_by_rp = cache['run_prefixes']
+    # a filename can only start with prefixes of its own length or shorter,
+    # so each filename is checked against the distinct prefix lengths instead
+    # of against every prefix
+    rp_index = _run_prefix_index(sn_by_rp)
 
     # make pairings
     samples = []
@@ -73,19 +292,17 @@ def make_read_pairs_per_sample(forward_seqs, reverse_seqs, map_file):
         # fwd_fp is the fwd read filepath
         fwd_fn = basename(fwd_fp)
 
-        # iterate over run prefixes and make sure only one matches
-        run_prefix = None
-        for rp in sn_by_rp:
-            if fwd_fn.startswith(rp) and run_prefix is None:
-                run_prefix = rp
-            elif fwd_fn.startswith(rp) and run_prefix is not None:
-                raise ValueError('Multiple run prefixes match this fwd read: '
-                                 '%s' % fwd_fn)
+        # make sure only one run prefix matches
+        matches = _match_run_prefixes(rp_index, fwd_fn)
+        if len(matches) > 1:
+            raise ValueError('Multiple run prefixes match this fwd read: '
+                             '%s' % fwd_fn)
 
         # make sure that we got one matching run prefix:
-        if run_prefix is None:
+        if not matches:
             raise ValueError('No run prefix matching this fwd read: %s'
                              % fwd_fn)
+        run_prefix = matches[0]
 
         if run_prefix in used_prefixes:
             raise ValueError('This run prefix matches multiple fwd reads: '
@@ -108,6 +325,9 @@ def make_read_pairs_per_sample(forward_seqs, reverse_seqs, map_file):
 
         used_prefixes.add(run_prefix)
 
+    cache['pairings'][pairing_key] = samples
+    _save_map_cache(map_key, cache)
+
     return(samples)
 
 
@@ -134,22 +354,1160 @@ def _format_params(parameters, func_params):
     return(param_string)
 
 
-def _run_commands(qclient, job_id, commands, msg, cmd_name):
-    for i, cmd in enumerate(commands):
-        qclient.update_job_step(job_id, msg % (i+1))
-        std_out, std_err, return_value = system_call(cmd)
-        if return_value != 0:
-            error_msg = ("Error running %s:\nStd out: %s\nStd err: %s"
-                         "\n\nCommand run was:\n%s"
-                         % (cmd_name, std_out, std_err, cmd))
-            return False, error_msg
+def _split_threads(threads, n_commands, threads_per_command=None):
+    """Splits the job's threads among concurrent commands
+
+    Parameters
+    ----------
+    threads : int
+        The number of threads available for the job
+    n_commands : int
+        The number of independent commands to run
+    threads_per_command : int, optional
+        The number of threads a single command can use efficiently. Defaults
+        to QC_SHOGUN_THREADS_PER_COMMAND or DFLT_THREADS_PER_COMMAND
+
+    Returns
+    -------
+    int, int
+        The number of commands to run at the same time and the number of
+        threads for each of them
+
+    Notes
+    -----
+    The benchmarks of atropos and bowtie2 show that a single process uses
+    between 1.5 and 5 cores, so running several samples at the same time with
+    fewer threads each makes a better use of the job's threads. The threads
+    left over after choosing the number of concurrent commands are given
+    back to the commands.
+    """
+    threads = max(1, int(threads))
+    if threads_per_command is None:
+        threads_per_command = int(environ.get(
+            'QC_SHOGUN_THREADS_PER_COMMAND', DFLT_THREADS_PER_COMMAND))
+    per_command = max(1, min(threads, int(threads_per_command)))
+    concurrency = max(1, min(int(n_commands), threads // per_command))
+    per_command = max(per_command, threads // concurrency)
+
+    return concurrency, per_command
+
+
+def _cgroup_memory(cgroup_dp=CGROUP_DP, proc_cgroup_fp='/proc/self/cgroup'):
+    """The memory limit (in MB) of the cgroup of the job
+
+    Parameters
+    ----------
+    cgroup_dp : str, optional
+        Where the cgroup filesystem is mounted
+    proc_cgroup_fp : str, optional
+        The cgroups of this process
+
+    Returns
+    -------
+    float or None
+        The lowest limit of memory.max (cgroup v2) and
+        memory/memory.limit_in_bytes (cgroup v1), of the cgroup of this
+        process and of the root of the mount, as seen in a container; None
+        without a limit
+    """
+    fps = [join(cgroup_dp, 'memory.max'),
+           join(cgroup_dp, 'memory', 'memory.limit_in_bytes')]
+    try:
+        with open(proc_cgroup_fp) as f:
+            for line in f:
+                _, controllers, path = line.rstrip('\n').split(':', 2)
+                path = path.lstrip('/')
+                if not controllers:
+                    fps.append(join(cgroup_dp, path, 'memory.max'))
+                elif 'memory' in controllers.split(','):
+                    fps.append(join(cgroup_dp, 'memory', path,
+                                    'memory.limit_in_bytes'))
+    except (OSError, ValueError):
+        pass
+
+    limits = []
+    for fp in fps:
+        try:
+            with open(fp) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # v2 has no limit as max, v1 as a number larger than the memory
+        if value.isdigit():
+            limits.append(int(value) / 1024 ** 2)
+    return min(limits) if limits else None
+
+
+def _node_resources():
+    """The number of CPUs and the memory (in MB) available to the job
+
+    Returns
+    -------
+    int, float
+        The CPUs this process can run on and the memory: the node memory,
+        or the limit of the job's cgroup if lower (see _cgroup_memory), or
+        QC_SHOGUN_MEMORY_MB if set
+
+    Notes
+    -----
+    The scheduler usually limits the memory of a job with its cgroup, and
+    going over it gets the commands killed, so the node memory is only used
+    without a lower limit.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = cpu_count() or 1
+    if 'QC_SHOGUN_MEMORY_MB' in environ:
+        memory = float(environ['QC_SHOGUN_MEMORY_MB'])
+    else:
+        memory = sysconf('SC_PAGE_SIZE') * sysconf('SC_PHYS_PAGES') / 1024 ** 2
+        limit = _cgroup_memory()
+        if limit is not None:
+            memory = min(memory, limit)
+    return cpus, memory
+
 
-    return True, ""
+def _estimate_seqs(fp, sample_bytes=ESTIMATE_SAMPLE_BYTES):
+    """Estimates the number of sequences of a, possibly gzipped, FASTQ
+
+    Parameters
+    ----------
+    fp : str
+        The FASTQ filepath
+    sample_bytes : int, optional
+        The number of uncompressed bytes read from the start of the file
+
+    Returns
+    -------
+    int
+        The estimated number of sequences
+
+    Notes
+    -----
+    The size of a record is measured on the first records of the file. For
+    a gzipped file, the uncompressed size is the ISIZE trailer of the file
+    when it's reliable: ISIZE is the size modulo 2 ** 32 of the last gzip
+    member only, so it's only used if the whole file couldn't be larger than
+    4 GB and it's consistent with the compression ratio of the first
+    records (which isn't the case when the file has several members, as
+    those written by pigz or bgzip). Otherwise the file size is scaled by
+    that compression ratio. Files shorter than the sample are counted
+    exactly, and files that can't be read are estimated from their size
+    with GZ_BYTES_PER_SEQ.
+    """
+    size = getsize(fp)
+    fallback = int(size / GZ_BYTES_PER_SEQ)
+    read_in = 0
+    data = []
+    data_len = 0
+    try:
+        with open(fp, 'rb') as f:
+            gzipped = f.read(2) == b'\x1f\x8b'
+            f.seek(0)
+            dec = zlib.decompressobj(31) if gzipped else None
+            while data_len < sample_bytes and read_in < size:
+                chunk = f.read(ESTIMATE_CHUNK)
+                if not chunk:
+                    break
+                read_in += len(chunk)
+                if dec is not None:
+                    chunk = dec.decompress(chunk)
+                    # a new member starts after the end of the current one
+                    while dec.eof and dec.unused_data:
+                        rest = dec.unused_data
+                        dec = zlib.decompressobj(31)
+                        chunk += dec.decompress(rest)
+                data.append(chunk)
+                data_len += len(chunk)
+            eof = read_in >= size
+            if gzipped and not eof:
+                f.seek(-4, 2)
+                isize = struct.unpack('<I', f.read(4))[0]
+    except (OSError, zlib.error, struct.error):
+        return fallback
+
+    records = b''.join(data).count(b'\n') / 4
+    if eof:
+        return int(records)
+    if not records:
+        return fallback
+    bytes_per_record = data_len / records
+    ratio = data_len / read_in
+    uncompressed = size * ratio
+    if gzipped and uncompressed * 2 < 2 ** 32 and (
+            uncompressed / 2 < isize < uncompressed * 2):
+        uncompressed = isize
+
+    return int(uncompressed / bytes_per_record)
+
+
+def _predict_makespan(runtimes, concurrency):
+    """Predicts the time to run the commands in order, concurrency at a time
+
+    Parameters
+    ----------
+    runtimes : list of float
+        The predicted runtime of each command, in the order they are submitted
+    concurrency : int
+        The number of commands running at the same time
+
+    Returns
+    -------
+    float
+        The time when the last command finishes
+    """
+    workers = [0.0] * min(concurrency, max(1, len(runtimes)))
+    for runtime in runtimes:
+        heapreplace(workers, workers[0] + runtime)
+    return max(workers)
+
+
+def _pipe_model(tools):
+    """The model of tools piped into each other, see TOOL_MODELS
+
+    Parameters
+    ----------
+    tools : list of str
+        The tools, keys of TOOL_MODELS
+
+    Returns
+    -------
+    dict
+        The model of the pipe
+
+    Notes
+    -----
+    The tools run at the same time, each with its share of the threads, so
+    their cores and memory add up and the runtime is their CPU time over
+    all their cores.
+    """
+    models = [TOOL_MODELS[tool] for tool in tools]
+    model = {'cores': sum(m['cores'] for m in models)}
+    for key in ('seconds_per_seq', 'seconds'):
+        model[key] = sum(m[key] * m['cores'] for m in models) / model['cores']
+    for key in ('mb_per_seq', 'mb', 'mb_per_thread', 'helper_threads'):
+        model[key] = sum(m[key] for m in models)
+    return model
+
+
+def _model_runtimes(model, sample_seqs, command_threads, order, stages):
+    """The runtimes predicted by a tool's model, see plan_concurrency"""
+    return [(model['seconds'] + model['seconds_per_seq'] * sample_seqs[i]) *
+            model['cores'] / min(command_threads[i], model['cores']) * stages
+            for i in order]
+
+
+def _plan_model(model, threads, sample_seqs, candidates, largest_first,
+                forced, memory_mb, node_memory, shared_mb, stages,
+                reserved):
+    """Chooses the split of the threads with the shortest predicted makespan
+
+    See plan_concurrency for the parameters
+
+    Returns
+    -------
+    dict
+        The 'concurrency', 'threads', 'command_threads' and 'makespan' of
+        the plan
+    """
+    n_commands = len(sample_seqs)
+    fixed_mb = model['mb'] if shared_mb is None else 0
+
+    plan = None
+    for concurrency, per_command in candidates:
+        # QC_SHOGUN_THREADS_PER_COMMAND sets the threads of every command
+        command_threads = [per_command] * n_commands
+        if not forced:
+            for i in largest_first[:max(0, threads - concurrency * (
+                    per_command + reserved))]:
+                command_threads[i] += 1
+        mem = memory_mb
+        if mem is None:
+            mem = fixed_mb + model['mb_per_seq'] * max(sample_seqs or [0])
+        mem = mem * stages + model['mb_per_thread'] * max(
+            command_threads or [per_command])
+        if not forced and concurrency > 1 and (
+                (shared_mb or 0) + concurrency * mem >
+                node_memory * MEMORY_FRACTION):
+            continue
+
+        makespan = _predict_makespan(
+            _model_runtimes(model, sample_seqs, command_threads,
+                            largest_first, stages),
+            concurrency)
+        # more concurrent commands also add I/O and memory pressure, which
+        # the models don't capture, so they need a clear gain
+        if plan is None or makespan < plan['makespan'] * PLAN_MIN_GAIN:
+            plan = {'concurrency': concurrency, 'threads': per_command,
+                    'command_threads': command_threads,
+                    'makespan': makespan}
+
+    return plan
+
+
+def plan_concurrency(tool, threads, sample_seqs, memory_mb=None,
+                     resources=None, shared_mb=None, stages=1):
+    """Chooses how many samples to run at the same time and their threads
+
+    Parameters
+    ----------
+    tool : str or list of str
+        The per-sample tool, a key of TOOL_MODELS if it has a model, or the
+        tools piped into each other by each command, see _pipe_model
+    threads : int
+        The number of threads of the job
+    sample_seqs : list of float
+        The (estimated) number of sequences of each command
+    memory_mb : float, optional
+        The memory used by each command, overrides the tool's model
+    resources : (int, float), optional
+        The CPUs and memory (MB) of the node, defaults to _node_resources()
+    shared_mb : float, optional
+        The memory (MB) shared by all the commands, as a memory-mapped index,
+        which replaces the fixed memory of the tool's model and is counted
+        once regardless of how many commands run at the same time
+    stages : int, optional
+        The number of copies of the tool each command chains, one after the
+        other, sharing its threads, e.g. one per database to filter
+
+    Returns
+    -------
+    dict
+        The plan: 'concurrency', 'threads' per command, the
+        'command_threads' of each command (indices of sample_seqs), the
+        'order' to run the commands in, the predicted 'makespan' in seconds
+        and its 'description', and the predicted peak 'memory' in MB with
+        the pre-flight 'estimate' of the whole job. The makespan, and the
+        memory without memory_mb, are None for tools without a model
+
+    Notes
+    -----
+    Each split of the threads, K commands at a time with threads // K
+    threads each, is evaluated with the tool's model. The helper_threads of
+    the model (per stage) are kept for the processes next to the tool and
+    'threads' is what is left for the tool itself. A command is slowed
+    down when it gets fewer threads than the cores it can use, and K is
+    limited by the node memory. The threads left over by the split are
+    given, one each, to the largest commands, which run in the first K, so
+    no thread is idle while they run; the model includes them. The split
+    with the shortest predicted makespan is chosen, unless a smaller K is
+    within PLAN_MIN_GAIN. Setting
+    QC_SHOGUN_THREADS_PER_COMMAND skips the models and uses _split_threads.
+    Tools without a model also use _split_threads, with as many commands at
+    a time as fit in the node memory, and nothing is predicted. Each tool of
+    a pipe needs a thread of its own, so its commands get at least a thread
+    per tool.
+
+    When more than one command runs at a time, the commands are run
+    largest first (LPT), so a large sample doesn't start last and delay the
+    whole job; the description includes the time this saves over running
+    them in their original order.
+    """
+    if isinstance(tool, str):
+        model, min_threads = TOOL_MODELS.get(tool), 1
+    else:
+        model, min_threads = _pipe_model(tool), len(tool)
+    cpus, node_memory = _node_resources() if resources is None else resources
+    threads = max(1, min(int(threads), cpus))
+    n_commands = len(sample_seqs)
+
+    forced = 'QC_SHOGUN_THREADS_PER_COMMAND' in environ
+    if forced or model is None:
+        candidates = [_split_threads(threads, n_commands)]
+        reserved = 0
+    else:
+        # the threads of the helpers of each command are kept for them
+        reserved = model['helper_threads'] * stages
+        most = max(1, min(n_commands, threads // (min_threads + reserved)))
+        candidates = [(k, max(min_threads, threads // k - reserved))
+                      for k in range(1, most + 1)]
+    largest_first = sorted(range(n_commands), key=lambda i: -sample_seqs[i])
+
+    if model is None:
+        concurrency, per_command = candidates[0]
+        if memory_mb and not forced:
+            concurrency = max(1, min(concurrency, int(
+                (node_memory * MEMORY_FRACTION - (shared_mb or 0)) //
+                memory_mb)))
+            per_command = max(per_command, threads // concurrency)
+        plan = {'concurrency': concurrency, 'threads': per_command,
+                'command_threads': [per_command] * n_commands,
+                'makespan': None}
+    else:
+        plan = _plan_model(model, threads, sample_seqs, candidates,
+                           largest_first, forced, memory_mb, node_memory,
+                           shared_mb, stages, reserved)
+
+    plan['description'] = '%d at a time with %d threads each' % (
+        plan['concurrency'], plan['threads'])
+    extra = sum(plan['command_threads']) - plan['threads'] * n_commands
+    if extra:
+        plan['description'] += ' (%d with %d)' % (extra, plan['threads'] + 1)
+    if plan['makespan'] is not None:
+        plan['description'] += ', predicted %s' % timedelta(
+            seconds=int(plan['makespan']))
+    if plan['concurrency'] > 1:
+        plan['order'] = largest_first
+        saved = 0
+        if model is not None:
+            in_order = _predict_makespan(
+                _model_runtimes(model, sample_seqs, plan['command_threads'],
+                                range(n_commands), stages),
+                plan['concurrency'])
+            saved = in_order - plan['makespan']
+        if saved > 0:
+            plan['description'] += ', %s (%d%%) less running largest first' % (
+                timedelta(seconds=int(saved)), round(100 * saved / in_order))
+    else:
+        plan['order'] = list(range(n_commands))
+
+    # the largest commands run at the same time, at the start of the job
+    if memory_mb is not None:
+        command_mb = [memory_mb] * n_commands
+    elif model is not None:
+        fixed_mb = model['mb'] if shared_mb is None else 0
+        command_mb = [fixed_mb + model['mb_per_seq'] * seqs
+                      for seqs in sample_seqs]
+    else:
+        command_mb = None
+    plan['memory'] = None
+    if command_mb is not None:
+        mb_per_thread = model['mb_per_thread'] if model is not None else 0
+        plan['memory'] = (shared_mb or 0) + sum(sorted(
+            (mb * stages + mb_per_thread * t
+             for mb, t in zip(command_mb, plan['command_threads'])),
+            reverse=True)[:plan['concurrency']])
+
+    plan['estimate'] = 'estimated %s sequences' % '{:,}'.format(
+        int(sum(sample_seqs)))
+    if plan['makespan'] is not None:
+        plan['estimate'] += ', predicted %s' % timedelta(
+            seconds=int(plan['makespan']))
+    if plan['memory'] is not None:
+        plan['estimate'] += ' and %.1f GB of memory' % (plan['memory'] / 1024)
+
+    return plan
+
+
+def _plan_commands(plan, generate, parameters, threads_param):
+    """Generates the commands of a plan, each with its threads
+
+    Parameters
+    ----------
+    plan : dict
+        The plan of the commands, see plan_concurrency
+    generate : callable
+        Generates the commands, and the samples, from the parameters
+    parameters : dict
+        The command's parameters, keyed by parameter name
+    threads_param : str
+        The name of the parameter with the number of threads
+
+    Returns
+    -------
+    list of str, list of tup
+        The commands, in the order of the plan, and the samples
+    """
+    commands = {}
+    for threads in set(plan['command_threads']) or {plan['threads']}:
+        commands[threads], samples = generate(
+            dict(parameters, **{threads_param: threads}))
+    return [commands[plan['command_threads'][i]][i]
+            for i in plan['order']], samples
+
+
+def _stream_to_log(pipe, stream, handler, tail):
+    """Writes the lines of a pipe to a log handler, keeping the last ones"""
+    for line in iter(partial(pipe.readline, LOG_LINE_MAX), ''):
+        tail.append(line)
+        handler.handle(makeLogRecord(
+            {'msg': '[%s] %s' % (stream, line.rstrip('\n'))}))
+    pipe.close()
+
+
+def _process_tree(pid):
+    """The pids of a process and all its descendants, from /proc"""
+    children = {}
+    for entry in listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                # the process name can have spaces, the ppid follows it
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    tree = []
+    queue = [pid]
+    while queue:
+        p = queue.pop()
+        tree.append(p)
+        queue.extend(children.get(p, []))
+    return tree
+
+
+def _proc_usage(pid):
+    """The memory of a process, from /proc
+
+    Returns
+    -------
+    dict
+        With rss, vms, uss and pss in kB, only the values that can be read
+    """
+    usage = {}
+    fields = {
+        'status': {'VmRSS:': 'rss', 'VmSize:': 'vms'},
+        'smaps_rollup': {'Pss:': 'pss', 'Private_Clean:': 'uss',
+                         'Private_Dirty:': 'uss'}}
+    for fname, keys in fields.items():
+        try:
+            with open('/proc/%d/%s' % (pid, fname)) as f:
+                for line in f:
+                    parts = line.split()
+                    if parts and parts[0] in keys:
+                        key = keys[parts[0]]
+                        usage[key] = usage.get(key, 0) + int(parts[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    return usage
+
+
+def _monitor_process(pid, stop, usage):
+    """Samples the memory of a process tree until stop is set
+
+    Parameters
+    ----------
+    pid : int
+        The root process
+    stop : threading.Event
+        Set when the process finishes
+    usage : dict
+        Updated with the maximum of the sum over the tree of rss, vms, uss
+        and pss (kB)
+    """
+    while True:
+        totals = {'rss': 0, 'vms': 0, 'uss': 0, 'pss': 0}
+        for p in _process_tree(pid):
+            proc_usage = _proc_usage(p)
+            for key in totals:
+                totals[key] += proc_usage.get(key, 0)
+        for key, value in totals.items():
+            usage[key] = max(usage.get(key, 0), value)
+        if stop.wait(BENCHMARK_INTERVAL):
+            break
+
+
+def _system_call_logged(cmd, log_fp, usage=None):
+    """Runs a command streaming its output to a rotating log file
+
+    Parameters
+    ----------
+    cmd : str
+        The command to run
+    log_fp : str
+        The log filepath
+    usage : dict, optional
+        If given, it's filled with the resources used by the command and its
+        children, with the benchmarks TSV columns: wall time (s), max_rss,
+        max_vms, max_uss and max_pss (MB, None if they couldn't be sampled),
+        io_in and io_out (MB) and mean_load (CPU time over wall time, in %)
+
+    Returns
+    -------
+    str, str, int
+        The tail of the stdout and stderr, and the return value, as
+        qiita_client.util.system_call
+
+    Notes
+    -----
+    system_call keeps all the output of the command in memory, which can be
+    a lot for verbose tools. Here the output is written to the log as it is
+    produced and only the last LOG_TAIL_LINES lines of each stream are kept.
+
+    The command runs in bash with pipefail, so a pipeline fails when any of
+    its commands does, e.g. bowtie2 in front of the filters that write its
+    unmapped pairs, and not only when the last one does.
+
+    The CPU time and I/O come from wait4, which includes all the processes
+    of the command. The memory is the maximum of the sum over all the
+    processes, sampled from /proc every BENCHMARK_INTERVAL seconds; if the
+    command finished before it could be sampled the memory is unknown, as
+    the RSS from wait4 can be the one of this process, which forked it.
+    """
+    handler = RotatingFileHandler(
+        log_fp, maxBytes=int(environ.get(
+            'QC_SHOGUN_LOG_MAX_BYTES', LOG_DFLT_MAX_BYTES)),
+        backupCount=LOG_BACKUPS)
+    handler.setFormatter(Formatter('%(message)s'))
+    handler.handle(makeLogRecord({'msg': '[command] %s' % cmd}))
+
+    tails = {'stdout': deque(maxlen=LOG_TAIL_LINES),
+             'stderr': deque(maxlen=LOG_TAIL_LINES)}
+    start = time()
+    proc = Popen('set -o pipefail\n' + cmd, shell=True, stdout=PIPE,
+                 stderr=PIPE, universal_newlines=True, errors='replace',
+                 executable=SHELL)
+    sampled, stop = {}, Event()
+    threads = [Thread(target=_stream_to_log,
+                      args=(getattr(proc, stream), stream, handler, tail))
+               for stream, tail in tails.items()]
+    threads.append(Thread(target=_monitor_process,
+                          args=(proc.pid, stop, sampled)))
+    for thread in threads:
+        thread.start()
+    for thread in threads[:-1]:
+        thread.join()
+    # waiting with wait4 to get the resources used by the command
+    _, status, rusage = wait4(proc.pid, 0)
+    wall = time() - start
+    stop.set()
+    threads[-1].join()
+    if WIFSIGNALED(status):
+        return_value = -WTERMSIG(status)
+    else:
+        return_value = WEXITSTATUS(status)
+    proc.returncode = return_value
+    handler.handle(makeLogRecord(
+        {'msg': '[return value] %d' % return_value}))
+    handler.close()
+
+    if usage is not None:
+        usage.update({
+            's': wall,
+            'h:m:s': str(timedelta(seconds=int(wall))),
+            # the block counts are in 512 byte units
+            'io_in': rusage.ru_inblock * 512 / 1024 ** 2,
+            'io_out': rusage.ru_oublock * 512 / 1024 ** 2,
+            'mean_load': 100 * (rusage.ru_utime + rusage.ru_stime) / max(
+                wall, 1e-6)})
+        usage.update(
+            ('max_%s' % key, sampled[key] / 1024 if sampled.get(key) else None)
+            for key in ('rss', 'vms', 'uss', 'pss'))
+
+    return ''.join(tails['stdout']), ''.join(tails['stderr']), return_value
+
+
+def _archive_logs(log_dir, archive_fp):
+    """Compresses the logs directory into a tarball and removes it
+
+    Parameters
+    ----------
+    log_dir : str
+        The directory with the logs
+    archive_fp : str
+        The tarball filepath
+
+    Returns
+    -------
+    str
+        archive_fp
+    """
+    with tarfile.open(archive_fp, 'w:gz') as tar:
+        tar.add(log_dir, arcname=basename(log_dir))
+    rmtree(log_dir)
+
+    return archive_fp
+
+
+class _StatusReporter(object):
+    """Sends the job step updates to Qiita from a background thread
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    job_id : str
+        The job id
+    interval : float, optional
+        The minimum number of seconds between two updates. Defaults to
+        QC_SHOGUN_STATUS_INTERVAL or STATUS_DFLT_INTERVAL
+
+    Notes
+    -----
+    update only records the message, so it never waits for the server.
+    The thread sends the latest message as soon as it can, but at most one
+    per interval, so the intermediate messages are coalesced. close sends
+    the last message if it wasn't sent yet; it's called when leaving the
+    context, whether the commands succeeded or not. A failed update is
+    ignored, as the status is informative and the next one replaces it.
+    """
+    def __init__(self, qclient, job_id, interval=None):
+        if interval is None:
+            interval = float(environ.get(
+                'QC_SHOGUN_STATUS_INTERVAL', STATUS_DFLT_INTERVAL))
+        self._qclient = qclient
+        self._job_id = job_id
+        self._interval = interval
+        self._pending = None
+        self._lock = Lock()
+        self._updated = Event()
+        self._closed = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def update(self, msg):
+        with self._lock:
+            self._pending = msg
+        self._updated.set()
+
+    def _send(self):
+        with self._lock:
+            msg, self._pending = self._pending, None
+        if msg is not None:
+            try:
+                self._qclient.update_job_step(self._job_id, msg)
+            except Exception:
+                pass
+
+    def _run(self):
+        while True:
+            self._updated.wait()
+            if self._closed.is_set():
+                return
+            self._updated.clear()
+            self._send()
+            if self._closed.wait(self._interval):
+                return
+
+    def close(self):
+        self._closed.set()
+        self._updated.set()
+        self._thread.join()
+        self._send()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _write_benchmarks(benchmark_fp, rows):
+    """Writes the resources used by the commands as a TSV
+
+    Parameters
+    ----------
+    benchmark_fp : str
+        The output filepath
+    rows : list of dict
+        The usage of each command, with the BENCHMARK_COLUMNS keys. The
+        unknown values (None) are written as NA
+
+    Notes
+    -----
+    The rows of benchmark_fp from an earlier run of the job, which was
+    resumed (see _run_commands), are kept unless their sample ran again.
+    """
+    lines = OrderedDict()
+    if exists(benchmark_fp):
+        with open(benchmark_fp) as f:
+            if f.readline().rstrip('\n').split('\t') == BENCHMARK_COLUMNS:
+                for line in f:
+                    line = line.rstrip('\n')
+                    if line:
+                        lines[line.split('\t', 1)[0]] = line
+    for row in rows:
+        values = []
+        for column in BENCHMARK_COLUMNS:
+            value = row[column]
+            if value is None:
+                value = 'NA'
+            elif column == 's':
+                value = '%.4f' % value
+            elif column in ('seqs', 'seqs_estimate'):
+                value = '%d' % value
+            elif isinstance(value, float):
+                value = '%.2f' % value
+            values.append(str(value))
+        lines[values[0]] = '\t'.join(values)
+
+    with open(benchmark_fp, 'w') as f:
+        f.write('\t'.join(BENCHMARK_COLUMNS) + '\n')
+        for line in lines.values():
+            f.write(line + '\n')
+
+
+def _log_lines(log_fp):
+    """The output lines of the last run of a command in its log
+
+    Parameters
+    ----------
+    log_fp : str
+        The log filepath, see _system_call_logged
+
+    Returns
+    -------
+    list of str
+        The stdout and stderr lines since the last time the command was
+        started, without their stream, empty if there is no log
+    """
+    lines = []
+    try:
+        with open(log_fp, errors='replace') as f:
+            for line in f:
+                if line.startswith('[command] '):
+                    lines = []
+                elif line.startswith(('[stdout] ', '[stderr] ')):
+                    lines.append(line[9:].rstrip('\n'))
+    except OSError:
+        pass
+    return lines
+
+
+def _write_read_counts(counts_fp, samples, counts, extra_columns=None):
+    """Writes the reads and bases in and out of each sample as a TSV
+
+    Parameters
+    ----------
+    counts_fp : str
+        The output filepath
+    samples : list of tup
+        list of 4-tuples with run prefix, sample name, fwd read fp, rev read fp
+    counts : dict of {str: tuple of int}
+        The reads in, reads out, bases in and bases out of each run prefix,
+        followed by the extra_columns, the samples without counts are left
+        out
+    extra_columns : list of str, optional
+        The columns after READ_COUNTS_COLUMNS, their unknown values (None)
+        are written as NA
+
+    Returns
+    -------
+    str
+        counts_fp
+
+    Notes
+    -----
+    The counts come from the outputs of the commands, which count the reads
+    as they stream them, so no file is read again.
+    """
+    with open(counts_fp, 'w') as f:
+        f.write('\t'.join(READ_COUNTS_COLUMNS + (extra_columns or [])) +
+                '\n')
+        for run_prefix, sample, _, _ in samples:
+            if counts.get(run_prefix) is None:
+                continue
+            f.write('\t'.join([sample, run_prefix] + [
+                'NA' if n is None else '%d' % n
+                for n in counts[run_prefix]]) + '\n')
+
+    return counts_fp
+
+
+def _counted_seqs(counts, paired):
+    """The sequences read by a command from its read counts
+
+    Parameters
+    ----------
+    counts : tuple of int or None
+        The read counts of the command, starting with the reads in, see
+        _write_read_counts
+    paired : bool
+        Whether the reads are pairs, which count as 2 reads
+
+    Returns
+    -------
+    int or None
+        The sequences of the forward reads, as the seqs of the benchmarks
+        and the estimates of plan_concurrency, None without counts
+    """
+    if counts is None or counts[0] is None:
+        return None
+    return counts[0] // 2 if paired else counts[0]
+
+
+def _load_ledger(ledger_fp):
+    """Loads the ledger of the commands that succeeded in a previous run
+
+    Parameters
+    ----------
+    ledger_fp : str
+        The ledger filepath
+
+    Returns
+    -------
+    dict of {str: dict of {str: int}}
+        The output filepaths, and their size, of each command keyed by its
+        log name, empty if there is no ledger
+    """
+    try:
+        with open(ledger_fp) as f:
+            return load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _ledger_validates(entry):
+    """Whether the outputs of a ledger entry exist with the recorded size"""
+    if not entry:
+        return False
+    for fp, size in entry.items():
+        if not exists(fp) or getsize(fp) != size:
+            return False
+    return True
+
+
+def _env_flag(name):
+    """Whether the environment variable name is set to true, yes or 1"""
+    return environ.get(name, 'false').lower() in ('true', 'yes', '1')
+
+
+def _gzip_level():
+    """The gzip level of the compressed outputs
+
+    Returns
+    -------
+    int or None
+        QC_SHOGUN_GZIP_LEVEL, from 1 (fastest) to 9 (smallest), or None for
+        the default of the compressor if it isn't set
+
+    Raises
+    ------
+    ValueError
+        If QC_SHOGUN_GZIP_LEVEL isn't a level
+    """
+    level = environ.get('QC_SHOGUN_GZIP_LEVEL')
+    if not level:
+        return None
+    if level not in [str(i) for i in range(1, 10)]:
+        raise ValueError(
+            'QC_SHOGUN_GZIP_LEVEL must be from 1 to 9, not %s' % level)
+    return int(level)
+
+
+def _scratch_dir(out_dir, needed_bytes):
+    """Creates a directory for the intermediate files of a job
+
+    Parameters
+    ----------
+    out_dir : str
+        The job output directory
+    needed_bytes : int
+        The space needed by the intermediate files
+
+    Returns
+    -------
+    str
+        A new directory in QC_SHOGUN_SCRATCH_DP, if set and it has
+        needed_bytes free, or in out_dir otherwise. The caller removes it
+
+    Notes
+    -----
+    The output directory is usually on a shared filesystem, so a node-local
+    scratch root (e.g. $TMPDIR or a local NVMe) keeps the intermediate files
+    off the network.
+    """
+    root = environ.get('QC_SHOGUN_SCRATCH_DP')
+    if root:
+        try:
+            makedirs(root, exist_ok=True)
+            if disk_usage(root).free >= needed_bytes:
+                return mkdtemp(prefix='qp-shogun-', dir=root)
+        except OSError:
+            pass
+    return mkdtemp(prefix='scratch-', dir=out_dir)
+
+
+def _move_atomic(src, dst):
+    """Moves a file so dst is either missing or complete
+
+    The file is copied next to dst, if it's in another filesystem, and
+    renamed to dst
+    """
+    tmp = '%s.tmp' % dst
+    move(src, tmp)
+    replace(tmp, dst)
+
+
+def _run_commands(qclient, job_id, commands, msg, cmd_name, concurrency=1,
+                  log_dir=None, log_names=None, seqs=None, outputs=None,
+                  ledger_fp=None, publish=None, count_seqs=None):
+    """Runs the commands, stopping at the first failure
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    job_id : str
+        The job id
+    commands : list of str
+        The commands to run
+    msg : str
+        The job step message, formatted with the 1-based command index
+    cmd_name : str
+        The name of the commands, used in the error message
+    concurrency : int, optional
+        The number of commands to run at the same time
+    log_dir : str, optional
+        If given, the output of each command is streamed to a log file in
+        this directory and the error message only has its tail
+    log_names : list of str, optional
+        The name of the log of each command, defaults to the command index
+    seqs : list of float, optional
+        The (estimated) number of sequences processed by each command
+    outputs : list of list of str, optional
+        The output filepaths of each command, required by ledger_fp
+    ledger_fp : str, optional
+        If given, the outputs of the commands that succeed are recorded in
+        this file, keyed by their log name, and the commands whose outputs
+        are still there are skipped when the job is run again
+    publish : list of list of (str, str), optional
+        The (scratch, final) filepaths of the outputs of each command, moved
+        atomically to their final filepath when the command succeeds, see
+        _scratch_dir
+    count_seqs : callable, optional
+        Given the output of a command (see _log_lines), the number of
+        sequences it read or None, see _counted_seqs
+
+    Returns
+    -------
+    bool, str
+        Whether all the commands succeeded and, if not, the error message of
+        the first one that failed. If QC_SHOGUN_ALLOW_SAMPLE_FAILURES is set
+        and some commands succeeded, True and the errors of the commands
+        that failed
+
+    Notes
+    -----
+    The job step updates are sent by a _StatusReporter so they don't delay
+    the commands. With concurrency > 1 the commands are started in order
+    and the job step is updated in order, when all the previous commands
+    are done. Once a command fails no other command starts, even if the
+    failure isn't reported yet; the ones running are waited for and the
+    error returned is the one of the first failed command in the list.
+
+    With a log_dir, the resources used by each command that ran are written
+    to benchmarks.tsv in log_dir, with the same columns as the benchmarks in
+    notebooks/support_files/benchmarks, so the models in TOOL_MODELS can be
+    refit from production jobs. Their seqs are the sequences counted by
+    count_seqs, NA without it, and seqs_estimate the seqs the plan used.
+
+    By default the job stops at the first failure. If
+    QC_SHOGUN_ALLOW_SAMPLE_FAILURES is true all the commands are run, the
+    outputs of the ones that failed are removed, and the job continues with
+    the rest.
+    """
+    usage = [None] * len(commands)
+    if log_names is None:
+        log_names = [str(i + 1) for i in range(len(commands))]
+    allow_failures = _env_flag('QC_SHOGUN_ALLOW_SAMPLE_FAILURES')
+    ledger = {} if ledger_fp is None else _load_ledger(ledger_fp)
+    ledger_lock = Lock()
+    skip = {i for i, name in enumerate(log_names)
+            if ledger_fp is not None and _ledger_validates(ledger.get(name))}
+    failed = Event()
+    if log_dir is not None:
+        makedirs(log_dir, exist_ok=True)
+        log_fps = [join(log_dir, '%s.log' % n) for n in log_names]
+
+    def _call(i):
+        if i in skip:
+            # this command succeeded in a previous run
+            return '', '', 0
+        if failed.is_set():
+            # a command failed so the job stops, the queued ones don't run
+            return None
+        if log_dir is None:
+            result = system_call(commands[i])
+        else:
+            usage[i] = {'sample': log_names[i], 'seqs': None,
+                        'seqs_estimate': seqs[i] if seqs is not None else None}
+            result = _system_call_logged(commands[i], log_fps[i], usage[i])
+            if count_seqs is not None:
+                usage[i]['seqs'] = count_seqs(_log_lines(log_fps[i]))
+        if publish is not None and result[2] == 0:
+            try:
+                for src, dst in publish[i]:
+                    if exists(src):
+                        _move_atomic(src, dst)
+            except OSError as e:
+                result = (result[0], '%s\nError moving the outputs: %s' % (
+                    result[1], e), 1)
+        if ledger_fp is not None and result[2] == 0:
+            with ledger_lock:
+                ledger[log_names[i]] = {
+                    fp: getsize(fp) for fp in outputs[i] if exists(fp)}
+                _save_json(ledger_fp, ledger)
+        if result[2] != 0 and not allow_failures:
+            failed.set()
+        return result
+
+    def _error(i, std_out, std_err):
+        error_msg = ("Error running %s:\nStd out: %s\nStd err: %s"
+                     "\n\nCommand run was:\n%s"
+                     % (cmd_name, std_out, std_err, commands[i]))
+        if log_dir is not None:
+            error_msg += "\n\nThe full output is in %s" % log_fps[i]
+        return error_msg
+
+    def _execute(reporter):
+        failures = []
+        if concurrency <= 1 or len(commands) <= 1:
+            for i in range(len(commands)):
+                reporter.update(msg % (i+1))
+                std_out, std_err, return_value = _call(i)
+                if return_value != 0:
+                    failures.append((i, _error(i, std_out, std_err)))
+                    if not allow_failures:
+                        break
+            return failures
+
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        futures = []
+        try:
+            futures = [executor.submit(_call, i)
+                       for i in range(len(commands))]
+            for i, future in enumerate(futures):
+                reporter.update(msg % (i+1))
+                result = future.result()
+                if result is None:
+                    # skipped after the failure of an earlier command,
+                    # which ends the loop before
+                    break
+                std_out, std_err, return_value = result
+                if return_value != 0:
+                    failures.append((i, _error(i, std_out, std_err)))
+                    if not allow_failures:
+                        break
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+        return failures
+
+    try:
+        with _StatusReporter(qclient, job_id) as reporter:
+            failures = _execute(reporter)
+            if not failures:
+                return True, ""
+            if not allow_failures or len(failures) == len(commands):
+                return False, failures[0][1]
+
+            # the partial outputs of the failed commands are removed so
+            # they are not part of the results
+            for i, _ in failures:
+                for fp in (outputs[i] if outputs is not None else []):
+                    if exists(fp):
+                        remove(fp)
+            summary = '%d of %d %s commands failed: %s' % (
+                len(failures), len(commands), cmd_name,
+                ', '.join(log_names[i] for i, _ in failures))
+            reporter.update(summary)
+            return True, '\n\n'.join(
+                [summary] + [error for _, error in failures])
+    finally:
+        if log_dir is not None:
+            _write_benchmarks(join(log_dir, 'benchmarks.tsv'),
+                              [u for u in usage if u is not None and 's' in u])
 
 
 def _per_sample_ainfo(
         out_dir, samples, suffixes, prg_name,
-        files_type_name, fwd_and_rev=False):
+        files_type_name, fwd_and_rev=False, log_fp=None, counts_fp=None):
     files = []
     missing_files = []
     smd = partial(join, out_dir)
@@ -174,4 +1532,9 @@ def _per_sample_ainfo(
         # was kept after quality control and filtering for host data
         raise ValueError("No sequences left after %s" % prg_name)
 
+    if log_fp is not None:
+        files.append((log_fp, 'log'))
+    if counts_fp is not None:
+        files.append((counts_fp, 'log'))
+
     return [ArtifactInfo(files_type_name, 'per_sample_FASTQ', files)]
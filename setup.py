@@ -44,7 +44,7 @@ setup(name='qp-shogun',
       test_suite='nose.collector',
       packages=['qp_shogun', 'qp_shogun/trim',
                 'qp_shogun/filter', 'qp_shogun/shogun',
-                'qp_shogun/sortmerna'],
+                'qp_shogun/sortmerna', 'qp_shogun/trim_filter'],
       package_data={
         'qp_shogun': [
             'support_files/config_file.cfg',